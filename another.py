@@ -3,8 +3,20 @@ import sys
 import os
 import hashlib
 import logging
-import json
-from datetime import datetime
+import checksum_cache
+import compare
+import diskorder
+import fileio
+import filetable
+import hashers
+import logs
+import stats
+import walker
+import workers
+from functools import partial
+
+
+logger = logs.get_logger('another')
 
 
 def chunk_reader(fobj, chunk_size=1024):
@@ -16,108 +28,556 @@ def chunk_reader(fobj, chunk_size=1024):
         yield chunk
 
 
-def get_hash(filename, first_chunk_only=False, hash=hashlib.md5):
-    """Get hash from file"""
+# Stages applied by check_duplicates() when none are given.
+DEFAULT_STAGES = ('size', '1k', 'content')
+
+# Number of bytes read at each offset of a 'sample:K' stage.
+SAMPLE_BLOCK_SIZE = 4096
+
+# Number of files going through the stages after the first one together.
+BATCH_FILES = 1024
+
+# Blocks of SAMPLE_BLOCK_SIZE bytes read per file by approximate_stages().
+APPROXIMATE_BLOCKS = 16
+
+
+def parse_stages(spec):
+    """
+    Parse a comma-separated list of grouping stages
+    - size: file size
+    - head:N / 1k: hash of the first N (1024) bytes
+    - tail:N: hash of the last N bytes
+    - sample:K: hash of K blocks spread evenly from head to tail
+    - content: hash of the full file content
+    Return a list of normalized stages, raise ValueError on invalid stage
+    """
+    stages = []
+    for stage in (spec.split(',') if isinstance(spec, str) else spec):
+        stage = stage.strip()
+        if stage == '1k':
+            stage = 'head:1024'
+        name, _, count = stage.partition(':')
+        if name in ('size', 'content') and not count:
+            stages.append(name)
+        elif name in ('head', 'tail', 'sample') and count.isdigit() \
+                and int(count) > 0:
+            stages.append(stage)
+        else:
+            raise ValueError('Invalid stage: ' + stage)
+    return stages
+
+
+def approximate_stages(blocks=APPROXIMATE_BLOCKS):
+    """
+    Return the stages of the approximate mode: size, then a fingerprint of
+    blocks blocks at fixed offsets from head to tail, see hash_stage()
+    At most blocks * SAMPLE_BLOCK_SIZE bytes are read per file whatever its
+    size, the groups found are likely but unverified duplicates
+    """
+    return parse_stages(['size', 'sample:%d' % blocks])
+
+
+def hash_stage(file_object, stage, hashobj):
+    """Update hashobj with the bytes of an open file selected by stage"""
+    name, _, count = stage.partition(':')
+    if name == 'head':
+        fileio.update_from_file(file_object, hashobj, length=int(count))
+    elif name == 'tail':
+        size = os.fstat(file_object.fileno()).st_size
+        file_object.seek(max(0, size - int(count)))
+        fileio.update_from_file(file_object, hashobj, length=int(count))
+    elif name == 'sample':
+        size = os.fstat(file_object.fileno()).st_size
+        count = int(count)
+        last = max(0, size - SAMPLE_BLOCK_SIZE)
+        for index in range(count):
+            file_object.seek(last * index // max(1, count - 1))
+            fileio.update_from_file(file_object, hashobj,
+                                    length=SAMPLE_BLOCK_SIZE)
+    else:
+        fileio.hash_open_file(file_object, hashobj)
+
+
+def get_hash(filename, first_chunk_only=False, hash=hashlib.md5,
+             cache=None, stage='content'):
+    """Get hash from file, looking it up in cache first when given
+    stage selects the bytes which are hashed, see parse_stages(),
+    first_chunk_only is a shortcut for the '1k' stage
+    Raise OSError if the file cannot be opened or read
+    """
+    stage = parse_stages(['1k' if first_chunk_only else stage])[0]
     hashobj = hash()
-    if os.access(filename, os.R_OK):
-        with open(filename, 'rb') as file_object:
-            if first_chunk_only:
-                hashobj.update(file_object.read(1024))
-            else:
-                for chunk in chunk_reader(file_object):
-                    hashobj.update(chunk)
-            hashed = hashobj.hexdigest()
-        return hashed
+    if cache is not None:
+        kind = hashers.hash_name(hash) + ':' + stage
+        cache_key = checksum_cache.record_key(walker.to_record(filename))
+        hashed = cache.get(cache_key, kind)
+        if hashed:
+            return hashed
+    with fileio.open_file(walker.record_path(filename),
+                          sequential=not stage.startswith('sample:')) \
+            as file_object:
+        hash_stage(file_object, stage, hashobj)
+    hashed = hashobj.hexdigest()
+    if cache is not None:
+        cache.put(cache_key, kind, hashed)
+    return hashed
+
+
+def get_hashes(file_path_names, stage='content', hash=hashlib.md5,
+               cache=None, jobs=1, use_processes=False, io_order='scan'):
+    """
+    Get hashes of several files with a pool of workers
+    Return a list of (ok, hash) tuples in the order of file_path_names,
+    ok is False when the file raised an OSError
+    Cache lookups and stores stay in the calling thread, the cache key of
+    a walker.FileRecord needs no extra stat call
+    io_order sets the order of the reads, see diskorder.read_batches(), any
+    order but 'scan' needs walker.FileRecords
+    """
+    results = [None] * len(file_path_names)
+    pending = []
+    kind = hashers.hash_name(hash) + ':' + stage
+    cache_keys = dict()
+
+    for index, filename in enumerate(file_path_names):
+        if cache is not None:
+            try:
+                cache_keys[index] = checksum_cache.record_key(
+                    walker.to_record(filename))
+            except OSError:
+                results[index] = (False, None)
+                continue
+            hashed = cache.get(cache_keys[index], kind)
+            if hashed:
+                results[index] = (True, hashed)
+                continue
+        pending.append(index)
+
+    for batch in diskorder.read_batches(
+            [file_path_names[index] for index in pending], io_order):
+        indexes = [pending[index] for index in batch]
+        hashed_files = workers.map_files(
+            partial(get_hash, stage=stage, hash=hash),
+            [walker.record_path(file_path_names[index])
+             for index in indexes],
+            jobs=jobs, use_processes=use_processes)
+        for index, (ok, hashed) in zip(indexes, hashed_files):
+            results[index] = (ok, hashed)
+            if ok and hashed and cache is not None:
+                cache.put(cache_keys[index], kind, hashed)
 
+    return results
 
-def group_by(file_path_names, hash=hashlib.md5, key='size'):
-    """Group files by 3 optional:
+
+def group_by(file_path_names, hash=hashlib.md5, key='size', cache=None,
+             jobs=1, use_processes=False, io_order='scan'):
+    """Group files by one stage, see parse_stages():
     - By size
-    - By 1024 first bytes
+    - By 1024 first bytes, or head/tail/sampled bytes
     - By full file content
-    Choose: key = ['size', '1k', 'content'].
+    Choose: key = ['size', '1k', 'content', 'head:N', 'tail:N', 'sample:K'].
     Return a dictionary contain duplicate files with md5 as key
+    Hashing keys are computed by `jobs` workers, see workers.map_files()
+    file_path_names may hold paths or walker.FileRecords, the dictionary
+    values hold the same items
+    Hardlinks of the same inode are hashed once and grouped together
+    io_order sets the order in which files are hashed, see get_hashes()
+    """
+    return dict((dict_key, filenames) for (_, dict_key), filenames
+                in group_each_by({(): file_path_names}, hash, key, cache,
+                                 jobs, use_processes, io_order).items())
+
+
+def group_each_by(groups, hash=hashlib.md5, key='size', cache=None, jobs=1,
+                  use_processes=False, io_order='scan'):
+    """
+    group_by() of every group of a dictionary at once
+    Return a dictionary of the files keyed by (group key, stage key), files
+    of different groups never share a key
+    The files of all the groups are hashed by a single pool of workers, so
+    that many small groups do not start one pool each
     """
     hashes_by = dict()
+    key = parse_stages([key])[0]
+    owners = list()
+    file_lists = list()
 
-    for filename in file_path_names:
-        try:
-            if key == '1k':
-                dict_key = get_hash(filename, first_chunk_only=True)
-            elif key == 'content':
-                dict_key = get_hash(filename, first_chunk_only=False)
-            else:
-                dict_key = os.path.getsize(filename)
-        except OSError:
-            continue
-        duplicate = hashes_by.get(dict_key)
-        if duplicate:
-            hashes_by[dict_key].append(filename)
-        else:
-            hashes_by[dict_key] = []
-            hashes_by[dict_key].append(filename)
+    if key != 'size':
+        records = list()
+        for group_key, values in groups.items():
+            group_records, links = walker.collapse_hardlinks(values)
+            for record in group_records:
+                owners.append(group_key)
+                records.append(record)
+                file_lists.append(links[walker.inode_key(record)])
+        keys = get_hashes(records, stage=key, hash=hash, cache=cache,
+                          jobs=jobs, use_processes=use_processes,
+                          io_order=io_order)
+    else:
+        for group_key, values in groups.items():
+            for filename in values:
+                owners.append(group_key)
+                file_lists.append([filename])
+        keys = [workers.call_safely(walker.record_size, filenames[0])
+                for filenames in file_lists]
+
+    for owner, filenames, (ok, dict_key) in zip(owners, file_lists, keys):
+        if ok:
+            hashes_by.setdefault((owner, dict_key), list()).extend(filenames)
 
     return hashes_by
 
 
-def create_log_file(LOG_FILENAME='default.log'):
+def run_stage(groups, stage, counts, hash=hashlib.md5, cache=None, jobs=1,
+              use_processes=False,
+              compare_max_group=compare.COMPARE_MAX_GROUP,
+              can_compare=True, prefilter_hash=None, scan_stats=None,
+              io_order='scan', keep=None):
     """
-    Create log file
+    Split every group of a grouping dictionary by one stage
+    Return (refined, confirmed) dictionaries keyed by composite keys:
+    refined holds the groups left for the next stage, confirmed the groups
+    settled by compare.compare_groups()
+    counts is a dictionary whose files_in, files_out, compared and
+    eliminated numbers are increased
+    scan_stats, an optional stats.ScanStats, measures the stage under its
+    name and the byte by byte comparison as 'compare'
+    io_order sets the order of the files hashed by the content stage, see
+    diskorder.read_batches()
+    keep, e.g. a MixedGroups, drops the groups for which it returns False
+    before they are split, and as soon as a comparison isolates them
+    The groups which are not compared are hashed together, see
+    group_each_by()
     """
-    logging.basicConfig(
-        filename=LOG_FILENAME,
-        level=logging.DEBUG,
-        format='%(message)s'
-    )
+    refined = dict()
+    confirmed = dict()
+    small_groups = []
+    small_keys = []
+    hashed_groups = dict()
+    links = dict()
+    files_in = sum(len(values) for values in groups.values())
+    with stats.stage(scan_stats, stage) as measures:
+        for keys, values in groups.items():
+            inodes = walker.count_inodes(values)
+            if inodes < 2 or keep is not None and not keep(values):
+                continue
+            elif can_compare and stage != 'size' \
+                    and inodes <= compare_max_group:
+                records, group_links = walker.collapse_hardlinks(values)
+                small_groups.append(records)
+                small_keys.append(keys)
+                links.update(group_links)
+            else:
+                measures.files_in += len(values)
+                hashed_groups[keys] = values
+        for (keys, key), sub_values in group_each_by(
+                hashed_groups, key=stage, cache=cache,
+                hash=hash if stage == 'content' else prefilter_hash or hash,
+                jobs=jobs, use_processes=use_processes,
+                io_order=io_order if stage == 'content'
+                else 'scan').items():
+            if walker.count_inodes(sub_values) > 1 and (
+                    keep is None or keep(sub_values)):
+                refined[keys + (key,)] = sub_values
+                measures.files_out += len(sub_values)
+
+    compared = sum(len(links[walker.inode_key(record)])
+                   for records in small_groups for record in records)
+    if small_groups:
+        with stats.stage(scan_stats, 'compare', compared) as measures:
+            for keys, classes in zip(small_keys, compare.compare_groups(
+                    small_groups, cache=cache, hash=hash, jobs=jobs,
+                    use_processes=use_processes,
+                    keeps=None if keep is None else [
+                        keep.restrict(records, links)
+                        for records in small_groups])):
+                for digest, records in classes:
+                    confirmed[keys + ('compare', digest)] = [
+                        value for record in records
+                        for value in links[walker.inode_key(record)]]
+                    measures.files_out += len(
+                        confirmed[keys + ('compare', digest)])
+    files_out = sum(len(values) for values in refined.values())
+    counts['files_in'] = counts.get('files_in', 0) + files_in
+    counts['files_out'] = counts.get('files_out', 0) + files_out
+    counts['compared'] = counts.get('compared', 0) + compared
+    counts['eliminated'] = counts.get('eliminated', 0) \
+        + files_in - files_out - compared
+    return refined, confirmed
 
 
-def check_duplicates(file_path_names, hash=hashlib.md5):
+class MixedGroups:
     """
-    Return a list of duplicate files
+    Filter of run_stage() keeping the groups which hold both files of a set,
+    e.g. candidates, and files out of it, e.g. references
+    - first: set of paths of the files of the set
     """
-    result = []
-    hashes_by_size = dict()
-    hashes_on_1k = dict()
-    hashes_full = dict()
 
-    create_log_file("another.log")
+    def __init__(self, first):
+        self.first = first
 
-    # hashes_by_size = group_by_size(file_path_names)
-    hashes_by_size = group_by(file_path_names, key='size')
+    def __call__(self, values):
+        inside = [walker.record_path(value) in self.first for value in values]
+        return any(inside) and not all(inside)
 
-    logging.debug("Time: " + str(datetime.now()))
-    logging.debug("List hashes by size:")
-    logging.debug(json.dumps(hashes_by_size, indent=4))
+    def restrict(self, records, links):
+        """
+        Return the filter of one group of records, one per inode whose
+        hardlinks are in links, holding only its own paths so that it is
+        cheap to send to a process pool
+        A record stands for every link of its inode: it counts in the set
+        when one of its links does
+        """
+        return MixedGroups(frozenset(
+            record.path for record in records
+            if any(walker.record_path(value) in self.first
+                   for value in links[walker.inode_key(record)])))
 
-    for keys, values in hashes_by_size.items():
-        if len(values) < 2:
-            continue
-        else:
-            # hashes_on_1k.update(group_on_1k(values))
-            hashes_on_1k.update(group_by(values, key='1k'))
 
-    logging.debug("List hashes on 1k:")
-    logging.debug(json.dumps(hashes_on_1k, indent=4))
+def table_size_stage(table, counts, scan_stats=None):
+    """
+    Size stage of a filetable.FileTable, grouped by sorting its size array
+    Return the grouping dictionary of run_stage(), holding the
+    walker.FileRecords of the files of groups with at least 2 inodes only
+    """
+    groups = dict()
+    with stats.stage(scan_stats, 'size', len(table)) as measures:
+        for indexes in table.size_groups(min_size=0):
+            records = table.records(indexes)
+            if walker.count_inodes(records) > 1:
+                groups[(records[0].size,)] = records
+                measures.files_out += len(records)
+    files_out = sum(len(values) for values in groups.values())
+    counts['files_in'] = counts.get('files_in', 0) + len(table)
+    counts['files_out'] = counts.get('files_out', 0) + files_out
+    counts['compared'] = counts.get('compared', 0)
+    counts['eliminated'] = counts.get('eliminated', 0) \
+        + len(table) - files_out
+    return groups
 
-    for keys, values in hashes_on_1k.items():
-        if len(values) < 2:
-            continue
-        else:
-            # hashes_full.update(group_by_content(values))
-            hashes_full.update(group_by(values, key='content'))
 
-    logging.debug("List hashes by full content:")
-    logging.debug(json.dumps(hashes_full, indent=4))
+def duplicate_group(keys, values):
+    """
+    Return the walker.DuplicateGroup of a group of FileRecords, its digest
+    is the last hash key when there is one
+    """
+    digest = keys[-1] if keys and isinstance(keys[-1], str) else None
+    return walker.DuplicateGroup(values[0].size, digest,
+                                 [walker.record_path(value)
+                                  for value in values])
 
-    for keys, values in hashes_full.items():
-        if len(values) < 2:
-            continue
-        else:
-            result.append(values)
 
-    logging.debug("Result list:")
-    logging.debug(json.dumps(result, indent=4))
-    logging.debug('<===============================END-OF-MESSAGE\
-===============================>\n')
+def iter_duplicates(file_path_names, hash=hashlib.md5, cache=None, jobs=1,
+                    use_processes=False,
+                    compare_max_group=compare.COMPARE_MAX_GROUP,
+                    stages=DEFAULT_STAGES, stage_counts=None,
+                    prefilter_hash=None, batch_files=BATCH_FILES,
+                    scan_stats=None, io_order='scan'):
+    """
+    Generator version of check_duplicates
+    Yield a walker.DuplicateGroup(size, digest, paths) for every group of
+    duplicates as soon as its last stage confirms it
+    The groups of the first stage go through the other stages in batches of
+    about batch_files files
+    scan_stats, an optional stats.ScanStats, receives the measures of the
+    'scan' of file_path_names, of every stage and of 'compare'
+    """
+    stages = parse_stages(stages)
+    can_compare = 'content' in stages
+    counts = [dict(stage=stage) for stage in stages]
+    compare_counts = dict(stage='compare', files_out=0)
+    options = dict(hash=hash, cache=cache, jobs=jobs,
+                   use_processes=use_processes,
+                   compare_max_group=compare_max_group,
+                   can_compare=can_compare, prefilter_hash=prefilter_hash,
+                   scan_stats=scan_stats, io_order=io_order)
+
+    logger.info('start', extra=logs.fields(stages=stages))
+
+    if isinstance(file_path_names, filetable.FileTable) \
+            and stages[0] == 'size':
+        first_groups = table_size_stage(file_path_names, counts[0],
+                                        scan_stats)
+        confirmed = dict()
+    else:
+        first_groups, confirmed = run_stage(
+            {(): list(stats.iter_stage(scan_stats, 'scan',
+                                       walker.to_records(file_path_names)))},
+            stages[0], counts[0], **options)
+    compare_counts['files_out'] += sum(len(values)
+                                       for values in confirmed.values())
+
+    batches = [dict()]
+    batch_size = 0
+    for keys, values in first_groups.items():
+        if batch_size >= batch_files:
+            batches.append(dict())
+            batch_size = 0
+        batches[-1][keys] = values
+        batch_size += len(values)
+
+    for groups in batches:
+        for index, stage in enumerate(stages[1:], 1):
+            groups, stage_confirmed = run_stage(groups, stage, counts[index],
+                                                **options)
+            confirmed.update(stage_confirmed)
+            compare_counts['files_out'] += sum(
+                len(values) for values in stage_confirmed.values())
+        for keys, values in list(groups.items()) + list(confirmed.items()):
+            group = duplicate_group(keys, values)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('group', extra=logs.fields(
+                    sampled=True, size=group.size, digest=group.digest,
+                    files=len(group.paths), paths=group.paths))
+            yield group
+        confirmed = dict()
+
+    compared = sum(stage_count['compared'] for stage_count in counts
+                   if 'compared' in stage_count)
+    if compared:
+        compare_counts.update(
+            files_in=compared, compared=0,
+            eliminated=compared - compare_counts['files_out'])
+        counts.append(compare_counts)
+    counts = [stage_count for stage_count in counts
+              if 'files_in' in stage_count]
+    for stage_count in counts:
+        logger.info('stage', extra=logs.fields(**stage_count))
+    if stage_counts is not None:
+        stage_counts.extend(counts)
+
+
+def check_duplicates(file_path_names, hash=hashlib.md5, cache=None, jobs=1,
+                     use_processes=False,
+                     compare_max_group=compare.COMPARE_MAX_GROUP,
+                     stages=DEFAULT_STAGES, stage_counts=None,
+                     prefilter_hash=None, scan_stats=None, io_order='scan'):
+    """
+    Return a list of duplicate files
+    file_path_names may hold paths or walker.FileRecords, each file is
+    stat'ed at most once, or be a filetable.FileTable whose size stage
+    sorts its size array
+    Files go through stages in order (see parse_stages()), each stage only
+    splits the groups left by the previous one. Groups are keyed by the
+    tuple of keys of every stage so far, groups of different sizes never
+    merge.
+    Groups made only of hardlinks of one inode are not duplicates, see
+    walker.hardlink_groups()
+    When stages contain 'content', groups of at most compare_max_group
+    inodes skip the remaining stages and are compared byte by byte, see
+    compare.compare_files()
+    stage_counts, when a list, receives one dictionary per stage with the
+    number of files in, out, compared and eliminated
+    The content stage and the comparison use hash, the other stages use
+    prefilter_hash, or hash when None, see hashers.get_hash_factory()
+    scan_stats, an optional stats.ScanStats, receives the time, files,
+    bytes read and errors of every stage, see iter_duplicates()
+    io_order sets the order of the files hashed in full, see
+    diskorder.read_batches()
+    """
+    return [group.paths for group in iter_duplicates(
+        file_path_names, hash=hash, cache=cache, jobs=jobs,
+        use_processes=use_processes, compare_max_group=compare_max_group,
+        stages=stages, stage_counts=stage_counts,
+        prefilter_hash=prefilter_hash, scan_stats=scan_stats,
+        io_order=io_order)]
+
+
+def iter_reference_matches(file_path_names, reference_names,
+                           hash=hashlib.md5, cache=None, jobs=1,
+                           use_processes=False,
+                           compare_max_group=compare.COMPARE_MAX_GROUP,
+                           stages=DEFAULT_STAGES, stage_counts=None,
+                           prefilter_hash=None, scan_stats=None,
+                           io_order='scan', min_size=0):
+    """
+    Generator of the candidate files whose content is already in a
+    reference set
+    Yield a walker.ReferenceMatch(size, digest, paths, references) for
+    every content of the candidates found among the references
+    - file_path_names: paths, walker.FileRecords or filetable.FileTable of
+    the candidates, read first
+    - reference_names: paths or walker.FileRecords of the references, read
+    lazily; only the ones of a size of a candidate of at least min_size
+    bytes are kept, and the paths of candidates are skipped
+    - A candidate sharing its inode with a reference matches it without
+    reading either file, digest is then None; the reference is still
+    compared with the other candidates
+    - The other files go through stages as in iter_duplicates(), but every
+    group left without a candidate or without a reference is dropped at
+    once, so duplicates among the references are never computed
+    - Raise ValueError if the first stage is not size
+    """
+    stages = parse_stages(stages)
+    if stages[0] != 'size':
+        raise ValueError('The first stage of a reference scan must be size')
+    counts = [dict(stage=stage) for stage in stages]
+    options = dict(hash=hash, cache=cache, jobs=jobs,
+                   use_processes=use_processes,
+                   compare_max_group=compare_max_group,
+                   can_compare='content' in stages,
+                   prefilter_hash=prefilter_hash, scan_stats=scan_stats,
+                   io_order=io_order)
+
+    if not isinstance(file_path_names, filetable.FileTable):
+        file_path_names = stats.iter_stage(
+            scan_stats, 'scan', walker.to_records(file_path_names))
+    candidates = [record for record in file_path_names
+                  if record.size >= min_size]
+    by_size = dict()
+    candidate_inodes = dict()
+    for record in candidates:
+        by_size.setdefault(record.size, list()).append(record)
+        candidate_inodes.setdefault(walker.inode_key(record), list()).append(
+            record)
+    references = dict()
+    linked = dict()
+    with stats.stage(scan_stats, 'reference') as measures:
+        for record in walker.to_records(reference_names):
+            measures.files_in += 1
+            if record.size not in by_size:
+                continue
+            # Only a reference sharing the inode of a candidate can be one
+            # of the candidates, their paths are compared then.
+            links = candidate_inodes.get(walker.inode_key(record), ())
+            if any(link.path == record.path for link in links):
+                continue
+            measures.files_out += 1
+            if links:
+                linked.setdefault(walker.inode_key(record), list()).append(
+                    record.path)
+            references.setdefault(record.size, list()).append(record)
+
+    for record in candidates:
+        if walker.inode_key(record) in linked:
+            yield walker.ReferenceMatch(record.size, None, [record.path],
+                                        linked[walker.inode_key(record)])
+    groups = dict()
+    candidate_paths = set()
+    for size, records in by_size.items():
+        if size not in references:
+            continue
+        own = [record for record in records
+               if walker.inode_key(record) not in linked]
+        if own and walker.count_inodes(own + references[size]) > 1:
+            groups[(size,)] = own + references[size]
+            candidate_paths.update(record.path for record in own)
+    keep = MixedGroups(candidate_paths)
+    files_in = len(candidates) + sum(map(len, references.values()))
+    files_out = sum(map(len, groups.values()))
+    counts[0].update(files_in=files_in, files_out=files_out, compared=0,
+                     eliminated=files_in - files_out)
 
-    return result
+    confirmed = dict()
+    for index, stage in enumerate(stages[1:], 1):
+        groups, stage_confirmed = run_stage(groups, stage, counts[index],
+                                            keep=keep, **options)
+        confirmed.update(stage_confirmed)
+    for keys, values in list(groups.items()) + list(confirmed.items()):
+        group = duplicate_group(keys, values)
+        yield walker.ReferenceMatch(
+            group.size, group.digest,
+            [path for path in group.paths if path in candidate_paths],
+            [path for path in group.paths if path not in candidate_paths])
+    if stage_counts is not None:
+        stage_counts.extend(counts)
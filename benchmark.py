@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import another
+import compare
+import diskorder
+import fileio
+import hashers
+import server
+import walker
+import workers
+import find_duplicate_files as fdf
+import generate_duplicate_files as gdf
+
+
+ONE_MB = 1024 * 1024
+ONE_KB = 1024
+
+# Corpora of the benchmark suite: keyword arguments of
+# generate_duplicate_files.generate_files(), file counts and sizes are
+# multiplied by the --scale option. 'prefix' is the number of leading bytes
+# made identical in every file after generation.
+SCENARIOS = {
+    'tiny_files': dict(file_count=2000, file_min_size=1,
+                       file_max_size=4 * ONE_KB, duplicate_file_ratio=0.2),
+    'huge_files': dict(file_count=4, file_min_size=8 * ONE_MB,
+                       file_max_size=8 * ONE_MB, duplicate_file_ratio=0.5),
+    'same_size_different': dict(file_count=200, file_min_size=64 * ONE_KB,
+                                file_max_size=64 * ONE_KB,
+                                duplicate_file_ratio=0),
+    'identical_prefix': dict(file_count=100, file_min_size=128 * ONE_KB,
+                             file_max_size=128 * ONE_KB,
+                             duplicate_file_ratio=0.2, prefix=64 * ONE_KB),
+    'deep_tree': dict(file_count=500, file_min_size=ONE_KB,
+                      file_max_size=8 * ONE_KB, duplicate_file_ratio=0.2,
+                      directory_min_depth=16, directory_max_depth=32),
+    'high_duplicates': dict(file_count=400, file_min_size=16 * ONE_KB,
+                            file_max_size=64 * ONE_KB,
+                            duplicate_file_ratio=4),
+}
+
+# Option combinations run on every corpus.
+SUITE_OPTIONS = {
+    'bonus': (False, True),
+    'jobs': tuple(sorted({1, workers.default_jobs()})),
+    'compare_max_group': (0, compare.COMPARE_MAX_GROUP),
+}
+
+
+def get_arguments():
+    """
+    Get argument from command-line interface
+    - Expected value: ArgumentParser Object with the benchmark to run in
+    parser.command and its options
+    """
+    parser = argparse.ArgumentParser(description='Duplicate files finder \
+                                                  benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    io_parser = commands.add_parser('io', help='Hashing I/O throughput of \
+                                                one file, from page cache')
+    io_parser.add_argument('--size-mb', type=int, default=256,
+                           help='Size of the test file in MiB')
+    io_parser.add_argument('--repeat', type=int, default=3,
+                           help='Number of runs, the best one is kept')
+
+    hashes_parser = commands.add_parser('hashes', help='Rank the available \
+                                                        hash algorithms')
+    hashes_parser.add_argument('--size-mb', type=int, default=64,
+                               help='Number of MiB hashed per algorithm')
+
+    suite_parser = commands.add_parser('suite', help='Run both algorithms \
+                                                      with every option on \
+                                                      seeded corpora')
+    suite_parser.add_argument('--scenarios', type=str,
+                              default=','.join(sorted(SCENARIOS)),
+                              help='Comma-separated scenarios among %s'
+                              % ', '.join(sorted(SCENARIOS)))
+    suite_parser.add_argument('--seed', type=int, default=0,
+                              help='Seed of the generated corpora')
+    suite_parser.add_argument('--scale', type=float, default=1,
+                              help='Multiply file counts by this factor')
+    suite_parser.add_argument('--work-dir', type=str,
+                              help='Where corpora are generated, kept after \
+                                    the run when given')
+    suite_parser.add_argument('--drop-caches', action='store_true',
+                              help='Drop the page cache before each run \
+                                    (root only)')
+
+    order_parser = commands.add_parser('disk-order', help='Hash a tree in \
+                                                           each I/O order')
+    order_parser.add_argument('-p', '--path', type=str,
+                              help='Tree to hash, a seeded corpus is \
+                                    generated when not given')
+    order_parser.add_argument('--file-count', type=int, default=2000)
+    order_parser.add_argument('--seed', type=int, default=0)
+    order_parser.add_argument('--drop-caches', action='store_true',
+                              help='Drop the page cache before each order \
+                                    so that files come from disk (root only)')
+
+    scan_parser = commands.add_parser('scan', help='Traverse a generated \
+                                                    tree on a slowed file \
+                                                    system stand-in')
+    scan_parser.add_argument('--file-count', type=int, default=2000)
+    scan_parser.add_argument('--latency-ms', type=float, default=1,
+                             help='Delay added to every directory listing \
+                                   and file stat call')
+    scan_parser.add_argument('--scan-jobs', type=str, default='1,4,16',
+                             help='Comma-separated thread counts to compare')
+    scan_parser.add_argument('--seed', type=int, default=0)
+
+    server_parser = commands.add_parser('server', help='Load the query \
+                                                        server with \
+                                                        concurrent lookups')
+    server_parser.add_argument('--file-count', type=int, default=2000)
+    server_parser.add_argument('--lookups', type=int, default=20000)
+    server_parser.add_argument('--batch', type=str, default='1,100',
+                               help='Comma-separated numbers of lookups \
+                                     per request to compare')
+    server_parser.add_argument('--clients', type=int, default=4)
+    server_parser.add_argument('--seed', type=int, default=0)
+
+    run_parser = commands.add_parser('run', help='Run one scan and report \
+                                                  its measures')
+    run_parser.add_argument('-p', '--path', type=str, required=True)
+    run_parser.add_argument('-b', '--bonus', action='store_true')
+    run_parser.add_argument('-j', '--jobs', type=int, default=1)
+    run_parser.add_argument('--compare-max-group', type=int,
+                            default=compare.COMPARE_MAX_GROUP)
+    return parser.parse_args()
+
+
+def time_best(func, repeat):
+    """Return the shortest wall time of repeat calls of func"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def hash_chunk_reader(file_path_name):
+    """Hash a file with the original 1 KiB chunk_reader loop"""
+    h = hashlib.md5()
+    with open(file_path_name, 'rb') as fd:
+        for chunk in fdf.chunk_reader(fd):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_readinto(file_path_name):
+    """Hash a file with fileio.update_from_file and no mmap"""
+    h = hashlib.md5()
+    with open(file_path_name, 'rb', buffering=0) as fd:
+        fileio.update_from_file(
+            fd, h, block_size=fileio.block_size_for(os.fstat(fd.fileno())))
+    return h.hexdigest()
+
+
+def hash_mmap(file_path_name):
+    """Hash a file with fileio.update_from_mmap"""
+    h = hashlib.md5()
+    with open(file_path_name, 'rb', buffering=0) as fd:
+        fileio.update_from_mmap(fd, h, os.fstat(fd.fileno()).st_size)
+    return h.hexdigest()
+
+
+IO_METHODS = (('chunk_reader', hash_chunk_reader),
+              ('readinto', hash_readinto),
+              ('mmap', hash_mmap),
+              ('hash_file', lambda path: fileio.hash_file(path,
+                                                          hashlib.md5())))
+
+
+def benchmark_io(size_mb=256, repeat=3):
+    """
+    Measure the hashing throughput of each read method on one file
+    - Expected value: list of {'method', 'seconds', 'mb_per_s'} dictionaries
+    - The file is freshly written so it is read from the page cache, which
+    isolates the per-block Python overhead from disk speed
+    """
+    results = list()
+    with tempfile.NamedTemporaryFile() as fd:
+        block = os.urandom(ONE_MB)
+        for _ in range(size_mb):
+            fd.write(block)
+        fd.flush()
+        for name, method in IO_METHODS:
+            seconds = time_best(lambda: method(fd.name), repeat)
+            results.append({'method': name,
+                            'seconds': round(seconds, 4),
+                            'mb_per_s': round(size_mb / seconds, 1)})
+    return results
+
+
+def generate_corpus(scenario, root_path, seed=0, scale=1):
+    """
+    Generate the files of a scenario under root_path with a fixed seed
+    - Expected value: list of (file_path_name, file_size) generated
+    """
+    options = dict(SCENARIOS[scenario])
+    prefix = options.pop('prefix', 0)
+    options['file_count'] = max(2, int(options['file_count'] * scale))
+    rng = random.Random('%s:%d' % (scenario, seed))
+    files = gdf.generate_files(root_path=root_path, seed=rng.getrandbits(64),
+                               **options)
+    if prefix:
+        head = gdf.generate_random_bytes(prefix, rng)
+        for file_path_name, _ in files:
+            with open(file_path_name, 'r+b') as fd:
+                fd.write(head)
+    return files
+
+
+def run_scan(path, bonus=False, jobs=1,
+             compare_max_group=compare.COMPARE_MAX_GROUP):
+    """
+    Scan path once and measure it
+    - Expected value: dictionary of wall and CPU seconds, files and bytes
+    scanned, bytes read, throughputs, peak RSS and number of groups found
+    - Peak RSS is the one of the whole process, run it in a fresh process
+    to measure one scan, see run_in_subprocess()
+    """
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    read_start = fileio.bytes_read()
+    records = list(walker.scan_records(path))
+    if bonus:
+        groups = another.check_duplicates(
+            records, jobs=jobs, compare_max_group=compare_max_group)
+    else:
+        groups = fdf.find_duplicate_files(
+            records, jobs=jobs, compare_max_group=compare_max_group)
+    wall = time.perf_counter() - start
+    bytes_read = fileio.bytes_read() - read_start
+    return {'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(time.process_time() - cpu_start, 4),
+            'files': len(records),
+            'bytes_scanned': sum(record.size for record in records),
+            'bytes_read': bytes_read,
+            'files_per_s': round(len(records) / wall, 1),
+            'mb_per_s': round(bytes_read / ONE_MB / wall, 1),
+            'peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+            'groups': len(groups)}
+
+
+def run_in_subprocess(path, bonus, jobs, compare_max_group, cwd=None):
+    """Run run_scan() in a fresh interpreter and return its measures"""
+    command = [sys.executable, os.path.abspath(__file__), 'run', '-p', path,
+               '-j', str(jobs), '--compare-max-group', str(compare_max_group)]
+    if bonus:
+        command.append('-b')
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                            cwd=cwd).stdout
+    return json.loads(output.decode())
+
+
+class SlowEntry:
+    """os.DirEntry whose stat() waits latency seconds, see slowed_scandir()"""
+
+    def __init__(self, entry, latency):
+        self.entry = entry
+        self.latency = latency
+        self.name = entry.name
+        self.path = entry.path
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self.entry.is_file(follow_symlinks=follow_symlinks)
+
+    def stat(self, follow_symlinks=True):
+        time.sleep(self.latency)
+        return self.entry.stat(follow_symlinks=follow_symlinks)
+
+
+@contextlib.contextmanager
+def slowed_scandir(latency):
+    """
+    Stand-in for a network or FUSE file system: while active, os.scandir
+    waits latency seconds before listing a directory and every stat() of
+    its entries waits latency seconds, like a round trip to a server
+    """
+    scandir = os.scandir
+
+    @contextlib.contextmanager
+    def slow_scandir(path):
+        time.sleep(latency)
+        with scandir(path) as entries:
+            yield (SlowEntry(entry, latency) for entry in entries)
+
+    os.scandir = slow_scandir
+    try:
+        yield
+    finally:
+        os.scandir = scandir
+
+
+def benchmark_scan(file_count=2000, latency=0.001, scan_jobs=(1, 4, 16),
+                   seed=0):
+    """
+    Traverse a generated tree with a slowed os.scandir and each number of
+    scan threads, ordered or not
+    - Expected value: list of {'scan_jobs', 'ordered', 'seconds',
+    'files_per_s', 'same_files'} dictionaries, same_files telling whether
+    the same files were found as with one thread
+    """
+    root = tempfile.mkdtemp(prefix='dff-benchmark-')
+    results = list()
+    try:
+        gdf.generate_files(file_count, directory_max_depth=3,
+                           file_min_size=1, file_max_size=ONE_KB,
+                           root_path=root, seed=seed)
+        expected = sorted(walker.scan_records(root))
+        with slowed_scandir(latency):
+            for jobs in scan_jobs:
+                for ordered in ((True,) if jobs == 1 else (False, True)):
+                    start = time.perf_counter()
+                    records = list(walker.scan_records(root, jobs=jobs,
+                                                       ordered=ordered))
+                    seconds = time.perf_counter() - start
+                    results.append({'scan_jobs': jobs,
+                                    'ordered': ordered,
+                                    'seconds': round(seconds, 4),
+                                    'files_per_s': round(len(records)
+                                                         / seconds, 1),
+                                    'same_files': sorted(records)
+                                    == expected})
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def percentile(values, fraction):
+    """Return the value below which fraction of the sorted values fall"""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def server_queries(index, rng, count):
+    """
+    Draw count queries for a StoreIndex built from a tree: a third are
+    (size, digest) of stored contents, a third (size, digest) which are
+    not stored, and a third paths of stored files
+    """
+    records = [record for records in index.by_size.values()
+               for record in records]
+    queries = list()
+    for number in range(count):
+        record = rng.choice(records)
+        if number % 3 == 0:
+            queries.append({'size': record.size,
+                            'digest': fdf.get_file_checksum(record)})
+        elif number % 3 == 1:
+            queries.append({'size': record.size,
+                            'digest': '%032x' % rng.getrandbits(128)})
+        else:
+            queries.append({'path': record.path})
+    return queries
+
+
+def benchmark_server(file_count=2000, lookups=20000, batches=(1, 100),
+                     clients=4, seed=0):
+    """
+    Serve a StoreIndex of a generated tree on localhost and send it
+    lookups from concurrent clients, each on its own keep-alive connection
+    - Expected value: list of {'batch', 'clients', 'lookups', 'seconds',
+    'lookups_per_s', 'p50_ms', 'p99_ms'} dictionaries, one per batch size,
+    latencies being the ones of whole requests
+    - Every stored file is hashed before serving, queries then measure the
+    index and the server, not the hashing of stored files
+    """
+    root = tempfile.mkdtemp(prefix='dff-benchmark-')
+    results = list()
+    try:
+        gdf.generate_files(file_count, directory_max_depth=3,
+                           file_min_size=1, file_max_size=ONE_KB,
+                           duplicate_file_ratio=0.3, root_path=root,
+                           seed=seed)
+        index = server.StoreIndex()
+        index.build(root)
+        queries = server_queries(index, random.Random(seed), lookups)
+        lookup_server = server.make_server(index)
+        thread = threading.Thread(target=lookup_server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        try:
+            for batch in batches:
+                latencies = list()
+
+                def run_client(client_queries):
+                    client = server.Client(*lookup_server.server_address[:2])
+                    try:
+                        for start in range(0, len(client_queries), batch):
+                            request_start = time.perf_counter()
+                            client.lookup(client_queries[start:start
+                                                         + batch])
+                            latencies.append(time.perf_counter()
+                                             - request_start)
+                    finally:
+                        client.close()
+
+                threads = [threading.Thread(target=run_client,
+                                            args=(queries[number::clients],))
+                           for number in range(clients)]
+                start = time.perf_counter()
+                for client_thread in threads:
+                    client_thread.start()
+                for client_thread in threads:
+                    client_thread.join()
+                seconds = time.perf_counter() - start
+                latencies.sort()
+                results.append({'batch': batch, 'clients': clients,
+                                'lookups': len(queries),
+                                'seconds': round(seconds, 4),
+                                'lookups_per_s': round(len(queries)
+                                                       / seconds, 1),
+                                'p50_ms': round(percentile(latencies, 0.5)
+                                                * 1000, 3),
+                                'p99_ms': round(percentile(latencies, 0.99)
+                                                * 1000, 3)})
+        finally:
+            lookup_server.shutdown()
+            lookup_server.server_close()
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def drop_caches():
+    """Flush dirty pages and drop the page cache, ignore if not permitted"""
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as fd:
+            fd.write('3\n')
+    except OSError:
+        pass
+
+
+def benchmark_suite(scenarios, seed=0, scale=1, work_dir=None,
+                    with_drop_caches=False):
+    """
+    Generate each scenario corpus and scan it with every combination of
+    SUITE_OPTIONS, each scan in its own process
+    - Expected value: list of dictionaries with the scenario, options and
+    measures of every run
+    """
+    results = list()
+    root = work_dir or tempfile.mkdtemp(prefix='dff-benchmark-')
+    try:
+        for scenario in scenarios:
+            corpus = os.path.join(root, '%s-%d-%g' % (scenario, seed, scale))
+            if not os.path.isdir(corpus):
+                generate_corpus(scenario, corpus, seed, scale)
+            names = sorted(SUITE_OPTIONS)
+            for values in itertools.product(*(SUITE_OPTIONS[name]
+                                               for name in names)):
+                options = dict(zip(names, values))
+                if with_drop_caches:
+                    drop_caches()
+                result = {'scenario': scenario, 'seed': seed,
+                          'scale': scale}
+                result.update(options)
+                result.update(run_in_subprocess(corpus, cwd=root, **options))
+                results.append(result)
+    finally:
+        if work_dir is None:
+            shutil.rmtree(root)
+    return results
+
+
+def benchmark_disk_order(path=None, file_count=2000, seed=0,
+                         with_drop_caches=False):
+    """
+    Hash every file of a tree in full with each diskorder.IO_ORDERS
+    - Expected value: list of {'io_order', 'seconds', 'mb_per_s',
+    'same_groups'} dictionaries, same_groups telling whether the groups
+    match the ones of the scan order
+    - Without with_drop_caches files are likely read from the page cache
+    and only the cost of planning the reads is measured
+    """
+    root = path or tempfile.mkdtemp(prefix='dff-benchmark-')
+    results = list()
+    try:
+        if path is None:
+            gdf.generate_files(file_count, directory_max_depth=4,
+                               file_min_size=64 * ONE_KB,
+                               file_max_size=ONE_MB, root_path=root,
+                               seed=seed)
+        records = list(walker.scan_records(root))
+        expected = None
+        for io_order in diskorder.IO_ORDERS:
+            if with_drop_caches:
+                drop_caches()
+            read_start = fileio.bytes_read()
+            start = time.perf_counter()
+            groups = fdf.group_files_by_checksum(records, io_order=io_order)
+            seconds = time.perf_counter() - start
+            groups = sorted(sorted(record.path for record in group)
+                            for group in groups)
+            expected = groups if expected is None else expected
+            results.append({'io_order': io_order,
+                            'seconds': round(seconds, 4),
+                            'mb_per_s': round((fileio.bytes_read()
+                                               - read_start) / ONE_MB
+                                              / seconds, 1),
+                            'same_groups': groups == expected})
+    finally:
+        if path is None:
+            shutil.rmtree(root)
+    return results
+
+
+def main():
+    """Main function operate program"""
+    ARGS = get_arguments()
+    if ARGS.command == 'io':
+        RESULT = benchmark_io(ARGS.size_mb, ARGS.repeat)
+    elif ARGS.command == 'hashes':
+        RESULT = hashers.benchmark_hashes(ARGS.size_mb * ONE_MB)
+    elif ARGS.command == 'suite':
+        RESULT = benchmark_suite(ARGS.scenarios.split(','), ARGS.seed,
+                                 ARGS.scale, ARGS.work_dir,
+                                 ARGS.drop_caches)
+    elif ARGS.command == 'disk-order':
+        RESULT = benchmark_disk_order(ARGS.path, ARGS.file_count, ARGS.seed,
+                                      ARGS.drop_caches)
+    elif ARGS.command == 'scan':
+        RESULT = benchmark_scan(ARGS.file_count, ARGS.latency_ms / 1000,
+                                [int(jobs) for jobs
+                                 in ARGS.scan_jobs.split(',')], ARGS.seed)
+    elif ARGS.command == 'server':
+        RESULT = benchmark_server(ARGS.file_count, ARGS.lookups,
+                                  [int(batch) for batch
+                                   in ARGS.batch.split(',')], ARGS.clients,
+                                  ARGS.seed)
+    elif ARGS.command == 'run':
+        RESULT = run_scan(ARGS.path, ARGS.bonus, ARGS.jobs,
+                          ARGS.compare_max_group)
+    print(json.dumps(RESULT, indent=4))
+
+
+if __name__ == '__main__':
+    main()
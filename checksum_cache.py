@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import os
+import sqlite3
+import threading
+
+
+DEFAULT_CACHE_NAME = '.duplicate_files_cache.sqlite'
+
+# Default maximum number of digests kept in the cache before the least
+# recently used ones are evicted.
+DEFAULT_MAX_ENTRIES = 1000000
+
+
+def default_cache_path(root_path):
+    """
+    Return the default location of the cache file for a scan root
+    - Expected value: hidden sqlite file next to the scanned files, or in
+    the parent directory when the scan root is a file
+    """
+    root_path = os.path.abspath(root_path)
+    if not os.path.isdir(root_path):
+        root_path = os.path.dirname(root_path)
+    return os.path.join(root_path, DEFAULT_CACHE_NAME)
+
+
+def record_key(record):
+    """
+    Return the identity of a file version as (dev, ino, size, mtime_ns)
+    - record: walker.FileRecord of the file
+    """
+    return (record.dev, record.ino, record.size, record.mtime)
+
+
+class ChecksumCache:
+    """
+    Persistent digest cache stored in a SQLite database.
+
+    A digest is stored per (st_dev, st_ino) and kind (e.g. 'md5:content'
+    or 'md5:1k') together with the st_size and st_mtime_ns it was computed
+    from. A lookup only hits when size and mtime are unchanged, so a file
+    modified since the last run is transparently re-hashed.
+
+    The connection belongs to the thread which opens the cache unless
+    check_same_thread is False, in which case the caller serializes every
+    access, e.g. with a lock.
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES,
+                 check_same_thread=True):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._clock = 0
+        self._touched = dict()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=check_same_thread)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS checksums ('
+            ' dev INTEGER, ino INTEGER, kind TEXT,'
+            ' size INTEGER, mtime_ns INTEGER, digest TEXT,'
+            ' used INTEGER,'
+            ' PRIMARY KEY (dev, ino, kind))')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS checksums_used ON checksums (used)')
+        row = self._connection.execute(
+            'SELECT MAX(used) FROM checksums').fetchone()
+        self._clock = (row[0] or 0) + 1
+
+    def get(self, key, kind):
+        """
+        Return the cached digest of a file, or None on a miss
+        - key: (dev, ino, size, mtime_ns) tuple, see record_key()
+        """
+        dev, ino, size, mtime_ns = key
+        row = self._connection.execute(
+            'SELECT digest FROM checksums WHERE dev = ? AND ino = ?'
+            ' AND kind = ? AND size = ? AND mtime_ns = ?',
+            (dev, ino, kind, size, mtime_ns)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched[(dev, ino, kind)] = self._clock
+        return row[0]
+
+    def put(self, key, kind, digest):
+        """Store the digest of a file, replacing any older version"""
+        dev, ino, size, mtime_ns = key
+        self._connection.execute(
+            'INSERT OR REPLACE INTO checksums'
+            ' (dev, ino, kind, size, mtime_ns, digest, used)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (dev, ino, kind, size, mtime_ns, digest, self._clock))
+        self.stores += 1
+
+    def clear(self):
+        """Invalidate every cached digest"""
+        self._connection.execute('DELETE FROM checksums')
+        self._connection.commit()
+
+    def __len__(self):
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM checksums').fetchone()[0]
+
+    def evict(self):
+        """
+        Drop the least recently used digests above max_entries
+        - Expected value: number of evicted entries
+        """
+        excess = len(self) - self.max_entries
+        if excess <= 0:
+            return 0
+        self._connection.execute(
+            'DELETE FROM checksums WHERE rowid IN'
+            ' (SELECT rowid FROM checksums ORDER BY used LIMIT ?)',
+            (excess,))
+        return excess
+
+    def flush(self):
+        """Record hits, apply eviction and commit to disk"""
+        self._connection.executemany(
+            'UPDATE checksums SET used = ?'
+            ' WHERE dev = ? AND ino = ? AND kind = ?',
+            [(used, dev, ino, kind)
+             for (dev, ino, kind), used in self._touched.items()])
+        self._touched.clear()
+        self.evict()
+        self._connection.commit()
+
+    def close(self):
+        """Flush pending changes and close the database"""
+        self.flush()
+        self._connection.close()
+
+    def report(self):
+        """Return a one-line summary of the hit/miss counters"""
+        return 'Checksum cache: %d hits, %d misses, %d stored (%s)' % (
+            self.hits, self.misses, self.stores, self.path)
+
+
+class MemoryCache:
+    """
+    In-memory digest cache with the get/put interface of ChecksumCache,
+    optionally backed by a fallback cache, e.g. a ChecksumCache, which is
+    consulted on a miss and receives every digest stored.
+
+    digests, the dictionary of (key, kind) to digest, may be shared with
+    another MemoryCache. Accesses to the fallback are serialized by lock,
+    so that threads can share a ChecksumCache opened with
+    check_same_thread=False.
+    """
+
+    def __init__(self, fallback=None, digests=None):
+        self.fallback = fallback
+        self.digests = digests if digests is not None else dict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, kind):
+        """Return the digest of a file version, or None, see ChecksumCache"""
+        digest = self.digests.get((key, kind))
+        if digest is None and self.fallback is not None:
+            with self.lock:
+                digest = self.fallback.get(key, kind)
+            if digest:
+                self.digests[(key, kind)] = digest
+        if digest is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return digest
+
+    def put(self, key, kind, digest):
+        """Record the digest of a file version, see ChecksumCache"""
+        self.digests[(key, kind)] = digest
+        if self.fallback is not None:
+            with self.lock:
+                self.fallback.put(key, kind, digest)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import hashlib
+from functools import partial
+import checksum_cache
+import fileio
+import hashers
+import walker
+import workers
+
+
+# Size groups with at most this many members are compared byte by byte
+# instead of being hashed, 0 disables the comparison engine.
+COMPARE_MAX_GROUP = 3
+
+# Number of bytes read from every member of a group at each step.
+BLOCK_SIZE = 256 * 1024
+
+
+def compare_files(file_path_names, block_size=BLOCK_SIZE, hash=hashlib.md5,
+                  keep=None):
+    """
+    Split files into classes of identical content by reading them in
+    lockstep, stopping as soon as a file differs from all the others
+    - file_path_names: paths or walker.FileRecords of the same size
+    - Expected value: list of (digest, items) for every class of at least 2
+    identical files, digest being the `hash` of their content, computed
+    once per class while streaming
+    - keep: optional callable on the items of a class, a class for which it
+    returns False is dropped as soon as it appears, without reading further
+    - Files which cannot be opened or read are left out
+    """
+    classes = [(list(), hash())]
+    finished = list()
+    try:
+        for item in file_path_names:
+            try:
+                fobj = open(walker.record_path(item), 'rb')
+                fileio.count('files_opened')
+                fileio.advise_sequential(fobj)
+                classes[0][0].append((item, fobj))
+            except OSError:
+                fileio.count('errors')
+                continue
+        while classes:
+            next_classes = list()
+            for members, hashobj in classes:
+                blocks = dict()
+                for item, fobj in members:
+                    try:
+                        block = fobj.read(block_size)
+                        fileio.count_bytes_read(len(block))
+                        fileio.throttle(len(block))
+                    except OSError:
+                        fileio.count('errors')
+                        fileio.close_file(fobj)
+                        continue
+                    blocks.setdefault(block, list()).append((item, fobj))
+                for block, same in blocks.items():
+                    if len(same) < 2 or keep is not None and \
+                            not keep([item for item, _ in same]):
+                        for _, fobj in same:
+                            fileio.close_file(fobj)
+                        continue
+                    same_hashobj = hashobj.copy()
+                    same_hashobj.update(block)
+                    if block:
+                        next_classes.append((same, same_hashobj))
+                        continue
+                    for _, fobj in same:
+                        fileio.close_file(fobj)
+                    finished.append((same_hashobj.hexdigest(),
+                                     [item for item, _ in same]))
+            classes = next_classes
+    finally:
+        for members, _ in classes:
+            for _, fobj in members:
+                fileio.close_file(fobj)
+    return finished
+
+
+def _compare_kept(group_keep, block_size=BLOCK_SIZE, hash=hashlib.md5):
+    """compare_files() of a (group, keep) pair, for a pool of workers"""
+    return compare_files(group_keep[0], block_size, hash, group_keep[1])
+
+
+def compare_groups(groups, cache=None, hash=hashlib.md5, jobs=1,
+                   use_processes=False, block_size=BLOCK_SIZE, keeps=None):
+    """
+    Run compare_files() on several groups of same-size files
+    - groups: lists of walker.FileRecords, one per distinct inode
+    - Expected value: one list of (digest, records) classes per group
+    - keeps: optional list of the keep callable of each group, see
+    compare_files(), picklable when use_processes
+    - A group whose digests are all in the cache is split without reading
+    any file, digests of confirmed duplicates are stored in the cache
+    - Groups are compared in parallel by `jobs` workers, see
+    workers.map_files()
+    """
+    keeps = keeps or [None] * len(groups)
+    kind = hashers.hash_name(hash) + ':content'
+    results = [None] * len(groups)
+    pending = list()
+    for index, group in enumerate(groups):
+        if cache is not None:
+            digests = [cache.get(checksum_cache.record_key(record), kind)
+                       for record in group]
+            if all(digests):
+                by_digest = dict()
+                for digest, record in zip(digests, group):
+                    by_digest.setdefault(digest, list()).append(record)
+                results[index] = [(digest, records)
+                                  for digest, records in by_digest.items()
+                                  if len(records) > 1 and (
+                                      keeps[index] is None
+                                      or keeps[index](records))]
+                continue
+        pending.append(index)
+    compared = workers.map_files(
+        partial(_compare_kept, block_size=block_size, hash=hash),
+        [(groups[index], keeps[index]) for index in pending],
+        jobs=jobs, use_processes=use_processes)
+    for index, (ok, classes) in zip(pending, compared):
+        results[index] = classes if ok else list()
+        if cache is not None:
+            for digest, records in results[index]:
+                for record in records:
+                    cache.put(checksum_cache.record_key(record), kind,
+                              digest)
+    return results
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import os
+import struct
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Orders in which files can be read, see order_records().
+IO_ORDERS = ('scan', 'inode', 'fiemap')
+
+# Linux ioctl returning the extents of a file (FS_IOC_FIEMAP).
+FS_IOC_FIEMAP = 0xC020660B
+
+# struct fiemap header, followed by one struct fiemap_extent.
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')
+_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+
+# Extent flags telling that its physical offset is not meaningful yet.
+_FIEMAP_EXTENT_UNKNOWN = 0x2
+_FIEMAP_EXTENT_DELALLOC = 0x4
+
+
+def physical_offset(file_path_name):
+    """
+    Return the physical offset on its device of the first extent of a file
+    - Expected value: offset in bytes, or None when the file system does not
+    support FIEMAP, the file is empty or its blocks are not allocated yet
+    """
+    if fcntl is None:
+        return None
+    buffer = bytearray(_FIEMAP_HEADER.size + _FIEMAP_EXTENT.size)
+    _FIEMAP_HEADER.pack_into(buffer, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+    try:
+        fd = os.open(file_path_name, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buffer, True)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    if not _FIEMAP_HEADER.unpack_from(buffer)[3]:
+        return None
+    extent = _FIEMAP_EXTENT.unpack_from(buffer, _FIEMAP_HEADER.size)
+    if extent[5] & (_FIEMAP_EXTENT_UNKNOWN | _FIEMAP_EXTENT_DELALLOC):
+        return None
+    return extent[1]
+
+
+def device_batches(records):
+    """
+    Split walker.FileRecords by device, in order of first appearance
+    - Expected value: list of lists of indexes in records, one per st_dev
+    """
+    batches = dict()
+    for index, record in enumerate(records):
+        batches.setdefault(record.dev, list()).append(index)
+    return list(batches.values())
+
+
+def order_batch(records, batch, io_order='inode'):
+    """
+    Sort indexes of walker.FileRecords of one device in the order to read
+    them
+    - io_order 'inode': by inode number, which most file systems allocate
+    close to the data of the file
+    - io_order 'fiemap': by physical offset of the first extent, files
+    without a known offset come last, by inode number
+    """
+    if io_order == 'fiemap':
+        keys = dict()
+        for index in batch:
+            offset = physical_offset(records[index].path)
+            keys[index] = (0, offset) if offset is not None \
+                else (1, records[index].ino)
+        return sorted(batch, key=keys.get)
+    return sorted(batch, key=lambda index: records[index].ino)
+
+
+def read_batches(records, io_order='scan'):
+    """
+    Plan the reads of a list of walker.FileRecords
+    - Expected value: list of lists of indexes in records, one list per
+    device, each sorted in the order to read the files, see order_batch()
+    - io_order 'scan' keeps every index in one batch, in order
+    - Raise ValueError on unknown io_order
+    """
+    if io_order not in IO_ORDERS:
+        raise ValueError('Unknown I/O order: ' + io_order)
+    if io_order == 'scan':
+        return [list(range(len(records)))] if records else list()
+    return [order_batch(records, batch, io_order)
+            for batch in device_batches(records)]
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+import hashlib
+import heapq
+import marshal
+import os
+import shutil
+import tempfile
+import another
+import stats
+import walker
+
+
+# Estimated memory taken by one entry waiting to be sorted, with its tuple.
+ENTRY_MEMORY = 256
+
+# Memory used for sorting when --max-memory gives no value.
+DEFAULT_MAX_MEMORY = 256 * 1024 * 1024
+
+# Largest number of runs merged at once, more runs are merged in passes.
+MERGE_FAN_IN = 64
+
+# Number of files of a size group hashed together.
+BATCH_FILES = 1024
+
+MEMORY_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_memory(text):
+    """
+    Parse a number of bytes with an optional K, M or G suffix, e.g. 512M
+    Raise ValueError if it is not a positive number
+    """
+    text = text.strip().upper()
+    unit = MEMORY_UNITS.get(text[-1:])
+    value = int(text[:-1] if unit else text) * (unit or 1)
+    if value <= 0:
+        raise ValueError('Invalid memory size: ' + text)
+    return value
+
+
+class ExternalSorter:
+    """
+    Sort tuples with bounded memory
+    Tuples are kept in memory up to max_entries, then sorted and spilled to
+    a run file of work_dir with marshal. Iterating the sorter merges the
+    runs, MERGE_FAN_IN at a time.
+    """
+
+    def __init__(self, work_dir, max_entries):
+        self.work_dir = work_dir
+        self.max_entries = max_entries
+        self.items = list()
+        self.runs = list()
+
+    def add(self, item):
+        """Add a tuple, spilling a run when memory is full"""
+        self.items.append(item)
+        if len(self.items) >= self.max_entries:
+            self.items.sort()
+            self.runs.append(self.write_run(self.items))
+            self.items = list()
+
+    def write_run(self, items):
+        """Write sorted tuples to a new run file and return its path"""
+        fd, path = tempfile.mkstemp(suffix='.run', dir=self.work_dir)
+        with os.fdopen(fd, 'wb') as fobj:
+            for item in items:
+                marshal.dump(item, fobj)
+        return path
+
+    @staticmethod
+    def read_run(path):
+        """Generator reading the tuples of a run file"""
+        with open(path, 'rb') as fobj:
+            while True:
+                try:
+                    yield marshal.load(fobj)
+                except EOFError:
+                    return
+
+    def __iter__(self):
+        self.items.sort()
+        while len(self.runs) >= MERGE_FAN_IN:
+            runs, self.runs = self.runs, list()
+            for start in range(0, len(runs), MERGE_FAN_IN):
+                merged = runs[start:start + MERGE_FAN_IN]
+                self.runs.append(self.write_run(heapq.merge(
+                    *[self.read_run(path) for path in merged])))
+                for path in merged:
+                    os.remove(path)
+        return heapq.merge(self.items,
+                           *[self.read_run(path) for path in self.runs])
+
+
+class PathStore:
+    """
+    Paths spilled to a file of work_dir, identified by their offset in it
+    Offsets grow in the order paths are added
+    """
+
+    def __init__(self, work_dir):
+        self.fobj = open(os.path.join(work_dir, 'paths'), 'w+b')
+        self.end = 0
+
+    def add(self, path):
+        """Store a path and return its id"""
+        data = os.fsencode(path)
+        path_id = self.end
+        self.fobj.seek(path_id)
+        self.fobj.write(len(data).to_bytes(4, 'little') + data)
+        self.end += 4 + len(data)
+        return path_id
+
+    def get(self, path_id):
+        """Return the path of an id"""
+        self.fobj.seek(path_id)
+        length = int.from_bytes(self.fobj.read(4), 'little')
+        return os.fsdecode(self.fobj.read(length))
+
+    def close(self):
+        self.fobj.close()
+
+
+def size_chunks(entries, batch_files=BATCH_FILES):
+    """
+    Generator cutting size-sorted entries into chunks of one size
+    - Expected value: lists of at most batch_files entries, from sizes
+    shared by at least 2 entries
+    """
+    chunk = list()
+    current = None
+    flushed = False
+    for entry in entries:
+        if entry[0] != current:
+            if chunk and (flushed or len(chunk) > 1):
+                yield chunk
+            chunk = list()
+            current = entry[0]
+            flushed = False
+        chunk.append(entry)
+        if len(chunk) >= batch_files:
+            yield chunk
+            chunk = list()
+            flushed = True
+    if chunk and (flushed or len(chunk) > 1):
+        yield chunk
+
+
+def iter_duplicates(file_path_names, hash=hashlib.md5, cache=None, jobs=1,
+                    use_processes=False, io_order='scan',
+                    max_memory=DEFAULT_MAX_MEMORY, work_dir=None,
+                    stages=None, prefilter_hash=None,
+                    batch_files=BATCH_FILES, scan_stats=None):
+    """
+    Generator finding duplicates with bounded memory
+    - Expected value: walker.DuplicateGroup of every group of duplicates,
+    with its paths in scan order
+    - file_path_names: paths or walker.FileRecords, read lazily
+    - The scan spills (size, dev, inode, mtime, path id) entries into sorted
+    runs under work_dir, paths themselves go to a path file. Size groups
+    come from an external merge of these runs; their files are hashed
+    batch_files at a time and (size, key, dev, inode, path id) entries
+    spilled again, and groups of the same key come from a second merge.
+    Sorting holds about max_memory bytes of entries.
+    - stages None gives the groups of find_duplicate_files(): files of at
+    least one byte with the same content hash. Otherwise the groups of
+    another.check_duplicates() with these stages: empty files included,
+    keyed by the hash of the content stage or, without it, by the hashes
+    of every stage after size.
+    """
+    max_entries = max(2, max_memory // ENTRY_MEMORY)
+    min_size = 1 if stages is None else 0
+    if stages is None or 'content' in another.parse_stages(stages):
+        key_stages = ['content']
+    else:
+        key_stages = [stage for stage in another.parse_stages(stages)
+                      if stage != 'size']
+    temp_dir = tempfile.mkdtemp(prefix='dff-external-', dir=work_dir)
+    paths = PathStore(temp_dir)
+    try:
+        by_size = ExternalSorter(temp_dir, max_entries)
+        for record in stats.iter_stage(scan_stats, 'scan',
+                                       walker.to_records(file_path_names)):
+            if record.size >= min_size:
+                by_size.add((record.size, record.dev, record.ino,
+                             record.mtime, paths.add(record.path)))
+
+        by_key = ExternalSorter(temp_dir, max_entries)
+        for chunk in size_chunks(by_size, batch_files):
+            with stats.stage(scan_stats, 'content', len(chunk)) as measures:
+                path_ids = dict()
+                for size, dev, ino, mtime, path_id in chunk:
+                    path_ids[walker.FileRecord(paths.get(path_id), size, dev,
+                                               ino, mtime)] = path_id
+                records, links = walker.collapse_hardlinks(path_ids)
+                keys = [list() for _ in records]
+                for stage in key_stages:
+                    hashes = another.get_hashes(
+                        records, stage=stage, cache=cache, jobs=jobs,
+                        use_processes=use_processes,
+                        hash=hash if stage == 'content'
+                        else prefilter_hash or hash,
+                        io_order=io_order if stage == 'content' else 'scan')
+                    for key, (ok, hashed) in zip(keys, hashes):
+                        key.append(hashed if ok else None)
+                for record, key in zip(records, keys):
+                    if None in key:
+                        continue
+                    for link in links[walker.inode_key(record)]:
+                        by_key.add((record.size, tuple(key), record.dev,
+                                    record.ino, path_ids[link]))
+                        measures.files_out += 1
+
+        group = list()
+        for entry in by_key:
+            if group and entry[:2] != group[0][:2]:
+                yield from duplicate_groups(group, paths)
+                group = list()
+            group.append(entry)
+        yield from duplicate_groups(group, paths)
+    finally:
+        paths.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def duplicate_groups(group, paths):
+    """
+    Return [walker.DuplicateGroup] of (size, key, dev, inode, path id)
+    entries sharing a key, or [] if they are all links of one inode
+    """
+    if len(set(entry[2:4] for entry in group)) < 2:
+        return list()
+    return [walker.DuplicateGroup(
+        group[0][0], group[0][1][-1],
+        [paths.get(path_id) for path_id in sorted(
+            entry[4] for entry in group)])]
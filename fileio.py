@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+import errno
+import mmap
+import os
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Smallest and largest read sizes picked by block_size_for().
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+
+# Regular files at least this large are hashed through mmap.
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+_buffers = threading.local()
+_counter_lock = threading.Lock()
+_counters = {'bytes_read': 0, 'files_opened': 0, 'errors': 0,
+             'throttled_seconds': 0.0}
+
+# Read policy of this process, see configure().
+_policy = {'bucket': None, 'drop_cache': False, 'direct_min_size': None}
+
+
+class DirectIOUnsupported(OSError):
+    """The file system of a file refuses O_DIRECT reads"""
+
+
+class TokenBucket:
+    """
+    Limit the reads of every thread of this process to rate bytes per
+    second on average, with bursts of at most burst bytes
+    - A read larger than the tokens left is still allowed, the debt is
+    paid by sleeping, so that the next readers wait for it too
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(MAX_BLOCK_SIZE, rate // 10)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Take amount tokens, sleeping until they are refilled if needed
+        - Expected value: number of seconds slept
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens
+                              + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def configure(max_read_rate=None, drop_cache=False, direct_min_size=None):
+    """
+    Set how this process reads the files it hashes or compares, so that a
+    scan can run next to a live workload
+    - max_read_rate: bytes per second shared by every thread, see
+    TokenBucket; None does not limit reads. Worker processes forked
+    afterwards each get their own budget of the same rate
+    - drop_cache: advise the kernel that files are read sequentially, and
+    drop their pages from the page cache once read, so that hashing does
+    not evict the pages other processes use; pages of these files cached
+    before the scan are dropped too
+    - direct_min_size: read regular files of at least this size with
+    O_DIRECT, bypassing the page cache, where the file system supports it
+    - Calling it again replaces the previous policy
+    """
+    _policy['bucket'] = TokenBucket(max_read_rate) if max_read_rate else None
+    _policy['drop_cache'] = drop_cache
+    _policy['direct_min_size'] = direct_min_size
+
+
+def max_read_rate():
+    """Return the read budget in bytes per second, None if unlimited"""
+    bucket = _policy['bucket']
+    return None if bucket is None else bucket.rate
+
+
+def throttle(amount):
+    """
+    Charge amount bytes read to the read budget, sleeping if it is spent
+    - The time slept is counted in throttled_seconds
+    """
+    bucket = _policy['bucket']
+    if bucket is not None and amount:
+        waited = bucket.consume(amount)
+        if waited:
+            count('throttled_seconds', waited)
+
+
+def _advise(fobj, advice):
+    if _policy['drop_cache'] and hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fobj.fileno(), 0, 0, advice)
+        except (OSError, ValueError):
+            pass
+
+
+def advise_sequential(fobj):
+    """Tell the kernel an open file is read sequentially, with drop_cache"""
+    _advise(fobj, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+
+
+def drop_cache(fobj):
+    """Drop the cached pages of an open file, with drop_cache"""
+    _advise(fobj, getattr(os, 'POSIX_FADV_DONTNEED', 0))
+
+
+def close_file(fobj):
+    """Close a file after drop_cache()"""
+    drop_cache(fobj)
+    fobj.close()
+
+
+@contextmanager
+def open_file(file_path_name, sequential=True):
+    """
+    Context manager opening a file for hashing, unbuffered, counted in
+    files_opened
+    - Its pages are dropped from the page cache when it is closed, and it
+    is read ahead when sequential, following the policy of configure()
+    """
+    with open(file_path_name, 'rb', buffering=0) as fobj:
+        count('files_opened')
+        if sequential:
+            advise_sequential(fobj)
+        try:
+            yield fobj
+        finally:
+            drop_cache(fobj)
+
+
+def count(name, value=1):
+    """
+    Add value to one of the I/O counters of this process: bytes_read,
+    files_opened, errors or throttled_seconds
+    - Work done in the workers of a process pool is not counted
+    """
+    with _counter_lock:
+        _counters[name] += value
+
+
+def count_bytes_read(value):
+    """Add value to the number of bytes read by this process"""
+    count('bytes_read', value)
+
+
+def bytes_read():
+    """Return the number of file bytes read or hashed by this process"""
+    return _counters['bytes_read']
+
+
+def counters():
+    """Return a copy of the I/O counters of this process, see count()"""
+    with _counter_lock:
+        return dict(_counters)
+
+
+def block_size_for(stat):
+    """
+    Return the read size to use for a file
+    - A multiple of the preferred I/O size of the file system (st_blksize),
+    between MIN_BLOCK_SIZE and MAX_BLOCK_SIZE, and no larger than needed
+    for small files
+    """
+    preferred = getattr(stat, 'st_blksize', 0) or 4096
+    size = min(max(stat.st_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+    return max(preferred, size // preferred * preferred)
+
+
+def get_buffer(size):
+    """
+    Return a memoryview of at least size bytes reused by the calling thread
+    """
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+        _buffers.buffer = buffer
+    return memoryview(buffer)
+
+
+def update_from_file(fobj, hashobj, length=None, block_size=MIN_BLOCK_SIZE):
+    """
+    Feed hashobj with the next length bytes of an open binary file, or up
+    to the end of the file when length is None
+    - Bytes are read with readinto into a per-thread buffer, no bytes object
+    is created per block
+    - Expected value: number of bytes read
+    """
+    view = get_buffer(block_size)[:block_size]
+    total = 0
+    while length is None or total < length:
+        if length is not None and length - total < block_size:
+            view = view[:length - total]
+        count = fobj.readinto(view)
+        if not count:
+            break
+        hashobj.update(view[:count])
+        total += count
+        throttle(count)
+    count_bytes_read(total)
+    return total
+
+
+def update_from_mmap(fobj, hashobj, size, block_size=MAX_BLOCK_SIZE):
+    """
+    Feed hashobj with the first size bytes of an open file mapped in memory
+    - Expected value: number of bytes hashed
+    """
+    with mmap.mmap(fobj.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            for offset in range(0, size, block_size):
+                hashobj.update(view[offset:offset + block_size])
+                throttle(min(block_size, size - offset))
+        finally:
+            view.release()
+    count_bytes_read(size)
+    return size
+
+
+def update_direct(fobj, hashobj, block_size=MAX_BLOCK_SIZE):
+    """
+    Feed hashobj with the full content of an open file read with O_DIRECT,
+    bypassing the page cache
+    - The buffer is an anonymous mmap, aligned on a page as O_DIRECT
+    requires, and block_size a multiple of the page size
+    - Raise DirectIOUnsupported, before anything is hashed, when the file
+    system refuses O_DIRECT
+    - Expected value: number of bytes read
+    """
+    if fcntl is None or not hasattr(os, 'O_DIRECT'):
+        raise DirectIOUnsupported(errno.EINVAL, 'O_DIRECT is not available')
+    fd = fobj.fileno()
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_DIRECT)
+    except OSError as error:
+        raise DirectIOUnsupported(error.errno, str(error))
+    total = 0
+    try:
+        with mmap.mmap(-1, block_size) as buffer:
+            view = memoryview(buffer)
+            try:
+                while True:
+                    try:
+                        count = os.readv(fd, [buffer])
+                    except OSError as error:
+                        if total == 0 and error.errno == errno.EINVAL:
+                            raise DirectIOUnsupported(error.errno,
+                                                      str(error))
+                        raise
+                    if not count:
+                        break
+                    hashobj.update(view[:count])
+                    total += count
+                    throttle(count)
+            finally:
+                view.release()
+    finally:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+    count_bytes_read(total)
+    return total
+
+
+def hash_open_file(fobj, hashobj):
+    """
+    Feed hashobj with the rest of an open binary file
+    - Large regular files are mapped with mmap, other files are read with
+    readinto and a block size derived from st_blksize and the file size
+    - Regular files of at least direct_min_size are read with O_DIRECT
+    instead, see configure(), falling back to the above when unsupported
+    - Expected value: number of bytes read
+    """
+    stat = os.fstat(fobj.fileno())
+    offset = fobj.tell()
+    direct_min_size = _policy['direct_min_size']
+    if offset == 0 and direct_min_size is not None \
+            and stat.st_size >= direct_min_size:
+        try:
+            return update_direct(fobj, hashobj)
+        except DirectIOUnsupported:
+            fobj.seek(0)
+    if offset == 0 and stat.st_size >= MMAP_THRESHOLD:
+        try:
+            return update_from_mmap(fobj, hashobj, stat.st_size)
+        except (OSError, ValueError):
+            fobj.seek(0)
+    return update_from_file(fobj, hashobj, block_size=block_size_for(stat))
+
+
+def hash_file(file_path_name, hashobj):
+    """
+    Feed hashobj with the full content of a file, see hash_open_file()
+    - Raise OSError if the file cannot be read
+    """
+    with open_file(file_path_name) as fobj:
+        return hash_open_file(fobj, hashobj)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import os
+from array import array
+import walker
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class FileTable:
+    """
+    Compact table of scanned files
+    Instead of one path string and one FileRecord per file, the table keeps
+    every directory path once, the file names encoded back to back in one
+    bytearray, and the directory, size, dev, inode and mtime of the files in
+    parallel arrays of machine integers. Paths and walker.FileRecords are
+    only built for the files asked for, see record().
+    Iterating a table yields the FileRecord of every file.
+    """
+
+    def __init__(self):
+        self.dirs = list()
+        self.dir_ids = dict()
+        self.names = bytearray()
+        self.name_ends = array('Q')
+        self.dir_of = array('I')
+        self.sizes = array('q')
+        self.devs = array('Q')
+        self.inos = array('Q')
+        self.mtimes = array('q')
+
+    @classmethod
+    def from_records(cls, items):
+        """
+        Return the table of paths or walker.FileRecords, paths which cannot
+        be stat'ed are skipped
+        """
+        table = cls()
+        for record in walker.to_records(items):
+            table.add_record(record)
+        return table
+
+    def append(self, dir_path, name, size, dev, ino, mtime):
+        """Append a file from its directory, name and stat fields"""
+        dir_id = self.dir_ids.get(dir_path)
+        if dir_id is None:
+            dir_id = self.dir_ids[dir_path] = len(self.dirs)
+            self.dirs.append(dir_path)
+        self.names += os.fsencode(name)
+        self.name_ends.append(len(self.names))
+        self.dir_of.append(dir_id)
+        self.sizes.append(size)
+        self.devs.append(dev)
+        self.inos.append(ino)
+        self.mtimes.append(mtime)
+
+    def add(self, dir_path, name, stat):
+        """Append a file from its directory, name and os.stat result"""
+        self.append(dir_path, name, stat.st_size, stat.st_dev, stat.st_ino,
+                    stat.st_mtime_ns)
+
+    def add_record(self, record):
+        """Append a walker.FileRecord"""
+        dir_path, name = os.path.split(record.path)
+        self.append(dir_path, name, record.size, record.dev, record.ino,
+                    record.mtime)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.record(index)
+
+    def path(self, index):
+        """Return the path of a file"""
+        start = self.name_ends[index - 1] if index else 0
+        name = bytes(self.names[start:self.name_ends[index]])
+        return os.path.join(self.dirs[self.dir_of[index]], os.fsdecode(name))
+
+    def record(self, index):
+        """Return the walker.FileRecord of a file"""
+        return walker.FileRecord(self.path(index), self.sizes[index],
+                                 self.devs[index], self.inos[index],
+                                 self.mtimes[index])
+
+    def records(self, indexes):
+        """Return the walker.FileRecords of several files"""
+        return [self.record(index) for index in indexes]
+
+    def size_groups(self, min_size=1):
+        """
+        Group the files by size with a sort of the size array instead of a
+        dictionary of lists, using NumPy when it is installed
+        - Expected value: list of lists of indexes of at least 2 files of
+        the same size, at least min_size bytes, by increasing size; indexes
+        of a group are in scan order
+        """
+        if numpy is not None:
+            return self._numpy_size_groups(min_size)
+        order = sorted(range(len(self)), key=self.sizes.__getitem__)
+        groups = list()
+        start = 0
+        for end in range(1, len(order) + 1):
+            if end < len(order) and \
+                    self.sizes[order[end]] == self.sizes[order[start]]:
+                continue
+            if end - start > 1 and self.sizes[order[start]] >= min_size:
+                groups.append(order[start:end])
+            start = end
+        return groups
+
+    def _numpy_size_groups(self, min_size):
+        """NumPy version of size_groups()"""
+        if not len(self):
+            return list()
+        sizes = numpy.frombuffer(self.sizes, dtype=numpy.int64)
+        order = numpy.argsort(sizes, kind='stable')
+        sorted_sizes = sizes[order]
+        bounds = numpy.concatenate((
+            [0], numpy.flatnonzero(numpy.diff(sorted_sizes)) + 1,
+            [len(sizes)]))
+        return [order[start:end].tolist()
+                for start, end in zip(bounds[:-1].tolist(),
+                                      bounds[1:].tolist())
+                if end - start > 1 and sorted_sizes[start] >= min_size]
+
+
+def scan_table(path, show_hidden=False, jobs=1, ordered=True):
+    """
+    Walk a directory tree into a FileTable, see walker.scan_entries()
+    - No path string is built for the files
+    """
+    table = FileTable()
+    for dir_path, name, stat in walker.scan_entries(path, show_hidden, jobs,
+                                                    ordered):
+        table.add(dir_path, name, stat)
+    return table
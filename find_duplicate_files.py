@@ -2,10 +2,29 @@
 import argparse
 import os
 import sys
-import datetime
 import hashlib
+import itertools
 import json
 import another
+import checksum_cache
+import compare
+import diskorder
+import external
+import fileio
+import filetable
+import hashers
+import logs
+import snapshot
+import stats
+import walker
+import workers
+from functools import partial
+
+
+logger = logs.get_logger('find_duplicate_files')
+
+# Number of files confirmed together when streaming duplicate groups.
+BATCH_FILES = 1024
 
 
 def get_arguments():
@@ -14,10 +33,43 @@ def get_arguments():
     Choose path with -p/--path option
     Choose show hidden or not with -s/--hidden option
     Choose different algorithm with -b/--bonus option
-    - Expected value: ArgumentParser Object with 3 attribute:
+    Reuse digests of unchanged files with -c/--cache option
+    - Expected value: ArgumentParser Object with attributes:
         - parser.path
         - parser.hidden
         - parser.bonus
+        - parser.cache
+        - parser.cache_max_entries
+        - parser.clear_cache
+        - parser.jobs
+        - parser.processes
+        - parser.hardlinks
+        - parser.compare_max_group
+        - parser.stages
+        - parser.stage_report
+        - parser.hash
+        - parser.prefilter_hash
+        - parser.benchmark_hashes
+        - parser.output
+        - parser.snapshot
+        - parser.stats
+        - parser.io_order
+        - parser.max_memory
+        - parser.spill_dir
+        - parser.scan_jobs
+        - parser.ordered_scan
+        - parser.log_file
+        - parser.log_level
+        - parser.log_max_bytes
+        - parser.log_backups
+        - parser.log_sample
+        - parser.approximate
+        - parser.verify
+        - parser.select
+        - parser.reference
+        - parser.max_read_rate
+        - parser.drop_cache
+        - parser.direct_io
     """
     parser = argparse.ArgumentParser(description='Ahahehihohu')
     parser.add_argument('-p', '--path', type=str,
@@ -27,27 +79,173 @@ def get_arguments():
                         help='Show hidden files')
     parser.add_argument('-b', '--bonus', action='store_true',
                         help='Bonus: Using a better method')
-    return parser.parse_args()
+    parser.add_argument('-c', '--cache', type=str, nargs='?', const='',
+                        default=None, metavar='CACHE_FILE',
+                        help='Persistent checksum cache, stored next to \
+                              the scan root unless a file is given')
+    parser.add_argument('--cache-max-entries', type=int,
+                        default=checksum_cache.DEFAULT_MAX_ENTRIES,
+                        help='Maximum number of digests kept in the cache')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='Invalidate the checksum cache before scanning')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of workers hashing files in parallel \
+                              (0: one per CPU)')
+    parser.add_argument('--processes', action='store_true',
+                        help='Hash with a process pool instead of threads')
+    parser.add_argument('--compare-max-group', type=int,
+                        default=compare.COMPARE_MAX_GROUP,
+                        help='Compare same-size groups up to this many \
+                              files byte by byte instead of hashing them \
+                              (0: always hash)')
+    parser.add_argument('--stages', type=another.parse_stages,
+                        default=another.DEFAULT_STAGES,
+                        help='Bonus: comma-separated grouping stages among \
+                              size, head:N, tail:N, sample:K and content \
+                              (default: size,1k,content)')
+    parser.add_argument('--stage-report', action='store_true',
+                        help='Bonus: print the number of files eliminated \
+                              by each stage to standard error')
+    parser.add_argument('--hash', type=hashers.get_hash_factory,
+                        default=hashers.get_hash_factory('md5'),
+                        help='Hash confirming duplicates, one of %s or \
+                              blake2b-N for an N bytes digest \
+                              (default: md5)'
+                        % ', '.join(hashers.available_hashes()))
+    parser.add_argument('--prefilter-hash', type=hashers.get_hash_factory,
+                        default=hashers.default_prefilter_hash(),
+                        help='Bonus: cheaper hash used by the head, tail \
+                              and sample stages (default: xxh3_64 when \
+                              xxhash is installed, crc32 otherwise; here %s)'
+                        % hashers.default_prefilter_hash().name)
+    parser.add_argument('--benchmark-hashes', action='store_true',
+                        help='Rank the available hashes by throughput on \
+                              this machine and exit')
+    parser.add_argument('-o', '--output', choices=('json', 'ndjson'),
+                        default='json',
+                        help='json: one list printed at the end, ndjson: \
+                              one line per group with its size and digest \
+                              printed as soon as it is confirmed')
+    parser.add_argument('--snapshot', type=str, metavar='SNAPSHOT_FILE',
+                        help='Rescan incrementally: directories whose mtime \
+                              did not change since the snapshot are not \
+                              listed again and known digests are reused, \
+                              the snapshot is updated at the end')
+    parser.add_argument('-l', '--hardlinks', action='store_true',
+                        help='Report sets of hardlinks, which already \
+                              share their content on disk, separately: \
+                              duplicate groups hold one path per inode')
+    parser.add_argument('--stats', choices=('table', 'json'), nargs='?',
+                        const='table', default=None,
+                        help='Print the time, files, bytes read and errors \
+                              of each stage to standard error')
+    parser.add_argument('--io-order', choices=diskorder.IO_ORDERS,
+                        default='scan',
+                        help='Order of the files hashed in full: scan \
+                              order, inode number, or physical location \
+                              from FIEMAP falling back to inode number; \
+                              inode and fiemap also read one device at a \
+                              time, which saves seeks on spinning disks')
+    parser.add_argument('--max-memory', type=external.parse_memory,
+                        metavar='SIZE',
+                        help='Out-of-core mode for trees larger than RAM: \
+                              spill the scan and the digests to sorted runs \
+                              on disk and group them by external merge, \
+                              using about SIZE bytes (e.g. 512M) to sort')
+    parser.add_argument('--spill-dir', type=str, default=None,
+                        help='Directory of the runs of --max-memory \
+                              (default: the temporary directory)')
+    parser.add_argument('--scan-jobs', type=int, default=1,
+                        help='Number of threads listing directories \
+                              concurrently, which hides the latency of \
+                              network and FUSE file systems (e.g. 16)')
+    parser.add_argument('--ordered-scan', action='store_true',
+                        help='With --scan-jobs, still return files in the \
+                              order of a single-threaded walk')
+    parser.add_argument('--log-file', type=str, default=None,
+                        help='Write JSON log records to this file, rotated \
+                              by size (default: no log)')
+    parser.add_argument('--log-level', choices=logs.LEVELS, default=None,
+                        help='Level of the records written, debug adds one \
+                              record per duplicate group (default: info; \
+                              without --log-file, records go to standard \
+                              error)')
+    parser.add_argument('--log-max-bytes', type=external.parse_memory,
+                        default=logs.DEFAULT_MAX_BYTES, metavar='SIZE',
+                        help='Rotate the log file at this size (e.g. 10M)')
+    parser.add_argument('--log-backups', type=int,
+                        default=logs.DEFAULT_BACKUP_COUNT,
+                        help='Number of rotated log files kept')
+    parser.add_argument('--log-sample', type=int, default=1, metavar='N',
+                        help='Keep one per-group debug record in N')
+    parser.add_argument('--approximate', type=int, nargs='?',
+                        const=another.APPROXIMATE_BLOCKS, default=None,
+                        metavar='BLOCKS',
+                        help='Fast triage: group files by size and BLOCKS \
+                              blocks read at fixed offsets from head to \
+                              tail (default: %d), so that bytes read per \
+                              file do not grow with its size; groups are \
+                              reported as unverified'
+                        % another.APPROXIMATE_BLOCKS)
+    parser.add_argument('--verify', type=str, metavar='GROUPS_FILE',
+                        help='Fully verify groups printed by \
+                              --approximate, in json or ndjson, and print \
+                              the confirmed duplicates')
+    parser.add_argument('--select', type=str, default=None,
+                        metavar='INDEXES',
+                        help='With --verify, comma-separated 0-based \
+                              numbers of the groups to verify (default: \
+                              all)')
+    parser.add_argument('--reference', type=str, action='append',
+                        metavar='PATH',
+                        help='Only report the files of --path whose \
+                              content already exists under PATH, which \
+                              may be given several times; reference files \
+                              are only read when a file of --path has their \
+                              size')
+    parser.add_argument('--max-read-rate', type=external.parse_memory,
+                        default=None, metavar='RATE',
+                        help='Read at most RATE bytes per second on \
+                              average (e.g. 50M) while hashing and \
+                              comparing, shared by every thread; with \
+                              --processes, each worker gets RATE / jobs')
+    parser.add_argument('--drop-cache', action='store_true',
+                        help='Advise the kernel that files are read \
+                              sequentially and drop them from the page \
+                              cache once read, so that the scan does not \
+                              evict the cache of other processes')
+    parser.add_argument('--direct-io', type=external.parse_memory,
+                        nargs='?', const=fileio.MMAP_THRESHOLD,
+                        default=None, metavar='MIN_SIZE',
+                        help='Hash files of at least MIN_SIZE bytes \
+                              (default: %dM) with O_DIRECT, bypassing the \
+                              page cache, where the file system supports it'
+                        % (fileio.MMAP_THRESHOLD // (1024 * 1024)))
+    ARGS = parser.parse_args()
+    if ARGS.approximate is not None and ARGS.approximate < 1:
+        parser.error('--approximate needs at least one block')
+    if ARGS.max_memory and ARGS.reference:
+        parser.error('--reference cannot be combined with --max-memory')
+    if ARGS.max_memory and ARGS.hardlinks:
+        parser.error('--hardlinks cannot be combined with --max-memory')
+    return ARGS
 
 
 def valid_path(path):
     """
     Return True if exist path
     Exit program when path does not exist
-    Write to error.log
     - Expected value: True
-    - If path is unvalid or unable access with read method, write to
-    error message to error.log and standard error, then exit program
-    with exit code 1.
+    - If path is unvalid or unable access with read method, write an
+    error message to standard error and an error record to the log, see
+    logs.configure(), then exit program with exit code 1.
     """
     if os.path.exists(path) and os.access(path, os.R_OK):
         return True
     else:
         error_mes = ": ".join([str(os.path.basename(sys.argv[0])),
                               "valid_path", path, "Invalid path.\n"])
-        with open('error.log', 'a+') as fd:
-            fd.write("Time: " + str(datetime.datetime.now()) + "\n")
-            fd.write(error_mes + "\n\n")
+        logger.error('invalid path', extra=logs.fields(path=path))
         sys.stderr.write(error_mes)
         sys.exit(1)
 
@@ -61,50 +259,56 @@ def file_valid(filename):
     return os.access(filename, os.R_OK)
 
 
-def scan_files(path, show_hidden=False):
+def scan_files(path, show_hidden=False, scan_stats=None):
     """
     Return list of files with full path
     - Expected value: list of files with full path
     - Return empty list if directory or files in directory unable to access
+    - Use walker.scan_records() to also get the size and inode of each
+    file without stat'ing it again
+    - scan_stats: optional stats.ScanStats measuring the 'scan' stage
     """
-    LIST_OF_FILES = list()
-    for (dir_path, dir_names, file_names) in os.walk(path):
-        if not show_hidden:
-            file_names = [f for f in file_names if not f[0] == '.']
-            dir_names[:] = [d for d in dir_names if not d[0] == '.']
-        for file_name in file_names:
-            file_path = os.path.join(dir_path, file_name)
-            try:
-                if file_valid(file_path) and not os.path.islink(file_path):
-                    full_path = os.path.realpath(file_path)
-                    LIST_OF_FILES += [full_path]
-            except OSError:
-                continue
-    return LIST_OF_FILES
+    return [record.path for record in stats.iter_stage(
+        scan_stats, 'scan', walker.scan_records(path, show_hidden))]
 
 
-def group_files_by_size(file_path_names):
+def group_files_by_size(file_path_names, scan_stats=None):
     """
     Simple function group file by size
     - Expected value: list contain groups of files with the same size
     - Return empty list if unable to find group of files with the same size
     or group os files with size 0
+    - file_path_names: paths or walker.FileRecords, groups hold the same
+    items; records are grouped without any stat call
+    - file_path_names may also be a filetable.FileTable, grouped by sorting
+    its size array, groups then hold the walker.FileRecords of the files
+    of size groups only
+    - scan_stats: optional stats.ScanStats measuring the 'size' stage
     """
     RESULT_GROUP = list()
     GROUP_BY_SIZE = dict()
-    for _file in file_path_names:
-        stat = os.stat(_file)
-        key = str(stat.st_size)
-        if stat.st_size == 0:
-            continue
-        try:
-            GROUP_BY_SIZE[key].append(_file)
-        except KeyError:
-            GROUP_BY_SIZE[key] = list()
-            GROUP_BY_SIZE[key].append(_file)
-    for _, values in GROUP_BY_SIZE.items():
-        if len(values) > 1:
-            RESULT_GROUP.append(list(value for value in values))
+    if isinstance(file_path_names, filetable.FileTable):
+        with stats.stage(scan_stats, 'size', len(file_path_names)) as STAGE:
+            for indexes in file_path_names.size_groups():
+                RESULT_GROUP.append(file_path_names.records(indexes))
+                STAGE.files_out += len(indexes)
+        return RESULT_GROUP
+    with stats.stage(scan_stats, 'size') as STAGE:
+        for _file in file_path_names:
+            STAGE.files_in += 1
+            record = walker.to_record(_file)
+            key = str(record.size)
+            if record.size == 0:
+                continue
+            try:
+                GROUP_BY_SIZE[key].append(_file)
+            except KeyError:
+                GROUP_BY_SIZE[key] = list()
+                GROUP_BY_SIZE[key].append(_file)
+        for _, values in GROUP_BY_SIZE.items():
+            if len(values) > 1:
+                RESULT_GROUP.append(list(value for value in values))
+                STAGE.files_out += len(values)
     return RESULT_GROUP
 
 
@@ -117,56 +321,230 @@ def chunk_reader(fobj, chunk_size=1024):
         yield chunk
 
 
-def get_file_checksum(file_path_name):
-    """Simple function get file checksum using chunk_reader"""
-    h = hashlib.md5()
-    if file_valid(file_path_name):
-        with open(file_path_name, "rb") as fd:
-            for chunk in chunk_reader(fd):
-                h.update(chunk)
-        return h.hexdigest()
+def get_file_checksum(file_path_name, cache=None, hash=hashlib.md5):
+    """
+    Simple function get file checksum using fileio.hash_file
+    - file_path_name: path or walker.FileRecord of the file
+    - cache: optional ChecksumCache consulted before reading the file
+    - hash: hash constructor, see hashers.get_hash_factory()
+    - Raise OSError if the file cannot be opened or read, the file is not
+    checked beforehand
+    """
+    kind = hashers.hash_name(hash) + ':content'
+    if cache is not None:
+        cache_key = checksum_cache.record_key(walker.to_record(file_path_name))
+        digest = cache.get(cache_key, kind)
+        if digest:
+            return digest
+    h = hash()
+    fileio.hash_file(walker.record_path(file_path_name), h)
+    digest = h.hexdigest()
+    if cache is not None:
+        cache.put(cache_key, kind, digest)
+    return digest
 
 
-def group_files_by_checksum(file_path_names):
+def get_file_checksums(records, cache=None, jobs=1, use_processes=False,
+                       hash=hashlib.md5, io_order='scan'):
+    """
+    Return the checksums of a list of files, hashed by a pool of workers
+    - Expected value: list of checksums in the order of records,
+    None for files that could not be read
+    - records: walker.FileRecords of the files, used as cache keys
+    - Cache lookups and stores happen in the calling thread, only the
+    missing checksums are handed to the workers
+    - io_order: order in which the missing checksums are read, see
+    diskorder.read_batches(), the checksums are the same whatever the order
+    """
+    CHECKSUMS = [None] * len(records)
+    PENDING = list()
+    KIND = hashers.hash_name(hash) + ':content'
+    for index, record in enumerate(records):
+        if cache is not None:
+            CHECKSUMS[index] = cache.get(checksum_cache.record_key(record),
+                                         KIND)
+            if CHECKSUMS[index]:
+                continue
+        PENDING.append(index)
+    for BATCH in diskorder.read_batches([records[i] for i in PENDING],
+                                        io_order):
+        INDEXES = [PENDING[i] for i in BATCH]
+        RESULTS = workers.map_files(partial(get_file_checksum, hash=hash),
+                                    [records[i].path for i in INDEXES],
+                                    jobs=jobs, use_processes=use_processes)
+        for index, (ok, checksum) in zip(INDEXES, RESULTS):
+            if not ok:
+                continue
+            CHECKSUMS[index] = checksum
+            if cache is not None and checksum:
+                cache.put(checksum_cache.record_key(records[index]), KIND,
+                          checksum)
+    return CHECKSUMS
+
+
+def iter_groups_by_checksum(file_path_names, cache=None, jobs=1,
+                            use_processes=False, hash=hashlib.md5,
+                            scan_stats=None, io_order='scan'):
+    """
+    Generator version of group_files_by_checksum
+    - Expected value: (checksum, group) for every group of files with the
+    same hash
+    - scan_stats: optional stats.ScanStats measuring the 'content' stage
+    """
+    GROUP_BY_CHECKSUM = dict()
+    GROUPS = list()
+    with stats.stage(scan_stats, 'content') as STAGE:
+        RECORDS, LINKS = walker.collapse_hardlinks(file_path_names)
+        RECORDS = [record for record in RECORDS if record.size != 0]
+        STAGE.files_in += sum(len(LINKS[walker.inode_key(record)])
+                              for record in RECORDS)
+        CHECKSUMS = get_file_checksums(RECORDS, cache, jobs, use_processes,
+                                       hash, io_order)
+        for record, key in zip(RECORDS, CHECKSUMS):
+            if key:
+                try:
+                    GROUP_BY_CHECKSUM[key].append(record)
+                except KeyError:
+                    GROUP_BY_CHECKSUM[key] = list()
+                    GROUP_BY_CHECKSUM[key].append(record)
+        for key, values in GROUP_BY_CHECKSUM.items():
+            if len(values) > 1:
+                GROUPS.append((key, list(
+                    _file for value in values
+                    for _file in LINKS[walker.inode_key(value)])))
+                STAGE.files_out += len(GROUPS[-1][1])
+    yield from GROUPS
+
+
+def group_files_by_checksum(file_path_names, cache=None, jobs=1,
+                            use_processes=False, hash=hashlib.md5,
+                            scan_stats=None, io_order='scan'):
     """
     Simple function group files by checksum
     - Expected value: list contain groups of files with the same hash
     - Return empty list if unable to find group of files with the same hash
     or group os files with size 0
+    - jobs/use_processes: see workers.map_files(), the groups are the same
+    whatever the number of workers
+    - file_path_names: paths or walker.FileRecords, groups hold the same
+    items
+    - Hardlinks of the same inode are hashed once and all land in the same
+    group, a group needs at least 2 distinct inodes
+    - scan_stats: optional stats.ScanStats, see stats.ScanStats.stage()
+    - io_order: order of the reads, see get_file_checksums()
     """
-    RESULT_GROUP = list()
-    GROUP_BY_CHECKSUM = dict()
-    for _file in file_path_names:
-        stat = os.stat(_file)
-        key = get_file_checksum(_file)
-        if stat.st_size == 0:
+    return [group for _, group in iter_groups_by_checksum(
+        file_path_names, cache, jobs, use_processes, hash, scan_stats,
+        io_order)]
+
+
+def confirm_size_groups(size_groups, cache=None, jobs=1, use_processes=False,
+                        compare_max_group=compare.COMPARE_MAX_GROUP,
+                        hash=hashlib.md5, scan_stats=None, io_order='scan'):
+    """
+    Generator splitting groups of same-size walker.FileRecords by content
+    - Expected value: walker.DuplicateGroup for every group of duplicates
+    - Groups of at most compare_max_group distinct inodes are compared
+    byte by byte, the others are hashed together
+    - scan_stats: optional stats.ScanStats measuring the 'compare' and
+    'content' stages
+    - io_order: order of the files hashed, see get_file_checksums()
+    """
+    TMP = list()
+    SMALL_GROUPS = list()
+    LINKS = dict()
+    for group in size_groups:
+        RECORDS, GROUP_LINKS = walker.collapse_hardlinks(group)
+        if len(RECORDS) < 2:
             continue
-        if key:
-            try:
-                GROUP_BY_CHECKSUM[key].append(_file)
-            except KeyError:
-                GROUP_BY_CHECKSUM[key] = list()
-                GROUP_BY_CHECKSUM[key].append(_file)
-    for _, values in GROUP_BY_CHECKSUM.items():
-        if len(values) > 1:
-            RESULT_GROUP.append(list(value for value in values))
-    return RESULT_GROUP
+        if len(RECORDS) <= compare_max_group:
+            SMALL_GROUPS.append(RECORDS)
+            LINKS.update(GROUP_LINKS)
+            continue
+        for _file in group:
+            TMP.append(_file)
+    COMPARED = list()
+    if SMALL_GROUPS:
+        with stats.stage(scan_stats, 'compare',
+                         sum(len(paths) for paths in LINKS.values())) \
+                as STAGE:
+            for classes in compare.compare_groups(
+                    SMALL_GROUPS, cache, hash=hash, jobs=jobs,
+                    use_processes=use_processes):
+                for digest, records in classes:
+                    COMPARED.append(walker.DuplicateGroup(
+                        records[0].size, digest,
+                        [_file.path for record in records
+                         for _file in LINKS[walker.inode_key(record)]]))
+                    STAGE.files_out += len(COMPARED[-1].paths)
+    yield from COMPARED
+    if len(TMP) > 0:
+        for digest, group in iter_groups_by_checksum(TMP, cache, jobs,
+                                                     use_processes, hash,
+                                                     scan_stats, io_order):
+            yield walker.DuplicateGroup(group[0].size, digest,
+                                        [record.path for record in group])
+
+
+def iter_duplicate_files(file_path_names, cache=None, jobs=1,
+                         use_processes=False,
+                         compare_max_group=compare.COMPARE_MAX_GROUP,
+                         hash=hashlib.md5, batch_files=BATCH_FILES,
+                         scan_stats=None, io_order='scan'):
+    """
+    Generator version of find_duplicate_files
+    - Expected value: walker.DuplicateGroup(size, digest, paths) of every
+    group of duplicates, as soon as it is confirmed
+    - Size groups are confirmed in batches of about batch_files files so
+    that workers stay busy while the first groups are already yielded
+    - scan_stats: optional stats.ScanStats receiving the measures of the
+    'scan', 'size', 'compare' and 'content' stages
+    - io_order: order of the files hashed, see get_file_checksums()
+    - file_path_names may be a filetable.FileTable, whose scan is not
+    measured here
+    """
+    BATCH = list()
+    BATCH_SIZE = 0
+    if isinstance(file_path_names, filetable.FileTable):
+        RECORDS = file_path_names
+    else:
+        RECORDS = list(stats.iter_stage(scan_stats, 'scan',
+                                        walker.to_records(file_path_names)))
+    for group in group_files_by_size(RECORDS, scan_stats):
+        BATCH.append(group)
+        BATCH_SIZE += len(group)
+        if BATCH_SIZE >= batch_files:
+            yield from confirm_size_groups(BATCH, cache, jobs, use_processes,
+                                           compare_max_group, hash,
+                                           scan_stats, io_order)
+            BATCH = list()
+            BATCH_SIZE = 0
+    yield from confirm_size_groups(BATCH, cache, jobs, use_processes,
+                                   compare_max_group, hash, scan_stats,
+                                   io_order)
 
 
-def find_duplicate_files(file_path_names):
+def find_duplicate_files(file_path_names, cache=None, jobs=1,
+                         use_processes=False,
+                         compare_max_group=compare.COMPARE_MAX_GROUP,
+                         hash=hashlib.md5, scan_stats=None,
+                         io_order='scan'):
     """
     Simple function find duplicate files
     Group files by size first and then
     group files by checksum using group_by function above
+    - file_path_names: paths or walker.FileRecords, each file is stat'ed
+    at most once, or a filetable.FileTable
+    - Expected value: list of groups of duplicate paths
+    - Size groups of at most compare_max_group distinct inodes are
+    compared byte by byte, which stops reading at the first difference,
+    see compare.compare_files()
+    - scan_stats: optional stats.ScanStats, see iter_duplicate_files()
+    - io_order: order of the files hashed, see get_file_checksums()
     """
-    TMP = list()
-    GROUP_BY_SIZE = group_files_by_size(file_path_names)
-    if len(GROUP_BY_SIZE) > 0:
-        for group in GROUP_BY_SIZE:
-            for _file in group:
-                TMP.append(_file)
-    if len(TMP) > 0:
-        return group_files_by_checksum(TMP)
+    return [group.paths for group in iter_duplicate_files(
+        file_path_names, cache, jobs, use_processes, compare_max_group,
+        hash, scan_stats=scan_stats, io_order=io_order)]
 
 
 def json_dump(data):
@@ -176,27 +554,451 @@ def json_dump(data):
     return json.dumps(data)
 
 
+def write_ndjson(groups, stream=sys.stdout, extra=None):
+    """
+    Write each walker.DuplicateGroup as one JSON line as soon as the groups
+    generator yields it
+    - extra: optional dictionary of values added to every line
+    - Expected value: number of groups written
+    """
+    COUNT = 0
+    for group in groups:
+        LINE = group._asdict()
+        LINE.update(extra or {})
+        stream.write(json_dump(LINE) + "\n")
+        stream.flush()
+        COUNT += 1
+    return COUNT
+
+
+def find_hardlinks(file_path_names):
+    """
+    Simple function find hardlinked files
+    - Expected value: list of groups of paths sharing the same inode, they
+    take no extra space on disk and are not reported as duplicates unless
+    another copy of their content exists
+    """
+    return walker.hardlink_groups(file_path_names)
+
+
+def load_groups(groups_path):
+    """
+    Read the groups printed by a previous run
+    - Expected value: list of lists of paths, in printed order
+    - groups_path holds the json output, a list of groups or an object with
+    'unverified' or 'duplicates' groups, or the ndjson output, one group
+    per line; hardlink lines are skipped
+    """
+    with open(groups_path) as fd:
+        text = fd.read()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = [json.loads(line) for line in text.splitlines()
+                if line.strip()]
+    if isinstance(data, dict) and 'paths' not in data:
+        data = data.get('unverified', data.get('duplicates', []))
+    elif isinstance(data, dict):
+        data = [data]
+    return [group['paths'] if isinstance(group, dict) else group
+            for group in data if not isinstance(group, dict)
+            or 'paths' in group]
+
+
+def verify_groups(groups, cache=None, jobs=1, use_processes=False,
+                  compare_max_group=compare.COMPARE_MAX_GROUP,
+                  hash=hashlib.md5, io_order='scan'):
+    """
+    Generator confirming groups of likely duplicates with their full
+    content, through the size and content stages of
+    another.iter_duplicates(), so that a duplicate of the approximate mode,
+    empty files included, stays one
+    - Expected value: walker.DuplicateGroup of every set of true duplicates,
+    a group may split into several or vanish; files gone are skipped
+    - The files of all the groups are verified together: true duplicates
+    always share a group, since they share their size and sampled blocks
+    """
+    return another.iter_duplicates(
+        [path for group in groups for path in group], hash=hash,
+        cache=cache, jobs=jobs, use_processes=use_processes,
+        compare_max_group=compare_max_group, stages=['size', 'content'],
+        io_order=io_order)
+
+
+def format_stage_counts(stage_counts):
+    """
+    Return a table of the files handled by each stage of
+    another.check_duplicates
+    """
+    LINES = ['%-16s %10s %10s %10s %10s' % ('stage', 'in', 'out',
+                                          'compared', 'eliminated')]
+    for counts in stage_counts:
+        LINES.append('%-16s %10d %10d %10d %10d' % (
+            counts['stage'], counts['files_in'], counts['files_out'],
+            counts['compared'], counts['eliminated']))
+    return "\n".join(LINES) + "\n"
+
+
+# Number of scanned files between two calls to the cancel callable of a
+# DuplicateFinder.
+CANCEL_CHECK_FILES = 1024
+
+
+class Cancelled(Exception):
+    """Raised inside a DuplicateFinder when its cancel callable returns True"""
+
+
+def distinct_roots(roots):
+    """
+    Return roots in order, without repeats and without the roots inside
+    another one, whose files would otherwise be scanned twice
+    """
+    real_paths = [os.path.join(os.path.realpath(root), '') for root in roots]
+    return [root for index, (root, real_path)
+            in enumerate(zip(roots, real_paths))
+            if not any(real_path.startswith(other)
+                       and (real_path != other or other_index < index)
+                       for other_index, other in enumerate(real_paths))]
+
+
+def check_roots(roots):
+    """
+    Return a directory or a list of directories as a list of paths
+    without repeats, see distinct_roots()
+    - Raise ValueError if there is none or one is not a readable directory
+    """
+    if isinstance(roots, (str, bytes, os.PathLike)):
+        roots = [roots]
+    roots = [os.fsdecode(root) for root in roots]
+    for root in roots:
+        if not os.path.isdir(root) or not os.access(root, os.R_OK):
+            raise ValueError('Invalid path: ' + root)
+    if not roots:
+        raise ValueError('No path to scan')
+    return distinct_roots(roots)
+
+
+class DuplicateFinder:
+    """
+    Find duplicate files from Python, without main() and its side effects
+    Iterating a finder scans its roots and yields a walker.DuplicateGroup
+    (size, digest, paths) for every group of duplicates as soon as it is
+    confirmed, no list of the groups is kept.
+    - roots: a directory or a list of directories, a group may hold files
+    of several roots
+    - reference: optional directory or list of directories; the finder
+    then yields a walker.ReferenceMatch for every content of the roots
+    found under them, see another.iter_reference_matches()
+    - The other options are the ones of the command line, see
+    get_arguments(); hash and prefilter_hash are hash factories, see
+    hashers.get_hash_factory(), cache an optional ChecksumCache which the
+    caller closes, snapshot_path a --snapshot file updated when the
+    iteration ends
+    - progress: optional callable called with the stats.StageStats of a
+    stage every time a run of this stage ends
+    - hardlinks: the groups hold one path per inode, the other links of an
+    inode are only returned by find_hardlinks()
+    - approximate: number of blocks of the approximate mode, which
+    replaces stages and implies bonus, see another.approximate_stages();
+    verified is then False
+    - cancel: optional callable checked after every run of a stage, every
+    CANCEL_CHECK_FILES scanned files and before every group; when it returns
+    True the iteration stops without error and cancelled is set
+    - After an iteration, scan_stats holds the measures of every stage when
+    collect_stats, progress or cancel is given, stage_counts the counts of
+    --stage-report and snapshot the updated snapshot.Snapshot
+    - Raise ValueError on a root which is not a readable directory and on
+    options the command line rejects
+    """
+
+    def __init__(self, roots, show_hidden=False, bonus=False, cache=None,
+                 jobs=1, use_processes=False,
+                 compare_max_group=compare.COMPARE_MAX_GROUP,
+                 stages=another.DEFAULT_STAGES, hash=hashlib.md5,
+                 prefilter_hash=None, io_order='scan', max_memory=None,
+                 spill_dir=None, scan_jobs=1, ordered_scan=False,
+                 snapshot_path=None, hardlinks=False, collect_stats=False,
+                 progress=None, cancel=None, approximate=None,
+                 reference=None):
+        roots = check_roots(roots)
+        if hardlinks and max_memory:
+            raise ValueError('hardlinks cannot be combined with max_memory')
+        if snapshot_path is not None and len(roots) > 1:
+            raise ValueError('A snapshot covers a single path')
+        if reference is not None and max_memory:
+            raise ValueError('reference cannot be combined with max_memory')
+        if io_order not in diskorder.IO_ORDERS:
+            raise ValueError('Unknown I/O order: ' + io_order)
+        self.roots = roots
+        self.references = None if reference is None \
+            else check_roots(reference)
+        self.show_hidden = show_hidden
+        self.bonus = bonus or bool(approximate)
+        self.cache = cache
+        self.jobs = jobs or workers.default_jobs()
+        self.use_processes = use_processes
+        self.compare_max_group = compare_max_group
+        self.stages = another.approximate_stages(approximate) \
+            if approximate else another.parse_stages(stages)
+        self.verified = not approximate
+        self.hash = hash
+        self.prefilter_hash = prefilter_hash
+        self.io_order = io_order
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.scan_jobs = scan_jobs
+        self.ordered_scan = ordered_scan
+        self.snapshot_path = snapshot_path
+        self.hardlinks = hardlinks
+        self.progress = progress
+        self.cancel = cancel
+        self.scan_stats = None
+        if collect_stats or progress is not None or cancel is not None:
+            self.scan_stats = stats.ScanStats(hook=self.stage_ended)
+        self.stage_counts = list()
+        self.snapshot = None
+        self.files = None
+        self.cancelled = False
+
+    def check_cancel(self):
+        """Raise Cancelled when the cancel callable returns True"""
+        if self.cancel is not None and self.cancel():
+            raise Cancelled()
+
+    def stage_ended(self, stage_stats):
+        """Hook of scan_stats, see stats.ScanStats"""
+        if self.progress is not None:
+            self.progress(stage_stats)
+        self.check_cancel()
+
+    def checked(self, items):
+        """Generator checking cancel every CANCEL_CHECK_FILES items"""
+        for index, item in enumerate(items, 1):
+            if not index % CANCEL_CHECK_FILES:
+                self.check_cancel()
+            yield item
+
+    def scan(self):
+        """
+        Scan the roots
+        - Expected value: filetable.FileTable of their files, or an iterator
+        of walker.FileRecords read lazily with snapshot_path or max_memory
+        """
+        if self.snapshot_path is not None:
+            previous = snapshot.Snapshot.load(self.snapshot_path,
+                                              self.roots[0], self.show_hidden)
+            self.snapshot = snapshot.Snapshot(
+                self.roots[0], self.show_hidden, fallback=self.cache,
+                digests=previous.digests)
+            records = self.checked(self.snapshot.scan_records(previous))
+            return list(records) if self.hardlinks else records
+        if self.max_memory:
+            return self.checked(itertools.chain.from_iterable(
+                walker.scan_records(root, self.show_hidden, self.scan_jobs,
+                                    self.ordered_scan)
+                for root in self.roots))
+        with stats.stage(self.scan_stats, 'scan') as measures:
+            table = filetable.FileTable()
+            for dir_path, name, stat in self.checked(
+                    itertools.chain.from_iterable(
+                        walker.scan_entries(root, self.show_hidden,
+                                            self.scan_jobs,
+                                            self.ordered_scan)
+                        for root in self.roots)):
+                table.add(dir_path, name, stat)
+            measures.files_out += len(table)
+        return table
+
+    def scan_references(self):
+        """Generator of the walker.FileRecords of the reference roots"""
+        return self.checked(itertools.chain.from_iterable(
+            walker.scan_records(root, self.show_hidden, self.scan_jobs,
+                                self.ordered_scan)
+            for root in self.references))
+
+    def find(self, files):
+        """Generator of the duplicate groups of scanned files, see scan()"""
+        cache = self.cache if self.snapshot is None else self.snapshot
+        if self.references is not None:
+            return another.iter_reference_matches(
+                files, self.scan_references(), cache=cache, jobs=self.jobs,
+                use_processes=self.use_processes,
+                compare_max_group=self.compare_max_group,
+                stages=self.stages, stage_counts=self.stage_counts,
+                hash=self.hash, prefilter_hash=self.prefilter_hash,
+                scan_stats=self.scan_stats, io_order=self.io_order,
+                min_size=0 if self.bonus else 1)
+        if self.max_memory:
+            return external.iter_duplicates(
+                files, hash=self.hash, cache=cache, jobs=self.jobs,
+                use_processes=self.use_processes, io_order=self.io_order,
+                max_memory=self.max_memory, work_dir=self.spill_dir,
+                stages=self.stages if self.bonus else None,
+                prefilter_hash=self.prefilter_hash,
+                scan_stats=self.scan_stats)
+        if self.bonus:
+            return another.iter_duplicates(
+                files, cache=cache, jobs=self.jobs,
+                use_processes=self.use_processes,
+                compare_max_group=self.compare_max_group,
+                stages=self.stages, stage_counts=self.stage_counts,
+                hash=self.hash, prefilter_hash=self.prefilter_hash,
+                scan_stats=self.scan_stats, io_order=self.io_order)
+        return iter_duplicate_files(
+            files, cache=cache, jobs=self.jobs,
+            use_processes=self.use_processes,
+            compare_max_group=self.compare_max_group, hash=self.hash,
+            scan_stats=self.scan_stats, io_order=self.io_order)
+
+    def __iter__(self):
+        self.cancelled = False
+        self.stage_counts = list()
+        try:
+            self.files = self.scan()
+            if self.hardlinks:
+                links = set(path for group in self.find_hardlinks()
+                            for path in group[1:])
+            for group in self.find(self.files):
+                self.check_cancel()
+                if self.hardlinks:
+                    group = group._replace(paths=[
+                        path for path in group.paths if path not in links])
+                yield group
+        except Cancelled:
+            self.cancelled = True
+            return
+        if self.snapshot is not None:
+            self.snapshot.save(self.snapshot_path)
+
+    def find_hardlinks(self):
+        """
+        Return the groups of hardlinks of the files of the last iteration,
+        see find_hardlinks()
+        - Raise ValueError unless the finder was made with hardlinks
+        """
+        if not self.hardlinks:
+            raise ValueError('The finder does not keep hardlinks')
+        return find_hardlinks(self.files or list())
+
+
+def open_cache(ARGS, root):
+    """
+    Return the checksum_cache.ChecksumCache asked for with --cache, or None
+    - root: path next to which the cache is stored unless a file is given
+    """
+    if ARGS.cache is None:
+        return None
+    CACHE = checksum_cache.ChecksumCache(
+        ARGS.cache or checksum_cache.default_cache_path(root),
+        max_entries=ARGS.cache_max_entries)
+    if ARGS.clear_cache:
+        CACHE.clear()
+    return CACHE
+
+
 def main():
     """Main function operate program"""
-    LIST_OF_FILES = []
-
     ARGS = get_arguments()
     PATH = ARGS.path
-    SHOW_HIDDEN = ARGS.hidden
-    BONUS = ARGS.bonus
+
+    if ARGS.benchmark_hashes:
+        print(json_dump(hashers.benchmark_hashes()))
+        return
+
+    if ARGS.log_file or ARGS.log_level:
+        logs.configure(ARGS.log_file, ARGS.log_level or 'info',
+                       max_bytes=ARGS.log_max_bytes,
+                       backup_count=ARGS.log_backups,
+                       sample_every=ARGS.log_sample)
+
+    MAX_READ_RATE = ARGS.max_read_rate
+    if MAX_READ_RATE and ARGS.processes:
+        MAX_READ_RATE = max(1, MAX_READ_RATE
+                            // (ARGS.jobs or workers.default_jobs()))
+    fileio.configure(MAX_READ_RATE, drop_cache=ARGS.drop_cache,
+                     direct_min_size=ARGS.direct_io)
+
+    if ARGS.verify:
+        GROUPS = load_groups(ARGS.verify)
+        if ARGS.select:
+            try:
+                GROUPS = [GROUPS[int(index)]
+                          for index in ARGS.select.split(',')]
+            except (IndexError, ValueError):
+                sys.stderr.write('Invalid --select for %d groups: %s\n'
+                                 % (len(GROUPS), ARGS.select))
+                sys.exit(1)
+        CACHE = open_cache(ARGS, PATH or ARGS.verify)
+        GROUPS = verify_groups(
+            GROUPS, cache=CACHE, jobs=ARGS.jobs or workers.default_jobs(),
+            use_processes=ARGS.processes,
+            compare_max_group=ARGS.compare_max_group, hash=ARGS.hash,
+            io_order=ARGS.io_order)
+        if ARGS.output == 'ndjson':
+            write_ndjson(GROUPS)
+        else:
+            print(json_dump([group.paths for group in GROUPS]))
+        if CACHE is not None:
+            CACHE.close()
+            sys.stderr.write(CACHE.report() + "\n")
+        return
 
     valid_path(PATH)
+    for REFERENCE in ARGS.reference or ():
+        valid_path(REFERENCE)
 
-    LIST_OF_FILES = scan_files(PATH, SHOW_HIDDEN)
-    if BONUS:
-        RESULT = another.check_duplicates(LIST_OF_FILES)
-    else:
-        RESULT = find_duplicate_files(LIST_OF_FILES)
+    CACHE = open_cache(ARGS, PATH)
+
+    FINDER = DuplicateFinder(
+        PATH, show_hidden=ARGS.hidden, bonus=ARGS.bonus, cache=CACHE,
+        jobs=ARGS.jobs, use_processes=ARGS.processes,
+        compare_max_group=ARGS.compare_max_group, stages=ARGS.stages,
+        hash=ARGS.hash, prefilter_hash=ARGS.prefilter_hash,
+        io_order=ARGS.io_order, max_memory=ARGS.max_memory,
+        spill_dir=ARGS.spill_dir, scan_jobs=ARGS.scan_jobs,
+        ordered_scan=ARGS.ordered_scan, snapshot_path=ARGS.snapshot,
+        hardlinks=ARGS.hardlinks, collect_stats=bool(ARGS.stats),
+        approximate=ARGS.approximate, reference=ARGS.reference)
+    LABEL = 'duplicates' if FINDER.verified else 'unverified'
 
-    if RESULT:
-        print(json_dump(RESULT))
+    if ARGS.output == 'ndjson':
+        COUNT = write_ndjson(FINDER, extra=None if FINDER.verified
+                             else {'verified': False})
+        if ARGS.hardlinks:
+            for group in FINDER.find_hardlinks():
+                print(json_dump({'hardlinks': group}))
     else:
-        print("This path have no duplicate files.")
+        RESULT = [group.paths if FINDER.references is None
+                  else group._asdict() for group in FINDER]
+        COUNT = len(RESULT)
+        if ARGS.hardlinks:
+            print(json_dump({LABEL: RESULT,
+                             'hardlinks': FINDER.find_hardlinks()}))
+        elif RESULT and not FINDER.verified:
+            print(json_dump({LABEL: RESULT}))
+        elif RESULT:
+            print(json_dump(RESULT))
+        elif FINDER.references is not None:
+            print("This path have no file in the reference.")
+        else:
+            print("This path have no duplicate files.")
+    logger.info('done', extra=logs.fields(path=PATH, groups=COUNT,
+                                          cancelled=FINDER.cancelled))
+
+    if ARGS.stage_report and FINDER.stage_counts:
+        sys.stderr.write(format_stage_counts(FINDER.stage_counts))
+
+    if ARGS.stats == 'json':
+        sys.stderr.write(FINDER.scan_stats.to_json() + "\n")
+    elif ARGS.stats:
+        sys.stderr.write(FINDER.scan_stats.format_table())
+
+    if FINDER.snapshot is not None:
+        sys.stderr.write(FINDER.snapshot.report() + "\n")
+
+    if CACHE is not None:
+        CACHE.close()
+        sys.stderr.write(CACHE.report() + "\n")
 
 
 if __name__ == '__main__':
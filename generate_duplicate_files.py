@@ -18,14 +18,21 @@
 # SOFTWARE OR ITS DERIVATIVES.
 
 import argparse
+import concurrent.futures
 import errno
 import io
 import json
+import math
 import os
 import random
 import shutil
 import string
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 ONE_KB = 1024
 ONE_MB = ONE_KB * 1024
@@ -45,6 +52,19 @@ FILE_MIN_SIZE = ONE_MB
 # Default maximum size of a file to randomly generate.
 FILE_MAX_SIZE = ONE_MB
 
+# Size of the blocks of random bytes written to a file.
+WRITE_BLOCK_SIZE = ONE_MB
+
+# Distributions the size of a file can be drawn from.
+SIZE_DISTRIBUTIONS = ('uniform', 'lognormal', 'fixed')
+
+# Ways a duplicate file can be made from its source file.
+DUPLICATE_METHODS = ('copy', 'hardlink', 'reflink')
+
+# ioctl request cloning a file into another one on Linux (``FICLONE``),
+# supported by Btrfs, XFS and other copy-on-write file systems.
+FICLONE = 0x40049409
+
 
 def build_tree_pathname(file_name, directory_depth=8, pathname_separator_character=os.sep):
     """
@@ -80,7 +100,8 @@ def build_tree_pathname(file_name, directory_depth=8, pathname_separator_charact
         for i in range(min(directory_depth, len(filename_without_extension)))])
 
 
-def duplicate_file(source_file_path_name, destination_file_path_name):
+def duplicate_file(source_file_path_name, destination_file_path_name,
+        duplicate_method='copy'):
     """
     Duplicate a source file to another path.
 
@@ -90,8 +111,26 @@ def duplicate_file(source_file_path_name, destination_file_path_name):
 
     @param destination_file_path_name: absolute path and name of the
         destination of this source file.
+
+    @param duplicate_method: one of ``DUPLICATE_METHODS``: ``copy`` writes
+        a new copy of the content, ``hardlink`` adds a name to the source
+        file, and ``reflink`` makes a copy-on-write clone sharing the
+        blocks of the source file.  A reflink falls back to a copy on
+        file systems that do not support it.
     """
-    shutil.copyfile(source_file_path_name, destination_file_path_name)
+    if duplicate_method == 'hardlink':
+        os.link(source_file_path_name, destination_file_path_name)
+
+    elif duplicate_method == 'reflink':
+        with io.open(source_file_path_name, mode='rb') as source_fd, \
+                io.open(destination_file_path_name, mode='wb') as destination_fd:
+            try:
+                fcntl.ioctl(destination_fd.fileno(), FICLONE, source_fd.fileno())
+            except OSError:
+                shutil.copyfileobj(source_fd, destination_fd, WRITE_BLOCK_SIZE)
+
+    else:
+        shutil.copyfile(source_file_path_name, destination_file_path_name)
 
 
 def generate_files(file_count,
@@ -106,10 +145,22 @@ def generate_files(file_count,
         file_name_min_length=1,
         file_min_size=FILE_MIN_SIZE,
         file_max_size=FILE_MAX_SIZE,
-        root_path=None):
+        root_path=None,
+        seed=None,
+        size_distribution='uniform',
+        file_sizes=None,
+        size_sigma=1.0,
+        duplicate_method='copy',
+        jobs=1):
     """
     Generate random files with a certain ratio of duplicate files.
 
+    The tree is first planned, then files are written by ``jobs`` worker
+    processes: the original files first, then their duplicates.  The
+    content of every original file comes from its own seed drawn while
+    planning, so that the same seed gives the same tree whatever the
+    number of workers.
+
 
     @param file_count: number of file to generate.
 
@@ -145,46 +196,125 @@ def generate_files(file_count,
 
     @param root_path: absolute root path where to generate files.
 
+    @param seed: seed of the tree; if not defined, the global ``random``
+        generator is used.
+
+    @param size_distribution: one of ``SIZE_DISTRIBUTIONS``, see
+        ``generate_random_size``.
+
+    @param file_sizes: list of sizes of the ``fixed`` distribution.
+
+    @param size_sigma: standard deviation of the logarithm of the sizes of
+        the ``lognormal`` distribution.
+
+    @param duplicate_method: one of ``DUPLICATE_METHODS``, see
+        ``duplicate_file``.
+
+    @param jobs: number of worker processes writing files.
+
 
     @return: the list of `(file_path_name, file_size)` of files that have
         been generated.
+
+    @raise ValueError: if reflink duplicates are requested on a platform
+        without ``fcntl``.
     """
+    if duplicate_method == 'reflink' and fcntl is None:
+        raise ValueError('Reflink duplicates require fcntl, which this platform does not provide')
+
+    rng = random if seed is None else random.Random(seed)
+
     file_path_name_sizes = []
-    duplicate_file_path_names = []
+    file_path_names = set()
+    original_files = []
+    duplicate_files = []
 
     for i in range(file_count):
-        path = os.path.join(root_path if root_path else '.', generate_random_path(
-            directory_max_depth=directory_max_depth,
-            directory_min_depth=directory_min_depth))
-        make_directory_if_not_exists(path)
+        # Draw another name when two files would get the same path, as
+        # they are written concurrently.
+        file_path_name = None
+        while file_path_name is None or file_path_name in file_path_names:
+            path = os.path.join(root_path if root_path else '.', generate_random_path(
+                directory_max_depth=directory_max_depth,
+                directory_min_depth=directory_min_depth,
+                rng=rng))
+
+            file_name = generate_random_file_name(
+                file_extensions=file_extensions,
+                file_extension_min_length=file_extension_min_length,
+                file_extension_max_length=file_extension_max_length,
+                file_name_characters=file_name_characters,
+                file_name_min_length=file_name_min_length,
+                file_name_max_length=file_name_max_length,
+                rng=rng)
+
+            file_path_name = os.path.join(path, file_name)
+
+        file_path_names.add(file_path_name)
+
+        if len(file_path_name_sizes) * duplicate_file_ratio > len(duplicate_files):
+            source_file_path_name, file_size = original_files[rng.randint(0, len(original_files) - 1)][:2]
+            duplicate_files.append((source_file_path_name, file_path_name, duplicate_method))
 
-        file_name = generate_random_file_name(
-            file_extensions=file_extensions,
-            file_extension_min_length=file_extension_min_length,
-            file_extension_max_length=file_extension_max_length,
-            file_name_characters=file_name_characters,
-            file_name_min_length=file_name_min_length,
-            file_name_max_length=file_name_max_length)
+        else:
+            file_size = generate_random_size(file_min_size, file_max_size,
+                size_distribution=size_distribution,
+                file_sizes=file_sizes,
+                size_sigma=size_sigma,
+                rng=rng)
+            original_files.append((file_path_name, file_size, rng.getrandbits(64)))
 
-        file_path_name = os.path.join(path, file_name)
+        file_path_name_sizes.append((file_path_name, file_size))
 
-        if len(file_path_name_sizes) * duplicate_file_ratio > len(duplicate_file_path_names):
-            duplicate_file(file_path_name_sizes[random.randint(0, len(file_path_name_sizes) - 1)][0], file_path_name)
-            duplicate_file_path_names.append(file_path_name)
+    for path in sorted(set(os.path.dirname(file_path_name) for file_path_name in file_path_names)):
+        make_directory_if_not_exists(path)
 
-        else:
-            file_size = generate_random_file(file_path_name,
-                file_min_size=file_min_size,
-                file_max_size=file_max_size)
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            list(executor.map(_write_random_file, original_files, chunksize=16))
+            list(executor.map(_duplicate_file, duplicate_files, chunksize=16))
 
-        file_path_name_sizes.append((file_path_name, file_size))
+    else:
+        for arguments in original_files:
+            _write_random_file(arguments)
+
+        for arguments in duplicate_files:
+            _duplicate_file(arguments)
 
     return file_path_name_sizes
 
 
+def _duplicate_file(arguments):
+    duplicate_file(*arguments)
+
+
+def _write_random_file(arguments):
+    write_random_file(*arguments)
+
+
+def generate_random_bytes(size, rng=random):
+    """
+    Return a buffer of random bytes.
+
+
+    @param size: number of bytes to generate.
+
+    @param rng: random generator, the ``random`` module or an instance of
+        ``random.Random``.
+
+
+    @return: a ``bytes`` object of ``size`` bytes.
+    """
+    if hasattr(rng, 'randbytes'):
+        return rng.randbytes(size)
+
+    return rng.getrandbits(size * 8).to_bytes(size, 'little') if size else b''
+
+
 def generate_random_file(file_path_name,
         file_min_size=FILE_MIN_SIZE,
-        file_max_size=FILE_MAX_SIZE):
+        file_max_size=FILE_MAX_SIZE,
+        rng=random):
     """
     Create a binary file of a random size of bytes.
 
@@ -197,32 +327,95 @@ def generate_random_file(file_path_name,
     @param file_max_size: maximum size in bytes of the file to randomly
         generate.
 
+    @param rng: random generator, the ``random`` module or an instance of
+        ``random.Random``.
+
 
     @return: the size of the file that has been created.
     """
     # Choose a random size for this file.
-    file_required_size = random.randint(file_min_size, file_max_size)
-    file_current_size = 0
+    file_required_size = rng.randint(file_min_size, file_max_size)
 
-    # Preferred file system block size.
-    preferred_block_size = os.statvfs('/').f_bsize
+    return write_random_file(file_path_name, file_required_size, rng.getrandbits(64))
 
-    # Reduce the size of the block if the chosen size of the file to be
-    # generated is below.
-    block_size = min(file_required_size, preferred_block_size)
 
-    # Create the file with random binary blocks up to the chosen size of
-    # this file.
-    with io.open(file_path_name, mode='wb') as fd:
-        while block_size:
-            fd.write(bytes([random.randint(0, 255) for i in range(block_size)]))
+def generate_random_size(file_min_size=FILE_MIN_SIZE,
+        file_max_size=FILE_MAX_SIZE,
+        size_distribution='uniform',
+        file_sizes=None,
+        size_sigma=1.0,
+        rng=random):
+    """
+    Draw the size of a file.
+
+
+    @param file_min_size: minimum size in bytes of a file.
+
+    @param file_max_size: maximum size in bytes of a file.
+
+    @param size_distribution: ``uniform`` draws sizes evenly between the
+        minimum and maximum sizes; ``lognormal`` draws many small and a few
+        large files, centered on the geometric mean of the minimum and
+        maximum sizes and clamped to them; ``fixed`` picks one of
+        ``file_sizes``.
+
+    @param file_sizes: list of sizes of the ``fixed`` distribution.
+
+    @param size_sigma: standard deviation of the logarithm of the sizes of
+        the ``lognormal`` distribution.
+
+    @param rng: random generator, the ``random`` module or an instance of
+        ``random.Random``.
+
+
+    @return: a size in bytes.
+
+
+    @raise ValueError: if the distribution is unknown, or if the ``fixed``
+        distribution has no sizes.
+    """
+    if size_distribution == 'uniform':
+        return rng.randint(file_min_size, file_max_size)
+
+    if size_distribution == 'lognormal':
+        mu = (math.log(max(file_min_size, 1)) + math.log(max(file_max_size, 1))) / 2
+        return min(max(int(rng.lognormvariate(mu, size_sigma)), file_min_size), file_max_size)
+
+    if size_distribution == 'fixed':
+        if not file_sizes:
+            raise ValueError('The fixed size distribution requires a list of file sizes')
+        return file_sizes[rng.randint(0, len(file_sizes) - 1)]
+
+    raise ValueError('Unknown size distribution: %s' % size_distribution)
 
-            file_current_size += block_size
 
-            if file_current_size + block_size > file_required_size:
-                block_size = file_required_size - file_current_size
+def write_random_file(file_path_name, file_size, seed):
+    """
+    Create a binary file of random bytes.
+
+
+    @param file_path_name: absolute path name of the file to be created.
+
+    @param file_size: size in bytes of the file to create.
+
+    @param seed: seed of the content of the file; files created with the
+        same seed start with the same bytes.
+
+
+    @return: the size of the file that has been created.
+    """
+    rng = random.Random(seed)
+    file_current_size = 0
 
-    return file_required_size
+    # Create the file with random binary blocks up to the size of this
+    # file.
+    with io.open(file_path_name, mode='wb') as fd:
+        while file_current_size < file_size:
+            block_size = min(WRITE_BLOCK_SIZE, file_size - file_current_size)
+            fd.write(generate_random_bytes(block_size, rng))
+            file_current_size += block_size
+
+    return file_size
 
 
 def generate_random_file_name(
@@ -231,7 +424,8 @@ def generate_random_file_name(
         file_extension_max_length=3,
         file_name_characters=FILE_NAME_CHARACTERS,
         file_name_min_length=1,
-        file_name_max_length=8):
+        file_name_max_length=8,
+        rng=random):
     """
     Generate a random name of a file.
 
@@ -255,18 +449,21 @@ def generate_random_file_name(
     @param file_name_max_length: maximum length of a file name to randomly
         generate.
 
+    @param rng: random generator, the ``random`` module or an instance of
+        ``random.Random``.
+
 
     @return: a file name.
     """
-    base_file_name = ''.join([file_name_characters[random.randint(0, len(file_name_characters) - 1)]
-        for _ in range(random.randint(file_name_min_length, file_name_max_length))])
+    base_file_name = ''.join([file_name_characters[rng.randint(0, len(file_name_characters) - 1)]
+        for _ in range(rng.randint(file_name_min_length, file_name_max_length))])
 
     if file_extension_max_length == 0:
         return base_file_name
 
-    file_name_extension = file_extensions[random.randint(0, len(file_extensions) - 1)] if file_extensions \
-        else ''.join([file_name_characters[random.randint(0, len(file_name_characters) - 1)]
-            for _ in range(random.randint(file_extension_min_length, file_extension_max_length))])
+    file_name_extension = file_extensions[rng.randint(0, len(file_extensions) - 1)] if file_extensions \
+        else ''.join([file_name_characters[rng.randint(0, len(file_name_characters) - 1)]
+            for _ in range(rng.randint(file_extension_min_length, file_extension_max_length))])
 
     return ''.join([base_file_name, os.path.extsep, file_name_extension])
 
@@ -274,7 +471,8 @@ def generate_random_file_name(
 
 def generate_random_path(directory_max_depth,
         directory_min_depth=None,
-        directory_name_characters=DIRECTORY_NAME_CHARACTERS):
+        directory_name_characters=DIRECTORY_NAME_CHARACTERS,
+        rng=random):
     """
     Generate a random path.
 
@@ -292,12 +490,15 @@ def generate_random_path(directory_max_depth,
     @param directory_name_characters: list of characters that are allowed
         to use to generate each path component.
 
+    @param rng: random generator, the ``random`` module or an instance of
+        ``random.Random``.
+
 
     @return: a random relative path.
     """
-    return os.path.join(*[directory_name_characters[random.randint(0, len(directory_name_characters) - 1)]
+    return os.path.join('', *[directory_name_characters[rng.randint(0, len(directory_name_characters) - 1)]
         for _ in range(directory_max_depth if directory_min_depth is None \
-            else random.randint(directory_min_depth, directory_max_depth))])
+            else rng.randint(directory_min_depth, directory_max_depth))])
 
 
 def main():
@@ -318,7 +519,13 @@ def main():
         file_name_min_length=arguments.file_name_min_length,
         file_min_size=arguments.file_min_size,
         file_max_size=arguments.file_max_size,
-        root_path=arguments.root_path)))
+        root_path=arguments.root_path,
+        seed=arguments.seed,
+        size_distribution=arguments.size_distribution,
+        file_sizes=arguments.file_sizes and [int(size) for size in arguments.file_sizes.split(',')],
+        size_sigma=arguments.size_sigma,
+        duplicate_method=arguments.duplicate_method,
+        jobs=arguments.jobs or os.cpu_count() or 1)))
 
 
 def make_directory_if_not_exists(path):
@@ -387,6 +594,21 @@ def parse_arguments():
     parser.add_argument('--file-max-size', type=int, required=False, default=FILE_MAX_SIZE,
         help='specify the maximum size of a file to randomly generate')
 
+    parser.add_argument('--size-distribution', choices=SIZE_DISTRIBUTIONS, required=False, default='uniform',
+        help='specify the distribution of the sizes of the files to randomly generate')
+    parser.add_argument('--file-sizes', required=False,
+        help='specify a comma-separated values of file sizes used by the fixed size distribution (e.g., "4096,65536")')
+    parser.add_argument('--size-sigma', type=float, required=False, default=1.0,
+        help='specify the standard deviation of the logarithm of the file sizes of the lognormal size distribution')
+
+    parser.add_argument('--duplicate-method', choices=DUPLICATE_METHODS, required=False, default='copy',
+        help='specify how duplicate files are made: copy, hardlink, or reflink (copy-on-write clone)')
+
+    parser.add_argument('--seed', type=int, required=False,
+        help='specify the seed used to generate the same tree of files again')
+    parser.add_argument('-j', '--jobs', type=int, required=False, default=1,
+        help='specify the number of worker processes writing files, 0 for one per CPU')
+
     return parser.parse_args()
 
 
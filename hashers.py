@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import time
+import zlib
+
+
+# Hash used when an optional algorithm is requested but not installed.
+FALLBACK_HASH = 'blake2b-16'
+
+# Algorithms provided by optional third-party modules.
+OPTIONAL_HASHES = ('xxh64', 'xxh3_64', 'xxh3_128', 'blake3')
+
+
+class HashFactory:
+    """
+    Picklable constructor of hash objects with a stable registry name
+    The name, not hashobj.name, identifies the algorithm in cache keys, so
+    that e.g. blake2b-16 and blake2b-32 never share digests
+    """
+
+    def __init__(self, name, constructor, **kwargs):
+        self.name = name
+        self.constructor = constructor
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.constructor(**self.kwargs)
+
+    def __repr__(self):
+        return 'HashFactory(%r)' % self.name
+
+
+class Crc32:
+    """
+    Hash object of zlib.crc32 with the interface of the hashlib ones, the
+    cheapest prefilter hash of the standard library
+    """
+    name = 'crc32'
+    digest_size = 4
+
+    def __init__(self, value=0):
+        self.value = value
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def copy(self):
+        return Crc32(self.value)
+
+    def digest(self):
+        return self.value.to_bytes(self.digest_size, 'big')
+
+    def hexdigest(self):
+        return '%08x' % self.value
+
+
+HASHES = dict()
+
+
+def register_hash(name, constructor, **kwargs):
+    """Add an algorithm to the registry under name"""
+    HASHES[name] = HashFactory(name, constructor, **kwargs)
+
+
+register_hash('md5', hashlib.md5)
+register_hash('sha1', hashlib.sha1)
+register_hash('sha256', hashlib.sha256)
+register_hash('blake2b', hashlib.blake2b)
+register_hash('crc32', Crc32)
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+else:
+    for _name in ('xxh64', 'xxh3_64', 'xxh3_128'):
+        if hasattr(xxhash, _name):
+            register_hash(_name, getattr(xxhash, _name))
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+else:
+    register_hash('blake3', blake3.blake3)
+
+
+def available_hashes():
+    """Return the names of the registered algorithms"""
+    return sorted(HASHES)
+
+
+def get_hash_factory(name, fallback=True):
+    """
+    Return the HashFactory of an algorithm
+    - name: registered name, or blake2b-N for a blake2b digest of N bytes
+    (1 to 64)
+    - When an optional algorithm is not installed, FALLBACK_HASH is
+    returned instead, or ValueError raised if not fallback
+    - Raise ValueError on unknown names
+    """
+    if name in HASHES:
+        return HASHES[name]
+    prefix, _, digest_size = name.partition('-')
+    if prefix == 'blake2b' and digest_size.isdigit() \
+            and 1 <= int(digest_size) <= 64:
+        register_hash(name, hashlib.blake2b, digest_size=int(digest_size))
+        return HASHES[name]
+    if name in OPTIONAL_HASHES and fallback:
+        return get_hash_factory(FALLBACK_HASH)
+    raise ValueError('Unknown or unavailable hash: ' + name)
+
+
+def default_prefilter_hash():
+    """
+    Return the hash used by prefilter stages: xxhash when installed, crc32
+    otherwise
+    """
+    for name in ('xxh3_64', 'xxh64'):
+        if name in HASHES:
+            return HASHES[name]
+    return HASHES['crc32']
+
+
+def hash_name(hash):
+    """
+    Return the name identifying a hash constructor in cache keys
+    - hash: HashFactory or plain constructor such as hashlib.md5
+    """
+    if isinstance(hash, HashFactory):
+        return hash.name
+    return hash().name
+
+
+def benchmark_hashes(size=64 * 1024 * 1024, block_size=1024 * 1024):
+    """
+    Rank the available algorithms by hashing throughput on this machine
+    - Hashes size bytes of random data held in memory, block_size bytes
+    per update call
+    - Expected value: list of {'hash', 'mb_per_s'} dictionaries, fastest
+    first
+    """
+    data = memoryview(os.urandom(block_size))
+    results = list()
+    for name in available_hashes():
+        hashobj = HASHES[name]()
+        start = time.perf_counter()
+        for _ in range(max(1, size // block_size)):
+            hashobj.update(data)
+        hashobj.hexdigest()
+        elapsed = time.perf_counter() - start
+        results.append({'hash': name,
+                        'mb_per_s': round(size / elapsed / 1048576, 1)})
+    return sorted(results, key=lambda result: -result['mb_per_s'])
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import itertools
+import json
+import logging
+import logging.handlers
+
+
+# Parent of the loggers of every module, see get_logger().
+LOGGER_NAME = 'dff'
+
+# Size of a log file before it is rotated, and number of rotated files kept.
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 3
+
+LEVELS = ('debug', 'info', 'warning', 'error')
+
+# Nothing is written, not even warnings on standard error, until configure()
+# is called; records below the level of the parent logger are dropped before
+# their message or fields are formatted.
+logging.getLogger(LOGGER_NAME).addHandler(logging.NullHandler())
+
+
+def get_logger(name):
+    """Return the logger of a module, under LOGGER_NAME"""
+    return logging.getLogger(LOGGER_NAME + '.' + name)
+
+
+def fields(sampled=False, **values):
+    """
+    Return the extra argument of a logging call adding values to the
+    record written by JsonFormatter
+    - sampled: the record is one of many of its kind, e.g. one per group,
+    and goes through SampleFilter
+    """
+    return {'fields': values, 'sampled': sampled}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a record as one JSON object per line with its time, level,
+    logger, event (the message) and the values given with fields()
+    """
+
+    def format(self, record):
+        data = {'time': self.formatTime(record),
+                'level': record.levelname.lower(),
+                'logger': record.name, 'event': record.getMessage()}
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keep one record in every `every` sampled records, see fields(), and
+    every record which is not sampled
+    """
+
+    def __init__(self, every=1):
+        super().__init__()
+        self.every = max(1, every)
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        if not getattr(record, 'sampled', False):
+            return True
+        return next(self.counter) % self.every == 0
+
+
+def configure(log_path=None, level='info', max_bytes=DEFAULT_MAX_BYTES,
+              backup_count=DEFAULT_BACKUP_COUNT, sample_every=1):
+    """
+    Send the records of every module at or above level to log_path as JSON
+    lines, or to standard error when log_path is None
+    - The file is rotated when it reaches max_bytes, backup_count rotated
+    files are kept, so the log takes at most about
+    (backup_count + 1) * max_bytes bytes
+    - sample_every: keep one sampled record in this many, see SampleFilter
+    - Calling it again replaces the previous configuration
+    - Expected value: the logging.Handler added
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        if not isinstance(handler, logging.NullHandler):
+            logger.removeHandler(handler)
+            handler.close()
+    if log_path is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            log_path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(SampleFilter(sample_every))
+    logger.addHandler(handler)
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    return handler
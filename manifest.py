@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+import argparse
+import gzip
+import json
+import os
+import socket
+import sys
+import another
+import checksum_cache
+import filetable
+import hashers
+import walker
+import workers
+
+
+MANIFEST_VERSION = 1
+
+
+class Manifest:
+    """
+    Files of one node and the digests it computed, to find duplicates
+    across nodes without moving their data
+
+    Paths are kept relative to the root, every directory once. Each file
+    has a dictionary of digests by stage, see another.parse_stages(): a
+    missing stage was not hashed, a None digest could not be read. A scan
+    only hashes the files sharing their keys with another file of the node,
+    merge() asks for the other digests it needs, see hash_work().
+    The hash and prefilter_hash names tell which algorithm computed the
+    digests of the content stage and of the other stages.
+    """
+
+    def __init__(self, node, root, stages=another.DEFAULT_STAGES,
+                 hash_name='md5', prefilter_name=None):
+        self.node = node
+        self.root = os.path.realpath(root)
+        self.stages = another.parse_stages(stages)
+        self.hash_name = hash_name
+        self.prefilter_name = prefilter_name or hash_name
+        self.dirs = list()
+        self.dir_ids = dict()
+        self.files = list()
+
+    @classmethod
+    def load(cls, manifest_path):
+        """
+        Return the Manifest saved in manifest_path
+        - Raise ValueError if it is not a manifest of this version
+        """
+        with gzip.open(manifest_path, 'rt') as fd:
+            data = json.load(fd)
+        if data.get('version') != MANIFEST_VERSION:
+            raise ValueError('Not a manifest: ' + manifest_path)
+        manifest = cls(data['node'], data['root'], data['stages'],
+                       data['hash'], data['prefilter_hash'])
+        manifest.dirs = data['dirs']
+        manifest.dir_ids = dict(
+            (dir_path, dir_id)
+            for dir_id, dir_path in enumerate(data['dirs']))
+        manifest.files = data['files']
+        return manifest
+
+    def save(self, manifest_path):
+        """Write the manifest to manifest_path, atomically"""
+        tmp_path = manifest_path + '.tmp'
+        with gzip.open(tmp_path, 'wt') as fd:
+            json.dump({'version': MANIFEST_VERSION, 'node': self.node,
+                       'root': self.root, 'stages': self.stages,
+                       'hash': self.hash_name,
+                       'prefilter_hash': self.prefilter_name,
+                       'dirs': self.dirs, 'files': self.files}, fd)
+        os.replace(tmp_path, manifest_path)
+
+    def add_record(self, record):
+        """Append a walker.FileRecord under the root, without digests"""
+        dir_path, name = os.path.split(os.path.relpath(record.path,
+                                                       self.root))
+        dir_id = self.dir_ids.get(dir_path)
+        if dir_id is None:
+            dir_id = self.dir_ids[dir_path] = len(self.dirs)
+            self.dirs.append(dir_path)
+        self.files.append([dir_id, name, record.size, record.dev, record.ino,
+                           record.mtime, dict()])
+
+    def path(self, index):
+        """Return the absolute path of a file on its node"""
+        dir_id, name = self.files[index][:2]
+        return os.path.normpath(os.path.join(self.root, self.dirs[dir_id],
+                                             name))
+
+    def record(self, index):
+        """Return the walker.FileRecord of a file, as scanned"""
+        size, dev, ino, mtime = self.files[index][2:6]
+        return walker.FileRecord(self.path(index), size, dev, ino, mtime)
+
+    def digests(self, index):
+        """Return the dictionary of digests by stage of a file"""
+        return self.files[index][6]
+
+    def hash_factory(self, stage):
+        """Return the hashers.HashFactory of the digests of a stage"""
+        return hashers.get_hash_factory(
+            self.hash_name if stage == 'content' else self.prefilter_name,
+            fallback=False)
+
+    def hash_files(self, indexes, stage, cache=None, jobs=1,
+                   use_processes=False):
+        """
+        Compute the digest of a stage of files, once per inode
+        Files whose size, inode or mtime changed since the scan get a None
+        digest, as the files which cannot be read
+        """
+        links = dict()
+        for index in indexes:
+            links.setdefault(tuple(self.files[index][3:5]), list()).append(
+                index)
+        records = list()
+        for inode_indexes in links.values():
+            try:
+                record = walker.to_record(self.path(inode_indexes[0]))
+            except OSError:
+                record = None
+            if record is None or checksum_cache.record_key(record) != \
+                    checksum_cache.record_key(self.record(inode_indexes[0])):
+                for index in inode_indexes:
+                    self.digests(index)[stage] = None
+            else:
+                records.append((record, inode_indexes))
+        hashes = another.get_hashes([record for record, _ in records],
+                                    stage=stage, cache=cache, jobs=jobs,
+                                    use_processes=use_processes,
+                                    hash=self.hash_factory(stage))
+        for (_, inode_indexes), (ok, hashed) in zip(records, hashes):
+            for index in inode_indexes:
+                self.digests(index)[stage] = hashed if ok else None
+
+
+def split_groups(groups, key_of, inode_of):
+    """
+    Split groups of files by a key
+    - key_of(file) returns the key of a file, or None to drop it
+    - inode_of(file) returns the identity shared by hardlinks
+    - Expected value: list of groups of files with the same key, holding
+    at least 2 distinct inodes
+    """
+    result = list()
+    for group in groups:
+        by_key = dict()
+        for item in group:
+            key = key_of(item)
+            if key is not None:
+                by_key.setdefault(key, list()).append(item)
+        result.extend(items for items in by_key.values()
+                      if len(set(map(inode_of, items))) > 1)
+    return result
+
+
+def scan_node(root, node=None, stages=another.DEFAULT_STAGES,
+              hash=hashers.get_hash_factory('md5'), prefilter_hash=None,
+              cache=None, jobs=1, use_processes=False, show_hidden=False,
+              scan_jobs=1):
+    """
+    Scan the tree of one node into a Manifest
+    - node: name of the node, the host name when None
+    - Every file is listed with its size and inode. Files go through the
+    stages after size as in another.check_duplicates(), but only the files
+    still sharing their keys with another file of the node are hashed, so
+    a file of a size unique on its node has no digest at all.
+    - hash and prefilter_hash are hashers.HashFactory, their names are
+    stored so that every node hashes the same way
+    - Raise ValueError if the first stage is not size
+    """
+    stages = another.parse_stages(stages)
+    if stages[0] != 'size':
+        raise ValueError('The first stage of a manifest must be size')
+    manifest = Manifest(node or socket.gethostname(), root, stages,
+                        hashers.hash_name(hash),
+                        hashers.hash_name(prefilter_hash or hash))
+    table = filetable.scan_table(root, show_hidden, scan_jobs)
+    for record in table:
+        manifest.add_record(record)
+
+    def inode_of(index):
+        return tuple(manifest.files[index][3:5])
+
+    groups = split_groups(table.size_groups(min_size=0), lambda index: 0,
+                          inode_of)
+    for stage in stages[1:]:
+        manifest.hash_files([index for group in groups for index in group],
+                            stage, cache=cache, jobs=jobs,
+                            use_processes=use_processes)
+        groups = split_groups(groups,
+                              lambda index: manifest.digests(index)[stage],
+                              inode_of)
+    return manifest
+
+
+def merge(manifests):
+    """
+    Find duplicates across the manifests of several nodes
+    - Expected value: (groups, work) where groups lists a
+    walker.DuplicateGroup for every group whose files have the digests of
+    every stage, their paths written node:path, and work maps each node to
+    the [path, stage] digests it still has to compute, see hash_work()
+    - Files of the same size on several nodes go through the stages with
+    the digests already in the manifests. When a file of a group lacks the
+    digest of a stage, the group stops there and only this stage of the
+    files lacking it, one path per inode, is asked for; merging again once
+    the nodes computed their work gets the groups further.
+    - Raise ValueError if the nodes are not unique or did not use the same
+    stages and hashes
+    """
+    if len(set(manifest.node for manifest in manifests)) < len(manifests):
+        raise ValueError('Each manifest must come from a distinct node')
+    for manifest in manifests[1:]:
+        if (manifest.stages, manifest.hash_name, manifest.prefilter_name) \
+                != (manifests[0].stages, manifests[0].hash_name,
+                    manifests[0].prefilter_name):
+            raise ValueError('Manifest of %s was made with other stages or '
+                             'hashes' % manifest.node)
+
+    def inode_of(item):
+        node_id, index = item
+        return (node_id,) + tuple(manifests[node_id].files[index][3:5])
+
+    def digests(item):
+        return manifests[item[0]].digests(item[1])
+
+    by_size = dict()
+    for node_id, manifest in enumerate(manifests):
+        for index, entry in enumerate(manifest.files):
+            by_size.setdefault(entry[2], list()).append((node_id, index))
+    groups = split_groups(by_size.values(), lambda item: 0, inode_of)
+
+    work = dict((manifest.node, list()) for manifest in manifests)
+    stages = manifests[0].stages[1:] if manifests else list()
+    for stage in stages:
+        complete = list()
+        for group in groups:
+            missing = dict()
+            for item in group:
+                if stage not in digests(item):
+                    missing.setdefault(inode_of(item), item)
+            if not missing:
+                complete.append(group)
+            for node_id, index in missing.values():
+                work[manifests[node_id].node].append(
+                    [manifests[node_id].path(index), stage])
+        groups = split_groups(complete, lambda item: digests(item)[stage],
+                              inode_of)
+
+    result = list()
+    for group in groups:
+        node_id, index = group[0]
+        result.append(walker.DuplicateGroup(
+            manifests[node_id].files[index][2],
+            digests(group[0])[stages[-1]] if stages else None,
+            sorted(manifests[node_id].node + ':' + manifests[node_id].path(
+                index) for node_id, index in group)))
+    return result, work
+
+
+def hash_work(manifest, work, cache=None, jobs=1, use_processes=False):
+    """
+    Compute the digests a merge asked for on this node and add them to its
+    manifest, together with the ones of the hardlinks of these files
+    - work: list of [path, stage], see merge()
+    - Expected value: number of files hashed, paths not in the manifest are
+    ignored
+    """
+    indexes = dict((manifest.path(index), index)
+                   for index in range(len(manifest.files)))
+    links = dict()
+    for index, entry in enumerate(manifest.files):
+        links.setdefault(tuple(entry[3:5]), list()).append(index)
+    by_stage = dict()
+    for path, stage in work:
+        if path in indexes:
+            by_stage.setdefault(stage, list()).extend(
+                links[tuple(manifest.files[indexes[path]][3:5])])
+    for stage, stage_indexes in by_stage.items():
+        manifest.hash_files(stage_indexes, stage, cache=cache, jobs=jobs,
+                            use_processes=use_processes)
+    return sum(len(set(stage_indexes)) for stage_indexes in by_stage.values())
+
+
+def get_arguments():
+    """
+    Get argument from command-line interface
+    - Expected value: ArgumentParser Object with the step to run in
+    parser.command and its options
+    """
+    parser = argparse.ArgumentParser(description='Find duplicate files \
+                                                  across several nodes')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scan_parser = commands.add_parser('scan', help='Scan the tree of this \
+                                                    node into a manifest')
+    scan_parser.add_argument('-p', '--path', type=str, required=True)
+    scan_parser.add_argument('-o', '--output', type=str, required=True,
+                             help='Manifest file to write')
+    scan_parser.add_argument('--node', type=str,
+                             help='Name of this node (default: host name)')
+    scan_parser.add_argument('-s', '--hidden', action='store_true')
+    scan_parser.add_argument('--stages', type=another.parse_stages,
+                             default=another.DEFAULT_STAGES)
+    scan_parser.add_argument('--hash', type=hashers.get_hash_factory,
+                             default=hashers.get_hash_factory('md5'))
+    scan_parser.add_argument('--prefilter-hash', type=hashers.get_hash_factory,
+                             default=hashers.get_hash_factory('md5'),
+                             help='Hash of the stages other than content, \
+                                   every node must have it (default: md5)')
+    scan_parser.add_argument('--scan-jobs', type=int, default=1)
+
+    merge_parser = commands.add_parser('merge', help='Find duplicates across \
+                                                      the manifests of \
+                                                      several nodes')
+    merge_parser.add_argument('manifests', nargs='+')
+    merge_parser.add_argument('--work-dir', type=str,
+                              help='Write the digests each node still has \
+                                    to compute to NODE.json in this \
+                                    directory')
+
+    hash_parser = commands.add_parser('hash', help='Compute the digests a \
+                                                    merge asked for and \
+                                                    update the manifest')
+    hash_parser.add_argument('manifest')
+    hash_parser.add_argument('work', help='NODE.json work list of merge')
+
+    for sub_parser in (scan_parser, hash_parser):
+        sub_parser.add_argument('-c', '--cache', type=str, default=None,
+                                metavar='CACHE_FILE')
+        sub_parser.add_argument('-j', '--jobs', type=int, default=1)
+    return parser.parse_args()
+
+
+def main():
+    """Run one step of a scan across nodes"""
+    ARGS = get_arguments()
+    CACHE = None
+    if getattr(ARGS, 'cache', None):
+        CACHE = checksum_cache.ChecksumCache(ARGS.cache)
+    JOBS = getattr(ARGS, 'jobs', 1) or workers.default_jobs()
+
+    if ARGS.command == 'scan':
+        MANIFEST = scan_node(ARGS.path, ARGS.node, ARGS.stages, ARGS.hash,
+                             ARGS.prefilter_hash, cache=CACHE, jobs=JOBS,
+                             show_hidden=ARGS.hidden,
+                             scan_jobs=ARGS.scan_jobs)
+        MANIFEST.save(ARGS.output)
+        sys.stderr.write('%s: %d files, %d hashed\n' % (
+            MANIFEST.node, len(MANIFEST.files),
+            sum(1 for entry in MANIFEST.files if entry[6])))
+    elif ARGS.command == 'merge':
+        GROUPS, WORK = merge([Manifest.load(path)
+                              for path in ARGS.manifests])
+        print(json.dumps([group._asdict() for group in GROUPS]))
+        for NODE, FILES in WORK.items():
+            if ARGS.work_dir:
+                with open(os.path.join(ARGS.work_dir, NODE + '.json'),
+                          'w') as fd:
+                    json.dump({'node': NODE, 'files': FILES}, fd)
+            sys.stderr.write('%s: %d digests to compute\n'
+                             % (NODE, len(FILES)))
+    else:
+        MANIFEST = Manifest.load(ARGS.manifest)
+        with open(ARGS.work) as fd:
+            WORK = json.load(fd)
+        if WORK['node'] != MANIFEST.node:
+            sys.exit('Work list of %s, manifest of %s'
+                     % (WORK['node'], MANIFEST.node))
+        COUNT = hash_work(MANIFEST, WORK['files'], cache=CACHE, jobs=JOBS)
+        MANIFEST.save(ARGS.manifest)
+        sys.stderr.write('%s: %d files hashed\n' % (MANIFEST.node, COUNT))
+
+    if CACHE is not None:
+        CACHE.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import http.client
+import http.server
+import json
+import threading
+import another
+import checksum_cache
+import filetable
+import hashers
+import logs
+import walker
+import workers
+
+
+logger = logs.get_logger('server')
+
+# Stages used to tell whether a file is stored, see another.parse_stages().
+STAGES = another.parse_stages(another.DEFAULT_STAGES)
+
+
+class StoreIndex:
+    """
+    Index of the files stored under a root, answering whether some content
+    is already stored
+    build() groups the tree with another.iter_duplicates() and keeps every
+    digest of its size, 1k and content stages, then hashes the files left,
+    e.g. of a size unique in the tree, so that no query reads the stored
+    tree: a file whose size is not stored is answered from the size index
+    alone, a (size, digest) lookup is a dictionary access. Files added
+    later are hashed by add_paths().
+    With lazy, the files left are only hashed, once, by the first query
+    needing them, which starts serving sooner but makes that query read
+    the stored tree.
+    The digests are kept in a checksum_cache.MemoryCache in front of the
+    optional cache, a ChecksumCache opened with check_same_thread=False
+    when the index is served, see make_server()
+    """
+
+    def __init__(self, hash=hashlib.md5, prefilter_hash=None, cache=None,
+                 jobs=1, use_processes=False, lazy=False):
+        self.hash = hash
+        self.prefilter_hash = prefilter_hash or hash
+        self.store = checksum_cache.MemoryCache(cache)
+        self.jobs = jobs
+        self.use_processes = use_processes
+        self.lazy = lazy
+        self.by_size = dict()
+        self.by_digest = dict()
+        self.resolved = set()
+        self.lock = threading.Lock()
+
+    def add_record(self, record):
+        """Add a stored walker.FileRecord"""
+        with self.lock:
+            self.by_size.setdefault(record.size, list()).append(record)
+            self.resolved.discard(record.size)
+
+    def add_paths(self, paths):
+        """
+        Add stored files by path, e.g. once they are ingested
+        - Expected value: number of files added, paths which cannot be
+        stat'ed are skipped
+        - Unless lazy, the stored files of their sizes are hashed now
+        """
+        count = 0
+        sizes = set()
+        for record in walker.to_records(paths):
+            self.add_record(record)
+            sizes.add(record.size)
+            count += 1
+        if not self.lazy:
+            for size in sizes:
+                self.resolve(size)
+        return count
+
+    def build(self, root, show_hidden=False, scan_jobs=1):
+        """Scan and hash a tree, see StoreIndex"""
+        table = filetable.scan_table(root, show_hidden, scan_jobs)
+        for record in table:
+            self.add_record(record)
+        for _ in another.iter_duplicates(
+                table, hash=self.hash, cache=self.store, jobs=self.jobs,
+                use_processes=self.use_processes, compare_max_group=0,
+                stages=STAGES, prefilter_hash=self.prefilter_hash):
+            pass
+        if not self.lazy:
+            for size in list(self.by_size):
+                self.resolve(size)
+        logger.info('index', extra=logs.fields(
+            root=root, files=len(table), sizes=len(self.by_size)))
+
+    def stage_digests(self, records, stage):
+        """Return the digests of a stage of stored files, None if unread"""
+        return [hashed if ok else None for ok, hashed in another.get_hashes(
+            records, stage=stage, cache=self.store, jobs=self.jobs,
+            use_processes=self.use_processes,
+            hash=self.hash if stage == 'content' else self.prefilter_hash)]
+
+    def resolve(self, size):
+        """
+        Hash every stored file of a size into the (size, digest) index, and
+        keep the digests of its prefilter stages for lookup_path()
+        """
+        records = list(self.by_size.get(size, ()))
+        for stage in STAGES[1:]:
+            digests = self.stage_digests(records, stage)
+        with self.lock:
+            for record, digest in zip(records, digests):
+                if digest is not None:
+                    paths = self.by_digest.setdefault((size, digest), list())
+                    if record.path not in paths:
+                        paths.append(record.path)
+            self.resolved.add(size)
+
+    def lookup_digest(self, size, digest):
+        """Return the stored paths of a size and content digest"""
+        if size not in self.by_size:
+            return list()
+        if size not in self.resolved:
+            self.resolve(size)
+        return list(self.by_digest.get((size, digest), ()))
+
+    def lookup_path(self, path):
+        """
+        Return (digest, stored paths) of the content of a file, which is
+        not compared with itself nor its hardlinks
+        - digest is None when no stored file could match it
+        - Raise OSError if the file cannot be read
+        """
+        record = walker.to_record(path)
+        candidates = [stored for stored in self.by_size.get(record.size, ())
+                      if walker.inode_key(stored) != walker.inode_key(record)]
+        digest = None
+        for stage in STAGES[1:]:
+            if not candidates:
+                return None, list()
+            digest = another.get_hash(
+                record, stage=stage,
+                hash=self.hash if stage == 'content' else self.prefilter_hash)
+            candidates = [stored for stored, stored_digest in zip(
+                candidates, self.stage_digests(candidates, stage))
+                if stored_digest == digest]
+        return digest, [stored.path for stored in candidates]
+
+    def query(self, query):
+        """
+        Answer one query, {'path': path} or {'size': size, 'digest': hex}
+        - Expected value: the query with 'stored' and the stored 'paths', or
+        with an 'error'
+        """
+        result = dict(query)
+        try:
+            if 'path' in query:
+                result['digest'], result['paths'] = self.lookup_path(
+                    query['path'])
+            else:
+                result['paths'] = self.lookup_digest(int(query['size']),
+                                                     query['digest'])
+        except (OSError, KeyError, TypeError, ValueError) as error:
+            result['error'] = str(error)
+            return result
+        result['stored'] = bool(result['paths'])
+        return result
+
+    def stats(self):
+        """Return the number of files and sizes indexed"""
+        return {'files': sum(len(records)
+                             for records in self.by_size.values()),
+                'sizes': len(self.by_size),
+                'resolved_sizes': len(self.resolved),
+                'digests': len(self.store.digests)}
+
+
+class LookupHandler(http.server.BaseHTTPRequestHandler):
+    """
+    JSON requests of the query server, on a keep-alive connection
+    - POST /lookup {"queries": [...]}: {"results": [...]}, see
+    StoreIndex.query()
+    - POST /add {"paths": [...]}: {"added": count}
+    - GET /stats: StoreIndex.stats()
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without TCP_NODELAY the
+    # body waits for the delayed ACK of the client.
+    disable_nagle_algorithm = True
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.index.stats())
+        else:
+            self.send_json(404, {'error': 'Unknown path: ' + self.path})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        if self.path == '/lookup':
+            self.send_json(200, {'results': [
+                self.server.index.query(query)
+                for query in request.get('queries', ())]})
+        elif self.path == '/add':
+            self.send_json(200, {'added': self.server.index.add_paths(
+                request.get('paths', ()))})
+        else:
+            self.send_json(404, {'error': 'Unknown path: ' + self.path})
+
+    def log_message(self, format, *args):
+        logger.debug('request', extra=logs.fields(
+            sampled=True, client=self.client_address[0],
+            request=format % args))
+
+
+def make_server(index, host='127.0.0.1', port=0):
+    """
+    Return a threaded HTTP server answering queries on index, not started
+    - port 0 picks a free port, see server_address
+    """
+    server = http.server.ThreadingHTTPServer((host, port), LookupHandler)
+    server.daemon_threads = True
+    server.index = index
+    return server
+
+
+class Client:
+    """Keep-alive connection to a query server"""
+
+    def __init__(self, host, port, timeout=60):
+        self.connection = http.client.HTTPConnection(host, port,
+                                                     timeout=timeout)
+
+    def request(self, method, path, data=None):
+        # bytes, not str, so that headers and body go in one send()
+        body = None if data is None else json.dumps(data).encode()
+        self.connection.request(method, path, body,
+                                {'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        return json.loads(response.read())
+
+    def lookup(self, queries):
+        """Return the results of a batch of queries"""
+        return self.request('POST', '/lookup', {'queries': queries})[
+            'results']
+
+    def add(self, paths):
+        """Add stored files, return the number added"""
+        return self.request('POST', '/add', {'paths': paths})['added']
+
+    def close(self):
+        self.connection.close()
+
+
+def get_arguments():
+    """
+    Get argument from command-line interface
+    - Expected value: ArgumentParser Object with attributes:
+        - parser.path
+        - parser.hidden
+        - parser.host
+        - parser.port
+        - parser.cache
+        - parser.jobs
+        - parser.hash
+        - parser.prefilter_hash
+        - parser.lazy
+    """
+    parser = argparse.ArgumentParser(description='Answer whether files are \
+                                                  already stored under a \
+                                                  root')
+    parser.add_argument('-p', '--path', type=str, required=True)
+    parser.add_argument('-s', '--hidden', action='store_true')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('-c', '--cache', type=str, default=None,
+                        metavar='CACHE_FILE')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--hash', type=hashers.get_hash_factory,
+                        default=hashers.get_hash_factory('md5'))
+    parser.add_argument('--prefilter-hash', type=hashers.get_hash_factory,
+                        default=hashers.default_prefilter_hash())
+    parser.add_argument('--lazy', action='store_true',
+                        help='Serve before every stored file is hashed, \
+                              the first query of a size then hashes the \
+                              stored files of this size')
+    return parser.parse_args()
+
+
+def main():
+    """Index a tree, then serve queries until interrupted"""
+    ARGS = get_arguments()
+    CACHE = None
+    if ARGS.cache:
+        CACHE = checksum_cache.ChecksumCache(ARGS.cache,
+                                             check_same_thread=False)
+    INDEX = StoreIndex(ARGS.hash, ARGS.prefilter_hash, cache=CACHE,
+                       jobs=ARGS.jobs or workers.default_jobs(),
+                       lazy=ARGS.lazy)
+    INDEX.build(ARGS.path, ARGS.hidden)
+    SERVER = make_server(INDEX, ARGS.host, ARGS.port)
+    print('Serving %s on http://%s:%d' % ((ARGS.path,)
+                                          + SERVER.server_address[:2]),
+          flush=True)
+    try:
+        SERVER.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        SERVER.server_close()
+        if CACHE is not None:
+            with INDEX.store.lock:
+                CACHE.close()
+
+
+if __name__ == '__main__':
+    main()
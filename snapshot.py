@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import gzip
+import json
+import os
+import checksum_cache
+import fileio
+import walker
+
+
+SNAPSHOT_VERSION = 2
+
+
+class Snapshot(checksum_cache.MemoryCache):
+    """
+    Directory snapshot of a scan, used to rescan a tree incrementally.
+
+    For every directory the snapshot records its st_mtime_ns, its
+    sub-directories and the FileRecords of its files, plus every digest
+    computed for these files. A directory whose mtime is unchanged on the
+    next run is not listed again: its records come from the snapshot.
+    Files added, removed or renamed change the directory mtime and are
+    picked up. A file rewritten in place does not, so the files of reused
+    directories whose size is shared by another inode, the only ones which
+    can be reported, are stat'ed again; the digests of a file whose size
+    and mtime are unchanged but whose ctime changed are dropped. A file of
+    a unique size rewritten in place to another size may be missed.
+
+    A Snapshot is also a checksum_cache.MemoryCache, optionally backed by
+    a fallback cache. digests may be shared with the snapshot of the
+    previous run.
+    """
+
+    def __init__(self, root, show_hidden=False, fallback=None, digests=None):
+        super().__init__(fallback, digests)
+        self.root = os.path.realpath(root)
+        self.show_hidden = show_hidden
+        self.dirs = dict()
+        self.ctimes = dict()
+        self.dirs_listed = 0
+        self.dirs_reused = 0
+        self.files_restated = 0
+
+    @classmethod
+    def load(cls, snapshot_path, root, show_hidden=False, fallback=None):
+        """
+        Return the Snapshot saved in snapshot_path
+        - An empty Snapshot is returned when the file does not exist or was
+        taken with another root or hidden files setting
+        """
+        snapshot = cls(root, show_hidden, fallback)
+        try:
+            with gzip.open(snapshot_path, 'rt') as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            return snapshot
+        if data.get('version') != SNAPSHOT_VERSION \
+                or data.get('root') != snapshot.root \
+                or data.get('show_hidden') != show_hidden:
+            return snapshot
+        for dir_path, (mtime, sub_dirs, files) in data['dirs'].items():
+            records = list()
+            for name, size, dev, ino, file_mtime, ctime, digests in files:
+                record = walker.FileRecord(os.path.join(dir_path, name),
+                                           size, dev, ino, file_mtime)
+                records.append(record)
+                snapshot.ctimes[record.path] = ctime
+                for kind, digest in digests.items():
+                    snapshot.digests[
+                        (checksum_cache.record_key(record), kind)] = digest
+            snapshot.dirs[dir_path] = (mtime, sub_dirs, records)
+        return snapshot
+
+    def save(self, snapshot_path):
+        """
+        Write the snapshot to snapshot_path, atomically
+        Only the digests of files still present are kept
+        """
+        by_key = dict()
+        for (key, kind), digest in self.digests.items():
+            by_key.setdefault(key, dict())[kind] = digest
+        dirs = dict()
+        for dir_path, (mtime, sub_dirs, records) in self.dirs.items():
+            files = list()
+            for record in records:
+                files.append([os.path.basename(record.path), record.size,
+                              record.dev, record.ino, record.mtime,
+                              self.ctimes.get(record.path),
+                              by_key.get(checksum_cache.record_key(record),
+                                         {})])
+            dirs[dir_path] = [mtime, sub_dirs, files]
+        tmp_path = snapshot_path + '.tmp'
+        with gzip.open(tmp_path, 'wt') as fd:
+            json.dump({'version': SNAPSHOT_VERSION, 'root': self.root,
+                       'show_hidden': self.show_hidden, 'dirs': dirs}, fd)
+        os.replace(tmp_path, snapshot_path)
+
+    def scan_records(self, previous=None):
+        """
+        Generator walking the root like walker.scan_records(), recording
+        every directory in this snapshot
+        - previous: Snapshot of the last run, whose unchanged directories
+        are reused instead of being listed
+        - Expected value: FileRecord of every regular file, the ones of the
+        reused directories last, once every size is known, see restat()
+        """
+        previous_dirs = previous.dirs if previous is not None else dict()
+        previous_ctimes = previous.ctimes if previous is not None else dict()
+        reused_dirs = list()
+        inodes_by_size = dict()
+        try:
+            pending = [(self.root, os.stat(self.root).st_mtime_ns)]
+        except OSError:
+            return
+        while pending:
+            dir_path, mtime = pending.pop()
+            known = previous_dirs.get(dir_path)
+            if known is not None and known[0] == mtime:
+                self.dirs_reused += 1
+                reused_dirs.append(dir_path)
+                _, sub_dirs, records = known
+                sub_dir_mtimes = self.stat_directories(sub_dirs)
+            else:
+                self.dirs_listed += 1
+                records, sub_dir_mtimes = self.list_directory(dir_path)
+            self.dirs[dir_path] = (mtime,
+                                   [sub_dir for sub_dir, _ in sub_dir_mtimes],
+                                   records)
+            for record in records:
+                inodes_by_size.setdefault(record.size, set()).add(
+                    walker.inode_key(record))
+                if not reused_dirs or reused_dirs[-1] != dir_path:
+                    yield record
+            pending.extend(reversed(sub_dir_mtimes))
+
+        stale = set()
+        for dir_path in reused_dirs:
+            mtime, sub_dirs, records = self.dirs[dir_path]
+            fresh_records = list()
+            for record in records:
+                ctime = previous_ctimes.get(record.path)
+                if len(inodes_by_size[record.size]) > 1:
+                    record = self.restat(record, ctime, stale)
+                else:
+                    self.ctimes[record.path] = ctime
+                if record is not None:
+                    fresh_records.append(record)
+            self.dirs[dir_path] = (mtime, sub_dirs, fresh_records)
+        for key in [key for key in self.digests if key[0] in stale]:
+            del self.digests[key]
+        for dir_path in reused_dirs:
+            yield from self.dirs[dir_path][2]
+
+    def restat(self, record, ctime, stale):
+        """
+        Stat a file of a reused directory again
+        - Expected value: its current FileRecord, None if it is gone
+        - ctime: its st_ctime_ns in the previous snapshot, the cache key of
+        the file is added to the stale set when its size and mtime are
+        unchanged but its ctime is not, e.g. a rewrite restoring the mtime
+        """
+        try:
+            stat = os.stat(record.path, follow_symlinks=False)
+        except OSError:
+            fileio.count('errors')
+            return None
+        self.files_restated += 1
+        fresh = walker.file_record(record.path, stat)
+        if fresh == record and stat.st_ctime_ns != ctime:
+            stale.add(checksum_cache.record_key(fresh))
+        self.ctimes[record.path] = stat.st_ctime_ns
+        return fresh
+
+    def list_directory(self, dir_path):
+        """
+        List a directory, see walker.list_directory()
+        - Expected value: (records, sub_dirs) with the FileRecords of its
+        files and the (path, mtime) of its sub-directories
+        """
+        files, sub_dirs = walker.list_directory(dir_path, self.show_hidden)
+        records = list()
+        for name, stat in files:
+            records.append(walker.file_record(os.path.join(dir_path, name),
+                                              stat))
+            self.ctimes[records[-1].path] = stat.st_ctime_ns
+        return records, self.stat_directories(sub_dirs)
+
+    def stat_directories(self, dir_paths):
+        """
+        Return the (path, mtime) of directories, the ones which cannot be
+        stat'ed are skipped
+        """
+        mtimes = list()
+        for dir_path in dir_paths:
+            try:
+                mtimes.append((dir_path, os.stat(
+                    dir_path, follow_symlinks=False).st_mtime_ns))
+            except OSError:
+                continue
+        return mtimes
+
+    def report(self):
+        """Return a one-line summary of the directories and digests reused"""
+        return 'Snapshot: %d directories reused, %d listed, ' \
+            '%d files stat\'ed again, %d digest hits, %d misses' % (
+                self.dirs_reused, self.dirs_listed, self.files_restated,
+                self.hits, self.misses)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import json
+import time
+from contextlib import contextmanager
+import fileio
+
+
+# Measures of a stage, in the order they are reported.
+FIELDS = ('runs', 'wall_seconds', 'cpu_seconds', 'files_in', 'files_out',
+          'bytes_read', 'files_opened', 'errors', 'throttled_seconds')
+
+
+class StageStats:
+    """
+    Measures of one stage of a scan, accumulated over all its runs
+    - wall_seconds/cpu_seconds: time spent in the stage, CPU time is the
+    one of the whole process, worker threads included
+    - files_in/files_out: files entering the stage and left for the next
+    one, set by the stage itself
+    - bytes_read/files_opened/errors/throttled_seconds: differences of
+    fileio.counters() while the stage runs, work done by a process pool is
+    not counted; throttled_seconds is the time threads slept waiting for
+    the read budget of fileio.configure()
+    """
+
+    def __init__(self, name):
+        self.name = name
+        for field in FIELDS:
+            setattr(self, field, 0)
+
+    def read_rate(self):
+        """Return the bytes read per second of wall time achieved"""
+        return self.bytes_read / self.wall_seconds if self.wall_seconds else 0
+
+    def as_dict(self):
+        """
+        Return the measures as a dictionary, with the stage name, the
+        read_rate achieved and the max_read_rate budget, None if unlimited
+        """
+        result = dict(stage=self.name)
+        for field in FIELDS:
+            result[field] = getattr(self, field)
+        result['read_rate'] = self.read_rate()
+        result['max_read_rate'] = fileio.max_read_rate()
+        return result
+
+
+class ScanStats:
+    """
+    Per-stage measures of a scan
+    - hook: optional callable called with the StageStats of a stage every
+    time a run of this stage ends, e.g. to export progress while scanning
+    """
+
+    def __init__(self, hook=None):
+        self.stages = dict()
+        self.hook = hook
+
+    def get(self, name):
+        """Return the StageStats of a stage, created on first use"""
+        if name not in self.stages:
+            self.stages[name] = StageStats(name)
+        return self.stages[name]
+
+    def start(self, name):
+        """Return the clocks and counters at the beginning of a run"""
+        return (self.get(name), time.perf_counter(), time.process_time(),
+                fileio.counters())
+
+    def stop(self, started):
+        """Add the measures of a run to its stage, see start()"""
+        stage, wall, cpu, counters = started
+        stage.wall_seconds += time.perf_counter() - wall
+        stage.cpu_seconds += time.process_time() - cpu
+        for name, value in fileio.counters().items():
+            setattr(stage, name,
+                    getattr(stage, name) + value - counters[name])
+
+    @contextmanager
+    def stage(self, name, files_in=0):
+        """
+        Context manager measuring one run of a stage
+        - Expected value: the StageStats of the stage, whose files_out is
+        to be increased by the caller
+        """
+        started = self.start(name)
+        started[0].files_in += files_in
+        try:
+            yield started[0]
+        finally:
+            self.stop(started)
+            started[0].runs += 1
+            if self.hook is not None:
+                self.hook(started[0])
+
+    def iter_stage(self, name, items):
+        """
+        Generator measuring the time spent producing items, such as the
+        records of a directory walk, each item counts as a file out
+        """
+        iterator = iter(items)
+        while True:
+            started = self.start(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                self.stop(started)
+            started[0].files_out += 1
+            yield item
+        started[0].runs += 1
+        if self.hook is not None:
+            self.hook(started[0])
+
+    def as_list(self):
+        """Return the measures of every stage, in order of first use"""
+        return [stage.as_dict() for stage in self.stages.values()]
+
+    def to_json(self):
+        """Return the measures of every stage as a JSON list"""
+        return json.dumps(self.as_list())
+
+    def format_table(self):
+        """
+        Return the measures of every stage as a text table, followed by the
+        read rate achieved by the stages which read files against the
+        budget when reads are limited, see fileio.configure()
+        """
+        lines = ['%-16s %6s %9s %9s %9s %9s %12s %8s %7s %8s %11s' % (
+            'stage', 'runs', 'wall(s)', 'cpu(s)', 'in', 'out', 'bytes read',
+            'opened', 'errors', 'MB/s', 'throttled')]
+        for stage in self.stages.values():
+            lines.append(
+                '%-16s %6d %9.3f %9.3f %9d %9d %12d %8d %7d %8.1f %11.3f' % (
+                    stage.name, stage.runs, stage.wall_seconds,
+                    stage.cpu_seconds, stage.files_in, stage.files_out,
+                    stage.bytes_read, stage.files_opened, stage.errors,
+                    stage.read_rate() / 1e6, stage.throttled_seconds))
+        budget = fileio.max_read_rate()
+        if budget:
+            reading = [stage for stage in self.stages.values()
+                       if stage.bytes_read]
+            wall = sum(stage.wall_seconds for stage in reading)
+            achieved = sum(stage.bytes_read for stage in reading) / wall \
+                if wall else 0
+            lines.append('read rate: %.1f MB/s of a %.1f MB/s budget '
+                         '(%.0f%%), %.3f s throttled' % (
+                             achieved / 1e6, budget / 1e6,
+                             100 * achieved / budget,
+                             sum(stage.throttled_seconds
+                                 for stage in reading)))
+        return "\n".join(lines) + "\n"
+
+
+# Stands for the StageStats of a disabled ScanStats, its measures are
+# never read.
+_DISABLED = StageStats('disabled')
+
+
+class _NullStage:
+    """Context manager of a disabled stage"""
+
+    def __enter__(self):
+        return _DISABLED
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def stage(scan_stats, name, files_in=0):
+    """
+    Return scan_stats.stage(name, files_in), or a context manager doing
+    nothing when scan_stats is None
+    """
+    if scan_stats is None:
+        return _NullStage()
+    return scan_stats.stage(name, files_in)
+
+
+def iter_stage(scan_stats, name, items):
+    """Return scan_stats.iter_stage(name, items), or items when None"""
+    if scan_stats is None:
+        return items
+    return scan_stats.iter_stage(name, items)
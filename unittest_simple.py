@@ -1,9 +1,35 @@
 #!/usr/bin/env python3
 import unittest
+import io
 import os
 import json
+import shutil
+import tempfile
+import another
+import benchmark
+import checksum_cache
+import compare
+import diskorder
+import external
+import fileio
+import filetable
+import generate_duplicate_files as gdf
+import hashlib
+import threading
+import hashers
+import logging
+import logs
+import manifest
+import server
+import snapshot
+import stats
+import walker
+import workers
+import watch
+import zlib
 import find_duplicate_files as fdf
 
+from functools import partial
 from subprocess import Popen, PIPE, run
 
 
@@ -152,3 +178,1116 @@ class FindDuplicateFilesTest(unittest.TestCase):
         self.assertIn(expected, result)
         # Empty file should not be in result
         self.assertNotIn(add_file, result)
+
+
+class ChecksumCacheTest(unittest.TestCase):
+    def setUp(self):
+        # Setup a directory with two identical files
+        self.DIR_NAME = tempfile.mkdtemp()
+        self.files = [os.path.join(self.DIR_NAME, name)
+                      for name in ('a', 'b')]
+        for name in self.files:
+            with open(name, 'wb') as fd:
+                fd.write(b'x' * 4096)
+        self.cache_path = os.path.join(self.DIR_NAME, '.cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_cache_hits_on_second_run(self):
+        cache = checksum_cache.ChecksumCache(self.cache_path)
+        first = fdf.find_duplicate_files(self.files, cache)
+        cache.close()
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        cache = checksum_cache.ChecksumCache(self.cache_path)
+        second = fdf.find_duplicate_files(self.files, cache)
+        cache.close()
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+        self.assertEqual(first, second)
+
+    def test_modified_file_is_rehashed(self):
+        cache = checksum_cache.ChecksumCache(self.cache_path)
+        another.check_duplicates(self.files, cache=cache,
+                                 compare_max_group=0)
+        cache.flush()
+        with open(self.files[1], 'wb') as fd:
+            fd.write(b'y' * 4096)
+        os.utime(self.files[1], ns=(0, 0))
+        result = another.check_duplicates(self.files, cache=cache,
+                                          compare_max_group=0)
+        cache.close()
+        self.assertEqual(result, [])
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+
+    def test_eviction_and_clear(self):
+        cache = checksum_cache.ChecksumCache(self.cache_path, max_entries=1)
+        fdf.find_duplicate_files(self.files, cache)
+        cache.flush()
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+
+class ParallelHashingTest(unittest.TestCase):
+    def setUp(self):
+        # Setup same-size files, some of them duplicates
+        self.DIR_NAME = tempfile.mkdtemp()
+        self.files = list()
+        for n in range(8):
+            name = os.path.join(self.DIR_NAME, 'file%d' % n)
+            with open(name, 'wb') as fd:
+                fd.write(bytes([n % 3]) * 8192)
+            self.files.append(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_threads_match_serial(self):
+        expected = fdf.find_duplicate_files(self.files)
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(fdf.find_duplicate_files(self.files, jobs=4),
+                         expected)
+        self.assertEqual(another.check_duplicates(self.files, jobs=4),
+                         another.check_duplicates(self.files))
+
+    def test_processes_match_serial(self):
+        self.assertEqual(
+            another.check_duplicates(self.files, jobs=2,
+                                     use_processes=True),
+            another.check_duplicates(self.files))
+
+    def test_one_pool_per_stage(self):
+        # Add 3 more sizes: the groups of a stage share one map_files()
+        for n in range(6):
+            name = os.path.join(self.DIR_NAME, 'other%d' % n)
+            with open(name, 'wb') as fd:
+                fd.write(b'y' * (100 + n // 2))
+            self.files.append(name)
+        calls = list()
+        map_files = workers.map_files
+
+        def counting_map_files(func, items, *args, **kwargs):
+            calls.append(len(items))
+            return map_files(func, items, *args, **kwargs)
+
+        workers.map_files = counting_map_files
+        try:
+            result = another.check_duplicates(self.files, jobs=4,
+                                              compare_max_group=0)
+        finally:
+            workers.map_files = map_files
+        self.assertEqual(len(result), 6)
+        self.assertEqual(calls, [14, 14])
+
+
+class ScanRecordsTest(unittest.TestCase):
+    def test_records_match_scan_files(self):
+        # Walker should list the same files as os.walk, in the same order
+        expected = list()
+        for (dir_path, dir_names, file_names) in os.walk('./TEST_DIR'):
+            file_names = [f for f in file_names if not f[0] == '.']
+            dir_names[:] = [d for d in dir_names if not d[0] == '.']
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                if not os.path.islink(file_path):
+                    expected.append(os.path.realpath(file_path))
+        self.assertEqual(fdf.scan_files('./TEST_DIR'), expected)
+
+    def test_records_hold_stat(self):
+        for record in walker.scan_records('./TEST_DIR/testcase'):
+            stat = os.stat(record.path)
+            self.assertEqual(record, walker.file_record(record.path, stat))
+
+    def test_records_give_same_groups_as_paths(self):
+        records = list(walker.scan_records('./TEST_DIR'))
+        paths = [record.path for record in records]
+        self.assertEqual(fdf.find_duplicate_files(records),
+                         fdf.find_duplicate_files(paths))
+        self.assertEqual(another.check_duplicates(records),
+                         another.check_duplicates(paths))
+
+    def test_parallel_scan(self):
+        for show_hidden in (False, True):
+            expected = list(walker.scan_records('./TEST_DIR', show_hidden))
+            self.assertEqual(list(walker.scan_records(
+                './TEST_DIR', show_hidden, jobs=4, ordered=True)), expected)
+            self.assertEqual(sorted(walker.scan_records(
+                './TEST_DIR', show_hidden, jobs=4)), sorted(expected))
+
+
+class HardlinkTest(unittest.TestCase):
+    def setUp(self):
+        # a and b are hardlinks, c is a copy of them, d and e are only
+        # hardlinks of each other
+        self.DIR_NAME = tempfile.mkdtemp()
+        self.path = dict((name, os.path.join(self.DIR_NAME, name))
+                         for name in 'abcde')
+        for name, content in (('a', b'1' * 2048), ('c', b'1' * 2048),
+                              ('d', b'2' * 2048)):
+            with open(self.path[name], 'wb') as fd:
+                fd.write(content)
+        os.link(self.path['a'], self.path['b'])
+        os.link(self.path['d'], self.path['e'])
+        self.files = [self.path[name] for name in 'abcde']
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_hardlinks_fan_out(self):
+        expected = [set(self.path[name] for name in 'abc')]
+        result = [set(group) for group in
+                  fdf.find_duplicate_files(self.files)]
+        self.assertEqual(result, expected)
+        result = [set(group) for group in
+                  another.check_duplicates(self.files)]
+        self.assertEqual(result, expected)
+
+    def test_inode_hashed_once(self):
+        cache = checksum_cache.ChecksumCache(':memory:')
+        fdf.find_duplicate_files(self.files, cache)
+        self.assertEqual(cache.misses, 3)
+
+    def test_hardlink_groups(self):
+        result = [set(group) for group in fdf.find_hardlinks(self.files)]
+        self.assertEqual(result, [{self.path['a'], self.path['b']},
+                                  {self.path['d'], self.path['e']}])
+
+    def test_finder_lists_one_link_per_inode(self):
+        finder = fdf.DuplicateFinder(self.DIR_NAME, hardlinks=True)
+        groups = [sorted(group.paths) for group in finder]
+        links = sorted(sorted(group) for group in finder.find_hardlinks())
+        self.assertEqual(links, [[self.path['a'], self.path['b']],
+                                 [self.path['d'], self.path['e']]])
+        self.assertEqual(len(groups), 1)
+        self.assertIn(self.path['c'], groups[0])
+        self.assertEqual(len(set(groups[0]) & {self.path['a'],
+                                                self.path['b']}), 1)
+
+
+class CompareFilesTest(unittest.TestCase):
+    def setUp(self):
+        # a, b and c share their first block, c differs at the end
+        self.DIR_NAME = tempfile.mkdtemp()
+        self.files = [os.path.join(self.DIR_NAME, name) for name in 'abc']
+        for name in self.files:
+            with open(name, 'wb') as fd:
+                fd.write(b'0' * 3000)
+                fd.write(b'2' if name.endswith('c') else b'1')
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_compare_splits_classes(self):
+        classes = compare.compare_files(self.files, block_size=1024)
+        self.assertEqual([items for _, items in classes], [self.files[:2]])
+        self.assertEqual(classes[0][0], fdf.get_file_checksum(self.files[0]))
+
+    def test_compare_matches_hashing(self):
+        self.assertEqual(fdf.find_duplicate_files(self.files),
+                         fdf.find_duplicate_files(self.files,
+                                                  compare_max_group=0))
+        self.assertEqual(another.check_duplicates(self.files),
+                         another.check_duplicates(self.files,
+                                                  compare_max_group=0))
+
+
+class StagePipelineTest(unittest.TestCase):
+    def setUp(self):
+        # Files share their head, b differs in the middle, c is 1 byte
+        # longer with an equal first 1k
+        self.DIR_NAME = tempfile.mkdtemp()
+        self.path = dict((name, os.path.join(self.DIR_NAME, name))
+                         for name in 'abcde')
+        contents = {'a': b'0' * 8192, 'b': b'0' * 4000 + b'1' + b'0' * 4191,
+                    'c': b'0' * 8193, 'd': b'0' * 8192, 'e': b'0' * 8193}
+        for name, content in contents.items():
+            with open(self.path[name], 'wb') as fd:
+                fd.write(content)
+        self.files = [self.path[name] for name in 'abcde']
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_parse_stages(self):
+        self.assertEqual(another.parse_stages('size,1k,tail:10,content'),
+                         ['size', 'head:1024', 'tail:10', 'content'])
+        self.assertRaises(ValueError, another.parse_stages, 'head:x')
+        self.assertRaises(ValueError, another.parse_stages, 'nothing')
+
+    def test_sizes_never_merge(self):
+        expected = [{self.path['a'], self.path['d']},
+                    {self.path['c'], self.path['e']}]
+        for stages in ('size,1k,content', 'size,head:64,tail:64,content',
+                       'size,sample:4,content', 'content'):
+            result = [set(group) for group in another.check_duplicates(
+                self.files, stages=stages, compare_max_group=0)]
+            self.assertEqual(sorted(result, key=sorted),
+                             sorted(expected, key=sorted))
+
+    def test_stage_counts(self):
+        counts = list()
+        another.check_duplicates(self.files, compare_max_group=0,
+                                 stages='size,sample:3,content',
+                                 stage_counts=counts)
+        self.assertEqual([(c['stage'], c['files_in'], c['eliminated'])
+                          for c in counts],
+                         [('size', 5, 0), ('sample:3', 5, 1),
+                          ('content', 4, 0)])
+
+    def test_unreadable_files_are_left_out(self):
+        records = list(walker.to_records(self.files))
+        os.remove(self.path['e'])
+        self.assertRaises(OSError, another.get_hash, self.path['e'])
+        self.assertRaises(OSError, fdf.get_file_checksum, self.path['e'])
+        errors = fileio.counters()['errors']
+        self.assertEqual(another.check_duplicates(records,
+                                                  compare_max_group=0),
+                         [[self.path['a'], self.path['d']]])
+        self.assertEqual(fileio.counters()['errors'], errors + 1)
+
+    def test_hashed_stages_use_the_requested_hash(self):
+        for compare_max_group in (0, 10):
+            groups = list(another.iter_duplicates(
+                self.files, hash=hashlib.sha256, prefilter_hash=hashlib.sha1,
+                compare_max_group=compare_max_group))
+            self.assertEqual(len(groups), 2)
+            for group in groups:
+                with open(group.paths[0], 'rb') as fd:
+                    self.assertEqual(group.digest,
+                                     hashlib.sha256(fd.read()).hexdigest())
+
+
+class FileIOTest(unittest.TestCase):
+    def setUp(self):
+        self.fd = tempfile.NamedTemporaryFile()
+        self.content = os.urandom(300000)
+        self.fd.write(self.content)
+        self.fd.flush()
+
+    def tearDown(self):
+        self.fd.close()
+
+    def test_hash_file_readinto_and_mmap(self):
+        expected = hashlib.md5(self.content).hexdigest()
+        for threshold in (fileio.MMAP_THRESHOLD, 1):
+            saved, fileio.MMAP_THRESHOLD = fileio.MMAP_THRESHOLD, threshold
+            try:
+                h = hashlib.md5()
+                self.assertEqual(fileio.hash_file(self.fd.name, h),
+                                 len(self.content))
+                self.assertEqual(h.hexdigest(), expected)
+            finally:
+                fileio.MMAP_THRESHOLD = saved
+
+    def test_partial_reads(self):
+        h = hashlib.md5()
+        with open(self.fd.name, 'rb', buffering=0) as fobj:
+            fileio.update_from_file(fobj, h, length=1000, block_size=256)
+        self.assertEqual(h.hexdigest(),
+                         hashlib.md5(self.content[:1000]).hexdigest())
+
+    def test_read_policy(self):
+        expected = hashlib.md5(self.content).hexdigest()
+        fileio.configure(drop_cache=True, direct_min_size=1)
+        try:
+            h = hashlib.md5()
+            self.assertEqual(fileio.hash_file(self.fd.name, h),
+                             len(self.content))
+            self.assertEqual(h.hexdigest(), expected)
+            self.assertEqual(another.get_hash(self.fd.name), expected)
+        finally:
+            fileio.configure()
+
+    def test_max_read_rate(self):
+        bucket = fileio.TokenBucket(1000000, burst=100000)
+        self.assertEqual(bucket.consume(100000), 0)
+        self.assertAlmostEqual(bucket.consume(200000), 0.2, delta=0.05)
+        fileio.configure(max_read_rate=2000000)
+        try:
+            throttled = fileio.counters()['throttled_seconds']
+            for _ in range(5):
+                fileio.hash_file(self.fd.name, hashlib.md5())
+            self.assertGreater(fileio.counters()['throttled_seconds'],
+                               throttled)
+            self.assertEqual(fileio.max_read_rate(), 2000000)
+        finally:
+            fileio.configure()
+        self.assertIsNone(fileio.max_read_rate())
+
+
+class HashRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        self.files = [os.path.join(self.DIR_NAME, name) for name in 'abcd']
+        for n, name in enumerate(self.files):
+            with open(name, 'wb') as fd:
+                fd.write(bytes([n % 2]) * 5000)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_blake2b_digest_size(self):
+        factory = hashers.get_hash_factory('blake2b-20')
+        self.assertEqual(len(factory().hexdigest()), 40)
+        self.assertEqual(hashers.hash_name(factory), 'blake2b-20')
+        self.assertRaises(ValueError, hashers.get_hash_factory, 'blake2b-99')
+        self.assertRaises(ValueError, hashers.get_hash_factory, 'unknown')
+
+    def test_crc32_prefilter(self):
+        factory = hashers.get_hash_factory('crc32')
+        hashobj = factory()
+        hashobj.update(b'head')
+        copy = hashobj.copy()
+        hashobj.update(memoryview(b'tail'))
+        self.assertEqual(hashobj.hexdigest(), '%08x' % zlib.crc32(b'headtail'))
+        self.assertEqual(copy.hexdigest(), '%08x' % zlib.crc32(b'head'))
+        if hashers.xxhash is None:
+            self.assertIs(hashers.default_prefilter_hash(), factory)
+
+    def test_optional_hash_falls_back(self):
+        factory = hashers.get_hash_factory('blake3')
+        self.assertIn(factory.name, ('blake3', hashers.FALLBACK_HASH))
+
+    def test_same_groups_whatever_hash(self):
+        expected = fdf.find_duplicate_files(self.files, compare_max_group=0)
+        for name in hashers.available_hashes():
+            factory = hashers.get_hash_factory(name)
+            self.assertEqual(fdf.find_duplicate_files(
+                self.files, compare_max_group=0, hash=factory), expected)
+            self.assertEqual(
+                [set(group) for group in another.check_duplicates(
+                    self.files, compare_max_group=0, hash=factory,
+                    prefilter_hash=hashers.default_prefilter_hash())],
+                [set(group) for group in expected])
+
+    def test_cache_kind_per_hash(self):
+        cache = checksum_cache.ChecksumCache(':memory:')
+        fdf.get_file_checksum(self.files[0], cache)
+        digest = fdf.get_file_checksum(
+            self.files[0], cache, hashers.get_hash_factory('sha1'))
+        self.assertEqual(len(digest), 40)
+        self.assertEqual(cache.hits, 0)
+
+
+class StreamingTest(unittest.TestCase):
+    def setUp(self):
+        # Three pairs of duplicates of different sizes
+        self.DIR_NAME = tempfile.mkdtemp()
+        self.files = list()
+        for n in range(6):
+            name = os.path.join(self.DIR_NAME, 'file%d' % n)
+            with open(name, 'wb') as fd:
+                fd.write(b'z' * (1000 + n // 2))
+            self.files.append(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_groups_are_generated_with_size_and_digest(self):
+        groups = fdf.iter_duplicate_files(self.files, batch_files=1)
+        first = next(groups)
+        self.assertEqual(first.digest, fdf.get_file_checksum(first.paths[0]))
+        self.assertEqual(first.size, os.path.getsize(first.paths[0]))
+        self.assertEqual(len(list(groups)), 2)
+
+    def test_bonus_batches_give_same_groups(self):
+        expected = another.check_duplicates(self.files)
+        groups = list(another.iter_duplicates(self.files, batch_files=1))
+        self.assertEqual([group.paths for group in groups], expected)
+        self.assertTrue(all(group.digest for group in groups))
+
+    def test_write_ndjson(self):
+        stream = io.StringIO()
+        count = fdf.write_ndjson(fdf.iter_duplicate_files(self.files),
+                                 stream)
+        lines = [json.loads(line) for line in
+                 stream.getvalue().splitlines()]
+        self.assertEqual(count, 3)
+        self.assertEqual(sorted(line['size'] for line in lines),
+                         [1000, 1001, 1002])
+
+
+class GenerateFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def generate(self, name, **kwargs):
+        root_path = os.path.join(self.DIR_NAME, name)
+        files = gdf.generate_files(20, directory_max_depth=2,
+                                   file_min_size=1000, file_max_size=50000,
+                                   root_path=root_path, seed=7, **kwargs)
+        result = list()
+        for file_path_name, file_size in files:
+            with open(file_path_name, 'rb') as fd:
+                content = fd.read()
+            self.assertEqual(len(content), file_size)
+            result.append((os.path.relpath(file_path_name, root_path),
+                           hashlib.md5(content).hexdigest()))
+        return files, result
+
+    def test_seed_gives_same_tree_whatever_the_jobs(self):
+        self.assertEqual(self.generate('a')[1], self.generate('b', jobs=2)[1])
+
+    def test_fixed_sizes_and_hardlinks(self):
+        files, _ = self.generate('a', size_distribution='fixed',
+                                 file_sizes=[1024, 4096],
+                                 duplicate_method='hardlink')
+        self.assertEqual({size for _, size in files}, {1024, 4096})
+        groups = fdf.find_hardlinks([path for path, _ in files])
+        self.assertTrue(groups)
+        self.assertEqual(sum(len(group) for group in groups),
+                         sum(1 for path, _ in files
+                             if os.stat(path).st_nlink > 1))
+
+    def test_reflink_without_fcntl(self):
+        fcntl, gdf.fcntl = gdf.fcntl, None
+        try:
+            self.assertRaises(ValueError, self.generate, 'a',
+                              duplicate_method='reflink')
+            self.assertFalse(os.path.exists(os.path.join(self.DIR_NAME, 'a')))
+        finally:
+            gdf.fcntl = fcntl
+
+
+class BenchmarkTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_corpus_is_reproducible(self):
+        corpora = list()
+        for name in ('a', 'b'):
+            files = benchmark.generate_corpus(
+                'identical_prefix', os.path.join(self.DIR_NAME, name),
+                seed=1, scale=0.05)
+            corpora.append([(os.path.relpath(path, self.DIR_NAME)[1:], size)
+                            for path, size in files])
+        self.assertEqual(corpora[0], corpora[1])
+
+    def test_run_scan_measures(self):
+        benchmark.generate_corpus('high_duplicates', self.DIR_NAME,
+                                  scale=0.02)
+        for bonus in (False, True):
+            result = benchmark.run_scan(self.DIR_NAME, bonus=bonus)
+            self.assertEqual(result['files'], 8)
+            self.assertGreater(result['groups'], 0)
+            self.assertGreater(result['bytes_read'], 0)
+
+
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        gdf.generate_files(30, directory_max_depth=1, file_min_size=1000,
+                           file_max_size=1010, duplicate_file_ratio=0.5,
+                           root_path=self.DIR_NAME, seed=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_stages_are_measured(self):
+        scan_stats = stats.ScanStats()
+        result = fdf.find_duplicate_files(
+            walker.scan_records(self.DIR_NAME), scan_stats=scan_stats)
+        measures = dict((stage['stage'], stage)
+                        for stage in scan_stats.as_list())
+        self.assertEqual(list(measures)[:2], ['scan', 'size'])
+        self.assertEqual(measures['scan']['files_out'], 30)
+        self.assertEqual(measures['size']['files_in'], 30)
+        self.assertEqual(sum(stage['files_out'] for name, stage
+                             in measures.items()
+                             if name in ('compare', 'content')),
+                         sum(len(group) for group in result))
+        self.assertGreater(sum(stage['bytes_read']
+                               for stage in measures.values()), 0)
+
+    def test_hook_sees_every_bonus_stage(self):
+        seen = set()
+        scan_stats = stats.ScanStats(hook=lambda stage: seen.add(stage.name))
+        another.check_duplicates(walker.scan_records(self.DIR_NAME),
+                                 compare_max_group=0, scan_stats=scan_stats)
+        self.assertEqual(seen, {'scan', 'size', 'head:1024', 'content'})
+        self.assertIn('bytes read', scan_stats.format_table())
+
+
+class DiskOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        gdf.generate_files(40, directory_max_depth=2, file_min_size=1000,
+                           file_max_size=1100, duplicate_file_ratio=0.5,
+                           root_path=self.DIR_NAME, seed=4)
+        self.records = list(walker.scan_records(self.DIR_NAME))
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_read_batches_cover_every_file(self):
+        for io_order in diskorder.IO_ORDERS:
+            batches = diskorder.read_batches(self.records, io_order)
+            self.assertEqual(sorted(index for batch in batches
+                                    for index in batch),
+                             list(range(len(self.records))))
+        inodes = [self.records[index].ino for index in
+                  diskorder.read_batches(self.records, 'inode')[0]]
+        self.assertEqual(inodes, sorted(inodes))
+
+    def test_same_groups_whatever_the_order(self):
+        expected = None
+        for io_order in diskorder.IO_ORDERS:
+            result = sorted(sorted(group) for group in
+                            fdf.find_duplicate_files(
+                                self.records, compare_max_group=0,
+                                io_order=io_order))
+            expected = expected or result
+            self.assertEqual(result, expected)
+            result = sorted(sorted(group) for group in
+                            another.check_duplicates(self.records,
+                                                     io_order=io_order))
+            self.assertEqual(result, expected)
+
+
+class FileTableTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        gdf.generate_files(40, directory_max_depth=2, file_min_size=0,
+                           file_max_size=30, duplicate_file_ratio=0.5,
+                           root_path=self.DIR_NAME, seed=5)
+        self.records = list(walker.scan_records(self.DIR_NAME))
+        self.table = filetable.scan_table(self.DIR_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_table_holds_the_records(self):
+        self.assertEqual(len(self.table), len(self.records))
+        self.assertEqual(list(self.table), self.records)
+        self.assertEqual(list(filetable.FileTable.from_records(self.records)),
+                         self.records)
+
+    def test_size_groups(self):
+        expected = sorted(sorted(record.path for record in group) for group
+                          in fdf.group_files_by_size(self.records))
+        groups = [sorted(self.table.path(index) for index in indexes)
+                  for indexes in self.table.size_groups()]
+        self.assertEqual(sorted(groups), expected)
+        sizes = [self.table.sizes[indexes[0]]
+                 for indexes in self.table.size_groups(min_size=0)]
+        self.assertEqual(sizes, sorted(sizes))
+
+    def test_same_duplicates_as_records(self):
+        for find in (fdf.find_duplicate_files, another.check_duplicates):
+            self.assertEqual(
+                sorted(sorted(group) for group in find(self.table)),
+                sorted(sorted(group) for group in find(self.records)))
+
+
+class ExternalTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        gdf.generate_files(200, directory_max_depth=2, file_min_size=0,
+                           file_max_size=300, duplicate_file_ratio=0.5,
+                           root_path=self.DIR_NAME, seed=6)
+        self.records = list(walker.scan_records(self.DIR_NAME))
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_sorter_merges_runs(self):
+        items = [(value * 7919 % 1000, str(value)) for value in range(1000)]
+        saved, external.MERGE_FAN_IN = external.MERGE_FAN_IN, 4
+        try:
+            sorter = external.ExternalSorter(self.DIR_NAME, max_entries=30)
+            for item in items:
+                sorter.add(item)
+            self.assertEqual(list(sorter), sorted(items))
+        finally:
+            external.MERGE_FAN_IN = saved
+
+    def test_same_groups_as_in_memory(self):
+        for stages, find in ((None, fdf.find_duplicate_files),
+                             (another.DEFAULT_STAGES,
+                              another.check_duplicates),
+                             (['size', 'head:16', 'tail:16'],
+                              partial(another.check_duplicates,
+                                      stages=['size', 'head:16',
+                                              'tail:16']))):
+            groups = external.iter_duplicates(
+                iter(self.records), max_memory=4096, stages=stages,
+                work_dir=self.DIR_NAME, batch_files=16)
+            self.assertEqual(sorted(sorted(group.paths) for group in groups),
+                             sorted(sorted(group)
+                                    for group in find(self.records)))
+        self.assertEqual(os.listdir(self.DIR_NAME).count('paths'), 0)
+
+    def test_size_chunks_of_exactly_batch_files(self):
+        entries = [(1, 'a'), (1, 'b'), (2, 'c'), (3, 'd'), (3, 'e')]
+        self.assertEqual(list(external.size_chunks(entries, batch_files=2)),
+                         [[(1, 'a'), (1, 'b')], [(3, 'd'), (3, 'e')]])
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        for sub_dir in ('x', 'y'):
+            os.mkdir(os.path.join(self.DIR_NAME, sub_dir))
+            for name in ('a', 'b'):
+                with open(os.path.join(self.DIR_NAME, sub_dir, name),
+                          'wb') as fd:
+                    fd.write(b'snapshot' * 100)
+        self.snapshot_path = tempfile.mktemp(suffix='.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+        os.remove(self.snapshot_path)
+
+    def scan(self):
+        previous = snapshot.Snapshot.load(self.snapshot_path, self.DIR_NAME)
+        current = snapshot.Snapshot(self.DIR_NAME, digests=previous.digests)
+        result = fdf.find_duplicate_files(current.scan_records(previous),
+                                          cache=current)
+        current.save(self.snapshot_path)
+        return current, [sorted(group) for group in result]
+
+    def test_unchanged_directories_are_reused(self):
+        first, expected = self.scan()
+        self.assertEqual((first.dirs_listed, first.dirs_reused), (3, 0))
+        second, result = self.scan()
+        self.assertEqual((second.dirs_listed, second.dirs_reused), (0, 3))
+        self.assertEqual(second.misses, 0)
+        self.assertEqual(result, expected)
+
+    def test_new_file_is_merged(self):
+        self.scan()
+        new_file = os.path.join(self.DIR_NAME, 'y', 'c')
+        with open(new_file, 'wb') as fd:
+            fd.write(b'snapshot' * 100)
+        current, result = self.scan()
+        self.assertEqual((current.dirs_listed, current.dirs_reused), (1, 2))
+        self.assertEqual(current.misses, 1)
+        self.assertEqual(len(result), 1)
+        self.assertIn(new_file, result[0])
+        self.assertEqual(len(result[0]), 5)
+
+    def test_rewritten_file_is_not_a_false_duplicate(self):
+        self.scan()
+        rewritten = os.path.join(self.DIR_NAME, 'x', 'a')
+        with open(rewritten, 'r+b') as fd:
+            fd.write(b'rewritten')
+        current, result = self.scan()
+        self.assertEqual(current.dirs_reused, 3)
+        self.assertEqual(current.files_restated, 4)
+        self.assertEqual(len(result[0]), 3)
+        self.assertNotIn(rewritten, result[0])
+        # Same size and mtime restored: only the ctime tells it changed
+        with open(rewritten, 'r+b') as fd:
+            fd.write(b'snapshots')
+        self.assertEqual(len(self.scan()[1][0]), 4)
+        stat = os.stat(rewritten)
+        with open(rewritten, 'r+b') as fd:
+            fd.write(b'rewritten')
+        os.utime(rewritten, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        current, result = self.scan()
+        self.assertNotIn(rewritten, result[0])
+
+
+class DuplicateFinderTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        gdf.generate_files(100, directory_max_depth=2, file_min_size=0,
+                           file_max_size=300, duplicate_file_ratio=0.5,
+                           root_path=self.DIR_NAME, seed=8)
+        self.records = list(walker.scan_records(self.DIR_NAME))
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_same_groups_as_functions(self):
+        for bonus, find in ((False, fdf.find_duplicate_files),
+                            (True, another.check_duplicates)):
+            finder = fdf.DuplicateFinder(self.DIR_NAME, bonus=bonus)
+            self.assertEqual(sorted(sorted(group.paths) for group in finder),
+                             sorted(sorted(group)
+                                    for group in find(self.records)))
+
+    def test_roots(self):
+        sub_dirs = [entry.path for entry in os.scandir(self.DIR_NAME)
+                    if entry.is_dir()]
+        self.assertEqual(fdf.distinct_roots(
+            [sub_dirs[0], self.DIR_NAME, sub_dirs[0], self.DIR_NAME + '/']),
+            [self.DIR_NAME])
+        finder = fdf.DuplicateFinder(sub_dirs + [sub_dirs[0]])
+        expected = fdf.find_duplicate_files(
+            [record for record in self.records
+             if os.path.dirname(record.path) != self.DIR_NAME])
+        self.assertEqual(sorted(sorted(group.paths) for group in finder),
+                         sorted(sorted(group) for group in expected))
+        with self.assertRaises(ValueError):
+            fdf.DuplicateFinder(os.path.join(self.DIR_NAME, 'missing'))
+
+    def test_progress_and_cancel(self):
+        stages = list()
+        groups = list(fdf.DuplicateFinder(
+            self.DIR_NAME, bonus=True,
+            progress=lambda stage: stages.append(stage.name)))
+        self.assertTrue(groups)
+        self.assertEqual(stages[0], 'scan')
+        self.assertIn('content', stages)
+        finder = fdf.DuplicateFinder(self.DIR_NAME, cancel=lambda: True)
+        self.assertEqual(list(finder), [])
+        self.assertTrue(finder.cancelled)
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        gdf.generate_files(150, directory_max_depth=2, file_min_size=0,
+                           file_max_size=2000, duplicate_file_ratio=0.5,
+                           root_path=self.DIR_NAME, seed=9)
+        self.nodes = sorted(entry.path for entry in os.scandir(self.DIR_NAME)
+                            if entry.is_dir())
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_single_node_needs_no_work(self):
+        node = manifest.scan_node(self.DIR_NAME, 'node')
+        manifest_path = os.path.join(self.DIR_NAME, 'node.gz')
+        node.save(manifest_path)
+        groups, work = manifest.merge([manifest.Manifest.load(manifest_path)])
+        self.assertEqual(work, {'node': []})
+        self.assertEqual(sorted(sorted(path.split(':', 1)[1]
+                                       for path in group.paths)
+                                for group in groups),
+                         sorted(sorted(group) for group in
+                                another.check_duplicates(
+                                    list(walker.scan_records(
+                                        self.DIR_NAME)))))
+
+    def test_merge_across_nodes(self):
+        nodes = [manifest.scan_node(path, str(index))
+                 for index, path in enumerate(self.nodes)]
+        hashed = sum(1 for node in nodes for entry in node.files if entry[6])
+        rounds = 0
+        while True:
+            groups, work = manifest.merge(nodes)
+            if not any(work.values()):
+                break
+            for node in nodes:
+                manifest.hash_work(node, work[node.node])
+            rounds += 1
+        self.assertLessEqual(rounds, len(nodes[0].stages) - 1)
+        self.assertLess(hashed, sum(len(node.files) for node in nodes))
+        records = [record for path in self.nodes
+                   for record in walker.scan_records(path)]
+        self.assertEqual(sorted(sorted(path.split(':', 1)[1]
+                                       for path in group.paths)
+                                for group in groups),
+                         sorted(sorted(group) for group in
+                                another.check_duplicates(records)))
+
+
+class LogsTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.DIR_NAME, 'dff.log')
+        self.logger = logging.getLogger(logs.LOGGER_NAME)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            if not isinstance(handler, logging.NullHandler):
+                self.logger.removeHandler(handler)
+                handler.close()
+        self.logger.setLevel(logging.NOTSET)
+        self.logger.propagate = True
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_off_by_default(self):
+        self.assertFalse(logs.get_logger('another').isEnabledFor(
+            logging.INFO))
+        another.check_duplicates(['./TEST_DIR/testcase'])
+        self.assertEqual(os.listdir(self.DIR_NAME), [])
+
+    def test_records_sampled_and_rotated(self):
+        logs.configure(self.log_path, 'debug', max_bytes=1000,
+                       backup_count=5, sample_every=10)
+        logger = logs.get_logger('test')
+        for index in range(100):
+            logger.debug('group', extra=logs.fields(sampled=True,
+                                                    index=index))
+        logger.info('stage', extra=logs.fields(files_in=100))
+        self.assertEqual(sorted(os.listdir(self.DIR_NAME)),
+                         ['dff.log', 'dff.log.1'])
+        self.assertLessEqual(os.path.getsize(self.log_path + '.1'), 1000)
+        records = list()
+        for name in ('dff.log.1', 'dff.log'):
+            with open(os.path.join(self.DIR_NAME, name)) as fd:
+                records.extend(json.loads(line) for line in fd)
+        self.assertEqual([record['index'] for record in records[:-1]],
+                         list(range(0, 100, 10)))
+        self.assertEqual(records[-1]['event'], 'stage')
+        self.assertEqual(records[-1]['files_in'], 100)
+
+
+@unittest.skipIf(watch._libc is None, 'inotify is not available')
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.DIR_NAME, 'a'))
+        self.write('a/x', b'hello')
+        self.write('y', b'hello')
+        self.write('unique', b'unique size')
+        self.watcher = watch.Watcher(self.DIR_NAME)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.DIR_NAME)
+
+    def write(self, name, data):
+        with open(os.path.join(self.DIR_NAME, name), 'wb') as fd:
+            fd.write(data)
+
+    def events(self):
+        return [(event.event, [os.path.relpath(path, self.DIR_NAME)
+                               for path in event.paths])
+                for event in self.watcher.poll(1)]
+
+    def test_groups_follow_changes(self):
+        self.assertEqual([event.event for event in self.watcher.start()],
+                         ['new'])
+        self.assertEqual(self.watcher.index.files_hashed, 2)
+        self.write('z', b'world')
+        self.assertEqual(self.events(), [])
+        os.mkdir(os.path.join(self.DIR_NAME, 'c'))
+        self.write('c/z', b'world')
+        self.assertEqual(self.events(), [('new', ['c/z', 'z'])])
+        self.assertEqual(self.watcher.index.files_hashed, 4)
+        os.rename(os.path.join(self.DIR_NAME, 'a'),
+                  os.path.join(self.DIR_NAME, 'b'))
+        self.assertEqual(self.events(), [('updated', ['b/x', 'y'])])
+        self.assertEqual(self.watcher.index.files_hashed, 4)
+        os.remove(os.path.join(self.DIR_NAME, 'y'))
+        self.assertEqual(self.events(), [('dissolved', ['b/x', 'y'])])
+        self.write('c/z', b'other')
+        self.assertEqual(self.events(), [('dissolved', ['c/z', 'z'])])
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        self.root = os.path.join(self.DIR_NAME, 'root')
+        gdf.generate_files(100, directory_max_depth=2, file_min_size=1,
+                           file_max_size=3000, duplicate_file_ratio=0.3,
+                           root_path=self.root, seed=10)
+        self.records = list(walker.scan_records(self.root))
+        self.index = server.StoreIndex()
+        self.index.build(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_lookups(self):
+        record = self.records[0]
+        incoming = os.path.join(self.DIR_NAME, 'incoming')
+        shutil.copy(record.path, incoming)
+        digest = fdf.get_file_checksum(record)
+        expected = sorted(other.path for other in self.records
+                          if other.size == record.size
+                          and fdf.get_file_checksum(other) == digest)
+        lookup_server = server.make_server(self.index)
+        thread = threading.Thread(target=lookup_server.serve_forever)
+        thread.start()
+        client = server.Client(*lookup_server.server_address[:2])
+        try:
+            results = client.lookup([
+                {'path': incoming},
+                {'size': record.size, 'digest': digest},
+                {'size': record.size, 'digest': '0' * 32},
+                {'path': os.path.join(self.DIR_NAME, 'missing')}])
+            self.assertEqual(sorted(results[0]['paths']), expected)
+            self.assertEqual(results[0]['digest'], digest)
+            self.assertEqual(sorted(results[1]['paths']), expected)
+            self.assertEqual([result.get('stored') for result in results],
+                             [True, True, False, None])
+            self.assertIn('error', results[3])
+            with open(os.path.join(self.DIR_NAME, 'new'), 'wb') as fd:
+                fd.write(b'x' * 5000)
+            self.assertFalse(client.lookup([{'path': fd.name}])[0]['stored'])
+            self.assertEqual(client.add([fd.name]), 1)
+            shutil.copy(fd.name, incoming)
+            self.assertEqual(client.lookup([{'path': incoming}])[0]['paths'],
+                             [fd.name])
+        finally:
+            client.close()
+            lookup_server.shutdown()
+            lookup_server.server_close()
+
+    def test_lookups_never_read_the_stored_tree(self):
+        incoming = os.path.join(self.DIR_NAME, 'incoming')
+        opened = list()
+        open_file = fileio.open_file
+
+        def recording_open_file(path, *args, **kwargs):
+            opened.append(path)
+            return open_file(path, *args, **kwargs)
+
+        fileio.open_file = recording_open_file
+        try:
+            for record in self.records:
+                shutil.copy(record.path, incoming)
+                result = self.index.query({'path': incoming})
+                self.assertIn(record.path, result['paths'])
+                self.assertEqual(self.index.query(
+                    {'size': record.size, 'digest': result['digest']})[
+                        'paths'], result['paths'])
+        finally:
+            fileio.open_file = open_file
+        self.assertTrue(opened)
+        self.assertEqual([path for path in opened
+                          if path.startswith(self.root + os.sep)], [])
+
+    def test_lookups_with_cache(self):
+        cache = checksum_cache.ChecksumCache(
+            os.path.join(self.DIR_NAME, 'cache.sqlite'),
+            check_same_thread=False)
+        index = server.StoreIndex(cache=cache)
+        index.build(self.root)
+        record = max(self.records, key=lambda record: (
+            sum(other.size == record.size for other in self.records) == 1,
+            record.size))
+        digest = fdf.get_file_checksum(record)
+        lookup_server = server.make_server(index)
+        thread = threading.Thread(target=lookup_server.serve_forever)
+        thread.start()
+        client = server.Client(*lookup_server.server_address[:2])
+        try:
+            results = client.lookup([{'path': record.path},
+                                     {'size': record.size, 'digest': digest}])
+            self.assertEqual([result['paths'] for result in results],
+                             [[], [record.path]])
+            self.assertGreater(cache.stores, 0)
+        finally:
+            client.close()
+            lookup_server.shutdown()
+            lookup_server.server_close()
+            cache.close()
+
+
+class ApproximateTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        data = os.urandom(2 * 1024 * 1024)
+        middle = len(data) // 2 + 5
+        for name, content in (('a', data), ('b', data),
+                              ('c', data[:middle] + b'X' + data[middle + 1:]),
+                              ('d', data[:1024 * 1024])):
+            with open(os.path.join(self.DIR_NAME, name), 'wb') as fd:
+                fd.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_reads_fixed_blocks_then_verifies(self):
+        finder = fdf.DuplicateFinder(self.DIR_NAME, approximate=4,
+                                     collect_stats=True)
+        groups = [sorted(os.path.basename(path) for path in group.paths)
+                  for group in finder]
+        self.assertFalse(finder.verified)
+        self.assertEqual(groups, [['a', 'b', 'c']])
+        self.assertEqual(finder.scan_stats.get('sample:4').bytes_read,
+                         3 * 4 * another.SAMPLE_BLOCK_SIZE)
+        groups_path = os.path.join(self.DIR_NAME, 'groups.ndjson')
+        with open(groups_path, 'w') as fd:
+            fdf.write_ndjson(fdf.DuplicateFinder(self.DIR_NAME,
+                                                 approximate=4),
+                             fd, extra={'verified': False})
+        verified = fdf.verify_groups(fdf.load_groups(groups_path))
+        self.assertEqual([sorted(os.path.basename(path)
+                                 for path in group.paths)
+                          for group in verified], [['a', 'b']])
+
+    def test_verify_keeps_exact_duplicates(self):
+        exact = os.path.join(self.DIR_NAME, 'exact')
+        os.mkdir(exact)
+        for name, content in (('e1', b''), ('e2', b''), ('s1', b'small'),
+                              ('s2', b'small'), ('l1', b'L' * 300000),
+                              ('l2', b'L' * 300000)):
+            with open(os.path.join(exact, name), 'wb') as fd:
+                fd.write(content)
+        approximate = sorted(sorted(group.paths) for group
+                             in fdf.DuplicateFinder(exact, approximate=4))
+        self.assertEqual(len(approximate), 3)
+        cache = checksum_cache.ChecksumCache(
+            os.path.join(self.DIR_NAME, 'cache.sqlite'))
+        for _ in range(2):
+            verified = sorted(sorted(group.paths) for group in
+                              fdf.verify_groups(approximate, cache=cache,
+                                                compare_max_group=0))
+            self.assertEqual(verified, approximate)
+        cache.close()
+        self.assertGreater(cache.hits, 0)
+
+
+class ReferenceTest(unittest.TestCase):
+    def setUp(self):
+        self.DIR_NAME = tempfile.mkdtemp()
+        self.archive = os.path.join(self.DIR_NAME, 'archive')
+        self.drop = os.path.join(self.DIR_NAME, 'drop')
+        gdf.generate_files(200, directory_max_depth=2, file_min_size=1,
+                           file_max_size=5000, duplicate_file_ratio=0.5,
+                           root_path=self.archive, seed=11)
+        os.mkdir(self.drop)
+        self.archived = sorted(record.path for record
+                               in walker.scan_records(self.archive))
+        for index, path in enumerate(self.archived[:10]):
+            shutil.copy(path, os.path.join(self.drop, 'copy%d' % index))
+        for index in range(5):
+            with open(os.path.join(self.drop, 'new%d' % index), 'wb') as fd:
+                fd.write(os.urandom(100 + index))
+        os.link(self.archived[20], os.path.join(self.drop, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR_NAME)
+
+    def test_only_candidates_with_a_reference(self):
+        matches = list(fdf.DuplicateFinder(self.drop, bonus=True,
+                                           reference=self.archive))
+        dropped = [os.path.join(self.drop, name)
+                   for name in os.listdir(self.drop)]
+        expected = dict()
+        for group in another.check_duplicates(self.archived + dropped):
+            for path in group:
+                if path.startswith(self.drop + os.sep):
+                    expected[path] = sorted(other for other in group
+                                            if other.startswith(
+                                                self.archive + os.sep))
+        found = dict()
+        for match in matches:
+            for path in match.paths:
+                found[path] = sorted(match.references)
+        link = os.path.join(self.drop, 'link')
+        self.assertEqual(found.pop(link), [self.archived[20]])
+        expected.pop(link, None)
+        self.assertEqual(found, expected)
+        self.assertEqual(len(found), 10)
+
+    def test_linked_reference_still_matches_copies(self):
+        reference = os.path.join(self.DIR_NAME, 'ref')
+        os.mkdir(reference)
+        with open(os.path.join(reference, 'r'), 'wb') as fd:
+            fd.write(os.urandom(3000))
+        os.link(os.path.join(reference, 'r'), os.path.join(self.drop, 'a'))
+        shutil.copy(os.path.join(reference, 'r'),
+                    os.path.join(self.drop, 'b'))
+        found = dict()
+        for match in fdf.DuplicateFinder(self.drop, bonus=True,
+                                         reference=reference):
+            for path in match.paths:
+                found[path] = match.references
+        self.assertEqual(found, {
+            os.path.join(self.drop, name): [os.path.join(reference, 'r')]
+            for name in 'ab'})
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import os
+import fileio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# Compact description of a scanned file, built from a single stat call.
+# mtime is st_mtime_ns.
+FileRecord = namedtuple('FileRecord', ['path', 'size', 'dev', 'ino', 'mtime'])
+
+
+def file_record(path, stat):
+    """Return the FileRecord of a path from its os.stat result"""
+    return FileRecord(path, stat.st_size, stat.st_dev, stat.st_ino,
+                      stat.st_mtime_ns)
+
+
+def record_path(item):
+    """Return the path of a FileRecord or of a plain path"""
+    if isinstance(item, FileRecord):
+        return item.path
+    return item
+
+
+def to_record(item):
+    """
+    Return item as a FileRecord
+    - item: FileRecord, returned as is, or file path which is stat'ed
+    - Raise OSError if the path cannot be stat'ed
+    """
+    if isinstance(item, FileRecord):
+        return item
+    return file_record(item, os.stat(item))
+
+
+def record_size(item):
+    """Return the size of a FileRecord, or of a path after stat'ing it"""
+    return to_record(item).size
+
+
+def to_records(items):
+    """
+    Generator converting paths or FileRecords to FileRecords
+    Paths which cannot be stat'ed any more are skipped
+    """
+    for item in items:
+        try:
+            yield to_record(item)
+        except OSError:
+            continue
+
+
+def list_directory(dir_path, show_hidden=False):
+    """
+    List one directory with os.scandir
+    - Expected value: (files, sub_dirs) with the (name, stat) of its regular
+    files and the paths of its sub-directories, in listing order
+    - The type of every entry comes from the listing and each file is
+    stat'ed exactly once
+    - Hidden files and directories are skipped unless show_hidden, symlinks
+    are neither returned nor followed, errors are counted in
+    fileio.counters() and ignored
+    """
+    files = list()
+    sub_dirs = list()
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if not show_hidden and entry.name[0] == '.':
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_dirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append((entry.name,
+                                      entry.stat(follow_symlinks=False)))
+                except OSError:
+                    fileio.count('errors')
+                    continue
+    except OSError:
+        fileio.count('errors')
+    return files, sub_dirs
+
+
+def scan_entries(path, show_hidden=False, jobs=1, ordered=True):
+    """
+    Generator walking a directory tree, see list_directory()
+    - Expected value: (dir_path, name, stat) of every regular file, with
+    the real path of its directory
+    - jobs > 1 lists directories concurrently with a pool of threads, which
+    hides the latency of network and FUSE file systems. Files then come in
+    the order their directory listing ends, unless ordered.
+    - With ordered, or a single job, files come in the same order as
+    os.walk
+    """
+    root = os.path.realpath(path)
+    if jobs > 1:
+        yield from _scan_entries_parallel(root, show_hidden, jobs, ordered)
+        return
+    pending = [root]
+    while pending:
+        dir_path = pending.pop()
+        files, sub_dirs = list_directory(dir_path, show_hidden)
+        for name, stat in files:
+            yield dir_path, name, stat
+        pending.extend(reversed(sub_dirs))
+
+
+def _scan_entries_parallel(root, show_hidden, jobs, ordered):
+    """
+    scan_entries() with jobs threads taking directories to list from a
+    shared queue, every sub-directory being queued as soon as it is found
+    """
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        if ordered:
+            listings = {root: executor.submit(list_directory, root,
+                                              show_hidden)}
+            pending = [root]
+            while pending:
+                dir_path = pending.pop()
+                files, sub_dirs = listings.pop(dir_path).result()
+                for sub_dir in sub_dirs:
+                    listings[sub_dir] = executor.submit(
+                        list_directory, sub_dir, show_hidden)
+                for name, stat in files:
+                    yield dir_path, name, stat
+                pending.extend(reversed(sub_dirs))
+            return
+        running = {executor.submit(list_directory, root, show_hidden): root}
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_path = running.pop(future)
+                files, sub_dirs = future.result()
+                for sub_dir in sub_dirs:
+                    running[executor.submit(list_directory, sub_dir,
+                                            show_hidden)] = sub_dir
+                for name, stat in files:
+                    yield dir_path, name, stat
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def scan_records(path, show_hidden=False, jobs=1, ordered=True):
+    """
+    Generator walking a directory tree, see scan_entries()
+    - Expected value: FileRecord of every regular file, with the real
+    path, in the same order as os.walk unless jobs > 1 and not ordered
+    """
+    for dir_path, name, stat in scan_entries(path, show_hidden, jobs,
+                                             ordered):
+        yield file_record(os.path.join(dir_path, name), stat)
+
+
+def inode_key(record):
+    """Return the (dev, ino) identity shared by hardlinks of a file"""
+    return (record.dev, record.ino)
+
+
+def collapse_hardlinks(items):
+    """
+    Collapse paths or FileRecords pointing to the same inode
+    - Expected value: (records, links) where records holds one FileRecord
+    per distinct (dev, ino), in order of first appearance, and links maps
+    each (dev, ino) to every item sharing it
+    - Items which cannot be stat'ed any more are skipped
+    """
+    records = list()
+    links = dict()
+    for item in items:
+        try:
+            record = to_record(item)
+        except OSError:
+            continue
+        key = inode_key(record)
+        if key not in links:
+            links[key] = list()
+            records.append(record)
+        links[key].append(item)
+    return records, links
+
+
+def count_inodes(records):
+    """Return the number of distinct inodes in a list of FileRecords"""
+    return len(set(inode_key(record) for record in records))
+
+
+def hardlink_groups(items):
+    """
+    Return groups of paths which are hardlinks of the same non-empty file
+    - Expected value: list of lists of paths, each with at least 2 paths
+    """
+    records, links = collapse_hardlinks(items)
+    return [[record_path(item) for item in links[inode_key(record)]]
+            for record in records
+            if record.size > 0 and len(links[inode_key(record)]) > 1]
+
+
+# Confirmed group of duplicate files, digest is None when the group was not
+# confirmed by a content hash.
+DuplicateGroup = namedtuple('DuplicateGroup', ['size', 'digest', 'paths'])
+
+# Files of a candidate tree whose content is found in a reference tree,
+# see another.iter_reference_matches().
+ReferenceMatch = namedtuple('ReferenceMatch',
+                            ['size', 'digest', 'paths', 'references'])
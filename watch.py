@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import select
+import stat
+import struct
+import sys
+from collections import namedtuple
+import checksum_cache
+import hashers
+import logs
+import walker
+import workers
+import find_duplicate_files as fdf
+
+
+logger = logs.get_logger('watch')
+
+# inotify event flags, see inotify(7).
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+# Events watched on every directory of the tree.
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+              | IN_EXCL_UNLINK)
+
+# struct inotify_event header, followed by len bytes of name.
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Bytes read from the inotify descriptor at once.
+READ_SIZE = 64 * 1024
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+
+
+# Change of a group of duplicates: event is 'new' when the files of a
+# (size, digest) become duplicates, 'updated' when the paths of a group
+# change and 'dissolved' when fewer than 2 inodes are left, with the paths
+# last reported.
+GroupEvent = namedtuple('GroupEvent', ['event', 'size', 'digest', 'paths'])
+
+
+class Inotify:
+    """
+    Linux inotify descriptor, used through ctypes
+    - Raise OSError when inotify is not available
+    """
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Watch a directory, return its watch descriptor"""
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """Stop watching a watch descriptor, errors are ignored"""
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever when None) for events
+        - Expected value: list of (wd, mask, cookie, name) of every queued
+        event, empty on timeout
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return list()
+        events = list()
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data,
+                                                                     offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, cookie, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DuplicateIndex:
+    """
+    In-memory index of duplicates, updated file by file
+    The index maps sizes to paths, and (size, digest) keys to paths. Files
+    are only hashed once their size collides with a file of another inode,
+    the digests of hardlinks and of files renamed in the same batch of
+    changes are reused. Files of 0 bytes are ignored, as in
+    find_duplicate_files().
+    add(), update() and remove() only record changes, changes() hashes
+    what they require and reports the groups which changed.
+    """
+
+    def __init__(self, hash=hashlib.md5, cache=None, jobs=1,
+                 use_processes=False):
+        self.hash = hash
+        self.cache = cache
+        self.jobs = jobs
+        self.use_processes = use_processes
+        self.records = dict()
+        self.by_size = dict()
+        self.digests = dict()
+        self.by_digest = dict()
+        self.reported = dict()
+        self.pending = set()
+        self.dirty = set()
+        self.recent = dict()
+        self.files_hashed = 0
+
+    def add(self, record):
+        """Index a walker.FileRecord, replacing the file of the same path"""
+        self.remove(record.path)
+        if record.size < 1:
+            return
+        self.records[record.path] = record
+        self.by_size.setdefault(record.size, set()).add(record.path)
+        self.pending.add(record.size)
+
+    def update(self, path):
+        """Stat a path again and index its new version, if it changed"""
+        try:
+            file_stat = os.stat(path, follow_symlinks=False)
+        except OSError:
+            file_stat = None
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+            self.remove(path)
+            return
+        record = walker.file_record(path, file_stat)
+        old = self.records.get(path)
+        if old is None or checksum_cache.record_key(old) != \
+                checksum_cache.record_key(record):
+            self.add(record)
+
+    def remove(self, path):
+        """Remove a path from the index, if indexed"""
+        record = self.records.pop(path, None)
+        if record is None:
+            return
+        paths = self.by_size[record.size]
+        paths.discard(path)
+        if not paths:
+            del self.by_size[record.size]
+        digest = self.digests.pop(path, None)
+        if digest is not None:
+            self.recent[checksum_cache.record_key(record)] = digest
+            key = (record.size, digest)
+            self.by_digest[key].discard(path)
+            if not self.by_digest[key]:
+                del self.by_digest[key]
+            self.dirty.add(key)
+
+    def remove_tree(self, dir_path):
+        """Remove every path under a directory"""
+        prefix = os.path.join(dir_path, '')
+        for path in [path for path in self.records
+                     if path.startswith(prefix)]:
+            self.remove(path)
+
+    def inodes(self, paths):
+        """Return the number of distinct inodes of indexed paths"""
+        return len(set(walker.inode_key(self.records[path])
+                       for path in paths))
+
+    def changes(self):
+        """
+        Hash the files whose size now collides with another inode and
+        report the groups which changed since the last call
+        - Expected value: list of GroupEvent, by size and digest
+        """
+        known = dict(self.recent)
+        missing = list()
+        for size in self.pending:
+            paths = self.by_size.get(size, ())
+            if self.inodes(paths) < 2:
+                continue
+            for path in paths:
+                key = checksum_cache.record_key(self.records[path])
+                if path in self.digests:
+                    known[key] = self.digests[path]
+                else:
+                    missing.append((path, key))
+        to_hash = dict((key, self.records[path]) for path, key in missing
+                       if key not in known)
+        checksums = fdf.get_file_checksums(
+            list(to_hash.values()), cache=self.cache, jobs=self.jobs,
+            use_processes=self.use_processes, hash=self.hash)
+        self.files_hashed += len(to_hash)
+        known.update(zip(to_hash, checksums))
+        for path, key in missing:
+            if known.get(key):
+                size = self.records[path].size
+                self.digests[path] = known[key]
+                self.by_digest.setdefault((size, known[key]), set()).add(
+                    path)
+                self.dirty.add((size, known[key]))
+        self.pending = set()
+        self.recent = dict()
+
+        events = list()
+        for key in sorted(self.dirty):
+            paths = sorted(self.by_digest.get(key, ()))
+            old = self.reported.get(key)
+            if paths and self.inodes(paths) > 1:
+                if old != paths:
+                    events.append(GroupEvent('new' if old is None
+                                             else 'updated', key[0], key[1],
+                                             paths))
+                    self.reported[key] = paths
+            elif old is not None:
+                events.append(GroupEvent('dissolved', key[0], key[1], old))
+                del self.reported[key]
+        self.dirty = set()
+        return events
+
+
+class Watcher:
+    """
+    Keep a DuplicateIndex of a tree up to date with inotify
+    start() scans the tree, then every poll() applies the events queued
+    since; each returns the GroupEvents of its changes. New directories
+    are watched and scanned, directories moved away or deleted are
+    forgotten, and the whole tree is scanned again when the kernel queue
+    overflowed.
+    - Raise OSError when inotify is not available
+    """
+
+    def __init__(self, root, show_hidden=False, index=None):
+        self.root = os.path.abspath(root)
+        self.show_hidden = show_hidden
+        self.index = index if index is not None else DuplicateIndex()
+        self.inotify = Inotify()
+        self.dirs = dict()
+
+    def watch_tree(self, path):
+        """
+        Watch a directory and its sub-directories, then list them
+        - Expected value: list of walker.FileRecords of their files
+        - Directories which cannot be watched, e.g. past
+        fs.inotify.max_user_watches, are logged and still listed
+        """
+        records = list()
+        stack = [path]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                self.dirs[self.inotify.add_watch(dir_path)] = dir_path
+            except OSError as error:
+                logger.warning('unwatched', extra=logs.fields(
+                    path=dir_path, error=str(error)))
+            files, sub_dirs = walker.list_directory(dir_path,
+                                                    self.show_hidden)
+            records.extend(walker.file_record(os.path.join(dir_path, name),
+                                              file_stat)
+                           for name, file_stat in files)
+            stack.extend(reversed(sub_dirs))
+        return records
+
+    def forget_tree(self, path):
+        """Stop watching a directory and its sub-directories"""
+        prefix = os.path.join(path, '')
+        for wd, dir_path in list(self.dirs.items()):
+            if dir_path == path or dir_path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.dirs[wd]
+        self.index.remove_tree(path)
+
+    def start(self):
+        """Scan the tree, return the GroupEvents of its duplicates"""
+        for record in self.watch_tree(self.root):
+            self.index.add(record)
+        logger.info('watch', extra=logs.fields(
+            root=self.root, dirs=len(self.dirs),
+            files=len(self.index.records)))
+        return self.index.changes()
+
+    def rescan(self):
+        """Scan the whole tree again, after events were lost"""
+        logger.warning('rescan', extra=logs.fields(root=self.root))
+        for wd in list(self.dirs):
+            self.inotify.rm_watch(wd)
+        self.dirs = dict()
+        self.index.remove_tree(self.root)
+        for record in self.watch_tree(self.root):
+            self.index.add(record)
+
+    def handle(self, wd, mask, name):
+        """Apply one inotify event to the index"""
+        if mask & IN_Q_OVERFLOW:
+            self.rescan()
+            return
+        if mask & IN_IGNORED:
+            self.dirs.pop(wd, None)
+            return
+        dir_path = self.dirs.get(wd)
+        if dir_path is None or not name or \
+                (not self.show_hidden and name[0] == '.'):
+            return
+        path = os.path.join(dir_path, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                for record in self.watch_tree(path):
+                    self.index.add(record)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.forget_tree(path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.index.remove(path)
+        else:
+            self.index.update(path)
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout seconds for events and apply them
+        - Expected value: list of GroupEvents, empty when nothing changed
+        """
+        for wd, mask, _, name in self.inotify.read(timeout):
+            self.handle(wd, mask, name)
+        return self.index.changes()
+
+    def close(self):
+        self.inotify.close()
+
+
+def get_arguments():
+    """
+    Get argument from command-line interface
+    - Expected value: ArgumentParser Object with attributes:
+        - parser.path
+        - parser.hidden
+        - parser.cache
+        - parser.jobs
+        - parser.hash
+    """
+    parser = argparse.ArgumentParser(description='Watch a tree and report \
+                                                  its duplicate groups as \
+                                                  they appear and dissolve')
+    parser.add_argument('-p', '--path', type=str, required=True)
+    parser.add_argument('-s', '--hidden', action='store_true')
+    parser.add_argument('-c', '--cache', type=str, default=None,
+                        metavar='CACHE_FILE')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--hash', type=hashers.get_hash_factory,
+                        default=hashers.get_hash_factory('md5'))
+    return parser.parse_args()
+
+
+def write_events(events, stream=sys.stdout):
+    """Write each GroupEvent as one JSON line"""
+    for event in events:
+        stream.write(json.dumps(event._asdict()) + "\n")
+    stream.flush()
+
+
+def main():
+    """Watch a tree until interrupted, one JSON line per GroupEvent"""
+    ARGS = get_arguments()
+    fdf.valid_path(ARGS.path)
+    CACHE = None
+    if ARGS.cache:
+        CACHE = checksum_cache.ChecksumCache(ARGS.cache)
+    WATCHER = Watcher(ARGS.path, ARGS.hidden, DuplicateIndex(
+        hash=ARGS.hash, cache=CACHE,
+        jobs=ARGS.jobs or workers.default_jobs()))
+    try:
+        write_events(WATCHER.start())
+        while True:
+            write_events(WATCHER.poll())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        WATCHER.close()
+        if CACHE is not None:
+            CACHE.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import os
+import fileio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def default_jobs():
+    """Return the number of CPUs available to this process"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def call_safely(func, item):
+    """
+    Call func(item) and capture an OSError instead of raising it
+    - Expected value: (True, result) or (False, None) on OSError, which is
+    counted in fileio.counters()
+    """
+    try:
+        return (True, func(item))
+    except OSError:
+        fileio.count('errors')
+        return (False, None)
+
+
+class _SafeCall:
+    """Picklable wrapper of call_safely() bound to a function"""
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item):
+        return call_safely(self.func, item)
+
+
+def map_files(func, items, jobs=1, use_processes=False):
+    """
+    Apply func to every item with a pool of workers
+    - Expected value: list of (ok, result) tuples in the order of items,
+    see call_safely()
+    - jobs <= 1 runs serially in the calling thread
+    - Threads are used by default since hashlib releases the GIL while
+    hashing large buffers, use_processes switches to a process pool, in
+    which case func must be picklable
+    """
+    items = list(items)
+    safe_func = _SafeCall(func)
+    if jobs is None or jobs <= 1 or len(items) < 2:
+        return [safe_func(item) for item in items]
+    jobs = min(jobs, len(items))
+    if use_processes:
+        chunksize = max(1, len(items) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(safe_func, items, chunksize=chunksize))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(safe_func, items))